@@ -3,6 +3,7 @@
 Collection of classes to help create plots.
 """
 import matplotlib.pyplot as plt
+import numpy as np
 
 
 class Plot(object):
@@ -131,8 +132,36 @@ class SpPlot(Plot):
 
         return
 
-    # def draw_band_limits(self):
-    #    return
+    def draw_band_limits(self, regions, color='0.5', alpha=0.3):
+        """
+        Shade wavelength regions over the full height of the plot, eg.
+        the regions outside the bands or blocked by the atmosphere.
+
+        All the regions are drawn as a single BrokenBarHCollection, which
+        stays cheap however many regions there are.  The shading follows
+        the y-axis limits if they are changed later.
+
+        :param regions: Lower and upper wavelengths of the regions, in the
+            units of the plotted spectrum.
+        :type regions: array of shape (n, 2)
+        :param color: Colour of the shading.
+        :type color: str
+        :param alpha: Opacity of the shading.
+        :type alpha: float
+        :return: The artist, or None if there are no regions.
+        :rtype: BrokenBarHCollection
+        """
+        regions = np.asarray(regions, dtype=float).reshape(-1, 2)
+        if regions.shape[0] == 0:
+            return None
+        xranges = np.column_stack((regions[:, 0],
+                                   regions[:, 1] - regions[:, 0]))
+        # x in data units, y in axes units: 0 to 1 spans the whole height
+        artist = self.axplot.broken_barh(
+            xranges, (0, 1), transform=self.axplot.get_xaxis_transform(),
+            facecolors=color, edgecolors='none', alpha=alpha, zorder=0)
+        self.fig.canvas.draw()
+        return artist
 
     def write_png(self, output_name):
         """
@@ -9,9 +9,16 @@ Utility function to plot a spectrum and annotate.
 
 from klpyastro.sciformats import spectro
 from klpyastro.plot import plottools
+from klpyastro.utils import throughput
 from klpyastro.utils.bookkeeping import get_valid_extension
+import hashlib
 import numpy as np
 
+# Masked regions already computed, by wavelength grid, band limits and
+# atmosphere.  See get_masked_regions().
+_MASKED_REGIONS_CACHE = {}
+_MASKED_REGIONS_CACHE_SIZE = 64
+
 def specplot(hdulist, spec_ext, var_ext, annotations=None,
              ylimits=None, output_plot_name=None):
     """
@@ -23,9 +30,10 @@ def specplot(hdulist, spec_ext, var_ext, annotations=None,
 
     Lines can be annotated provide that the list is defined
     in the spectro.py module.  A redshift can be applied to the line list.
-    The user can reset the y-axis limits.  Work in progress is the ability
-    to draw band limits to identify where the signal is not good due to
-    atmospheric absorption.  The plot can be saved as PNG.
+    The user can reset the y-axis limits.  The regions outside the bands
+    and those blocked by the atmosphere can be shaded, to identify where
+    the signal is not good, see get_masked_regions().  The plot can be
+    saved as PNG.
 
     Parameters
     ----------
@@ -59,14 +67,10 @@ def specplot(hdulist, spec_ext, var_ext, annotations=None,
     No return values. A plot is produced on screen, and it can be saved
     to disk.
 
-    Raises
-    ______
-    NotImplementedError
-        Some features are not yet implemented.
-
     See Also
     --------
     splot : An app that uses this function and is callable from the shell.
+    get_masked_regions : Regions shaded when drawing the band limits.
 
     Examples
     --------
@@ -100,12 +104,13 @@ def specplot(hdulist, spec_ext, var_ext, annotations=None,
     else:
         linelist = None
 
-    # Get the band limits.
+    # Get the regions outside the bands or blocked by the atmosphere.
     if annotations.draw_bands_limits:
-        errmsg = 'Draw bands limits feature not implemented.'
-        raise NotImplementedError(errmsg)
-#        bandlist = spectro.BandList(spectrum.wlen[0], spectrum.wlen[-1])
-
+        masked_regions = get_masked_regions(spectrum.wlen, spectrum.wunit,
+                                            annotations.atmosphere,
+                                            annotations.atmosphere_cutoff)
+    else:
+        masked_regions = None
 
     # ----- START PLOTTING
     #
@@ -126,8 +131,8 @@ def specplot(hdulist, spec_ext, var_ext, annotations=None,
         plot.annotate_lines(lines_to_plot)
 
     # Draw the band limits
-#    if annotations.draw_band_limits:
-#        plot.draw_band_limits()
+    if masked_regions is not None:
+        plot.draw_band_limits(masked_regions)
 
     # Save the plot to disk.
     if output_plot_name is not None:
@@ -136,6 +141,113 @@ def specplot(hdulist, spec_ext, var_ext, annotations=None,
     return
 
 
+def get_masked_regions(wlen, wunit, atmosphere=None, cutoff=0.8,
+                       registry=None):
+    """
+    Find the wavelength regions of a spectrum that are outside the
+    photometric bands or blocked by the atmosphere.
+
+    The bands covering the spectrum are obtained from the shared band
+    registry (throughput.BandList).  The bands whose transmission curve
+    is missing are skipped with a warning.  A pixel is masked if it is
+    outside the limits of all the bands, or if it is inside a region where
+    the atmospheric transmission is below cutoff.  The masked pixels are then
+    grouped into regions.  The result is cached by wavelength grid, band
+    limits and atmospheric transmission, so that a batch of spectra
+    sharing a grid computes the masks only once.
+
+    Parameters
+    ----------
+    wlen : ndarray
+        Wavelengths of the spectrum pixels, in increasing order.
+    wunit : Unit
+        Units of the wavelengths.
+    atmosphere : AtmosphericTransparency, optional
+        Atmospheric model.  If None, only the band limits are used.
+    cutoff : float, optional
+        Atmospheric transmission below which a region is blocked.
+        Default = 0.8
+    registry : BandRegistry, optional
+        Registry of the band curves.  Default = throughput.BAND_REGISTRY
+
+    Returns
+    -------
+    ndarray
+        Array of shape (n, 2) with the lower and upper wavelengths, in
+        wunit, of the masked regions.  The limits are pixel edges.  The
+        array is shared and read-only.
+
+    See Also
+    --------
+    throughput.in_regions : Used to compute the masks.
+    plottools.SpPlot.draw_band_limits : Draws the regions.
+    """
+    wlen = np.asarray(wlen, dtype=np.float64)
+    lower = wlen[0] * wunit
+    upper = wlen[-1] * wunit
+    # The band limits are obtained first, the bands are already cached
+    # by the registry, so that the key follows its changes.
+    band_regions = []
+    for band in throughput.BandList(lower, upper, registry,
+                                    skip_missing=True).bands:
+        limits = band.get_limits() * band.wunit
+        band_regions.append(limits.to(wunit).value)
+    band_regions = np.array(sorted(band_regions),
+                            dtype=np.float64).reshape(-1, 2)
+    if atmosphere is None:
+        atmosphere_key = None
+    else:
+        atmosphere_key = _get_digest(atmosphere.wlen, atmosphere.transmission,
+                                     atmosphere.wunit.to_string())
+    key = (_get_digest(wlen), str(wunit), _get_digest(band_regions),
+           atmosphere_key, cutoff)
+    if key in _MASKED_REGIONS_CACHE:
+        return _MASKED_REGIONS_CACHE[key]
+
+    if band_regions.size:
+        mask = ~throughput.in_regions(wlen, band_regions)
+    else:
+        # no band covers the spectrum, nothing to limit
+        mask = np.zeros(wlen.size, dtype=bool)
+
+    if atmosphere is not None:
+        blocked = atmosphere.get_blocked_regions(cutoff, lower=lower,
+                                                 upper=upper)
+        blocked = (blocked * atmosphere.wunit).to(wunit).value
+        mask |= throughput.in_regions(wlen, blocked)
+
+    # Runs of masked pixels, extended to the pixel edges.
+    edges = np.empty(wlen.size + 1)
+    edges[1:-1] = (wlen[1:] + wlen[:-1]) / 2.
+    edges[0] = wlen[0] - (edges[1] - wlen[0])
+    edges[-1] = wlen[-1] + (wlen[-1] - edges[-2])
+    steps = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(steps == 1)
+    ends = np.flatnonzero(steps == -1)
+    regions = np.column_stack((edges[starts], edges[ends]))
+
+    regions.flags.writeable = False
+    if len(_MASKED_REGIONS_CACHE) >= _MASKED_REGIONS_CACHE_SIZE:
+        _MASKED_REGIONS_CACHE.clear()
+    _MASKED_REGIONS_CACHE[key] = regions
+    return regions
+
+
+def _get_digest(*items):
+    """
+    Digest of arrays and strings, to key the cache on their content.
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, str):
+            digest.update(item.encode('utf-8'))
+        else:
+            array = np.ascontiguousarray(item, dtype=np.float64)
+            digest.update(array.tobytes())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
 class SpecPlotAnnotations(object):
     """
     A collection of information for the plot annotations.
@@ -153,9 +265,16 @@ class SpecPlotAnnotations(object):
     annotate_lines : bool
         Toggle on line identification annotation.  If True, line_list_name
         must be set to a valid name. Default = False.
+    atmosphere : AtmosphericTransparency, optional
+        Atmospheric model used to shade the blocked regions when drawing
+        the band limits.  Default = None.
+    atmosphere_cutoff : float
+        Transmission below which the atmosphere is considered opaque.
+        Default = 0.8.
     draw_bands_limits : bool
-        Toggle on the drawing of the band limits.  Not implemented yet.
-        Default = False.
+        Toggle on the drawing of the band limits, ie. the shading of the
+        regions outside the bands and, if an atmosphere is set, of the
+        regions blocked by the atmosphere.  Default = False.
     line_list_name : str, optional
         Name of the line list to use.  The lists are defined in
         spectro.LINELIST_DICT.  line_list_name must be set if annotate_lines
@@ -172,6 +291,8 @@ class SpecPlotAnnotations(object):
     def __init__(self, title=None):
         self.title = title
         self.annotate_lines = False
+        self.atmosphere = None
+        self.atmosphere_cutoff = 0.8
         self.draw_bands_limits = False
         self.line_list_name = None
         self.redshift = 0.
@@ -207,6 +328,37 @@ class SpecPlotAnnotations(object):
 
         return
 
+    def set_atmosphere(self, atmosphere, cutoff=0.8):
+        """
+        Set the atmosphere attributes and set draw_bands_limits to True.
+
+        Parameters
+        ----------
+        atmosphere : AtmosphericTransparency
+            Atmospheric model, eg. from
+            throughput.AtmosphericModelGrid.get_transparency().
+        cutoff : float, optional
+            Transmission below which the atmosphere is considered opaque.
+            Default = 0.8
+        """
+        self.atmosphere = atmosphere
+        self.atmosphere_cutoff = cutoff
+        self.draw_bands_limits = True
+        return
+
+    def set_draw_bands_limits(self, draw_bands_limits=True):
+        """
+        Set the draw_bands_limits attribute.
+
+        Parameters
+        ----------
+        draw_bands_limits : bool, optional
+            Toggle the shading of the regions outside the bands, or blocked
+            by the atmosphere.  Default = True
+        """
+        self.draw_bands_limits = draw_bands_limits
+        return
+
     def set_redshift(self, redshift):
         """
         Set the redshift attribute.
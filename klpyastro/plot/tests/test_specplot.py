@@ -0,0 +1,140 @@
+from klpyastro.plot import specplot
+from klpyastro.plot import plottools
+from klpyastro.utils import throughput
+from astropy import units as u
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from nose.tools import assert_is_none
+from nose.tools import assert_raises
+from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_almost_equal
+import matplotlib.pyplot as plt
+import numpy as np
+import shutil
+import tempfile
+
+
+class TestGetMaskedRegions:
+
+    @classmethod
+    def setup_class(cls):
+        TestGetMaskedRegions.tmpdir = tempfile.mkdtemp()
+        # one band, transmitting from 1.10 to 1.30 micron
+        wlen = np.arange(10000., 14001., 100.)
+        transmission = np.where((wlen >= 11000.) & (wlen <= 13000.), 0.9, 0.)
+        np.savetxt('%s/J-band.dat' % TestGetMaskedRegions.tmpdir,
+                   np.column_stack((wlen, transmission)), header='wlen T',
+                   comments='')
+        TestGetMaskedRegions.registry = throughput.BandRegistry(
+            bands_table=[(1.2 * u.micron, 'J-band')],
+            search_path=[TestGetMaskedRegions.tmpdir],
+            cachedir=TestGetMaskedRegions.tmpdir)
+        atmos_wlen = np.arange(10000., 14001., 10.)
+        atmos_transmission = np.ones(atmos_wlen.size)
+        atmos_transmission[(atmos_wlen >= 12000.) & (atmos_wlen <= 12100.)] = 0.
+        TestGetMaskedRegions.atmosphere = throughput.AtmosphericTransparency(
+            wlen=atmos_wlen, transmission=atmos_transmission)
+        TestGetMaskedRegions.wlen = np.arange(10500., 13501., 50.)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestGetMaskedRegions.tmpdir)
+
+    def test_bands_only(self):
+        expected_result = [[10475., 10975.], [13025., 13525.]]
+        result = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom,
+            registry=TestGetMaskedRegions.registry)
+        assert_array_equal(result, expected_result)
+
+    def test_with_atmosphere(self):
+        expected_result = [[10475., 10975.], [11975., 12125.],
+                           [13025., 13525.]]
+        result = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom,
+            atmosphere=TestGetMaskedRegions.atmosphere,
+            registry=TestGetMaskedRegions.registry)
+        assert_array_equal(result, expected_result)
+
+    def test_units(self):
+        # spectrum in micron, band and atmosphere in Angstrom
+        expected_result = [[1.05, 1.1], [1.2, 1.21], [1.3, 1.355]]
+        result = specplot.get_masked_regions(
+            (TestGetMaskedRegions.wlen + 25.) / 1.e4, u.micron,
+            atmosphere=TestGetMaskedRegions.atmosphere,
+            registry=TestGetMaskedRegions.registry)
+        assert_array_almost_equal(result, expected_result)
+
+    def test_missing_curve(self):
+        # the H-band curve is missing: skipped, J-band still used
+        registry = throughput.BandRegistry(
+            bands_table=[(1.2 * u.micron, 'J-band'),
+                         (1.3 * u.micron, 'H-band')],
+            search_path=[TestGetMaskedRegions.tmpdir],
+            cachedir=TestGetMaskedRegions.tmpdir)
+        expected_result = [[10475., 10975.], [13025., 13525.]]
+        result = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom, registry=registry)
+        assert_array_equal(result, expected_result)
+
+    def test_no_bands(self):
+        # no band covers the spectrum: nothing is masked
+        result = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen + 10000., u.Angstrom,
+            registry=TestGetMaskedRegions.registry)
+        assert_equal(result.shape, (0, 2))
+
+    def test_cache(self):
+        result1 = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom,
+            registry=TestGetMaskedRegions.registry)
+        result2 = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen.copy(), u.Angstrom,
+            registry=TestGetMaskedRegions.registry)
+        assert_true(result1 is result2)
+        assert_raises(ValueError, result1.__setitem__, 0, 0.)
+
+    def test_cache_changes(self):
+        # a change of the bands or of the atmosphere is not hidden by
+        # the cache
+        registry = throughput.BandRegistry(
+            bands_table=[(1.2 * u.micron, 'J-band')],
+            search_path=[TestGetMaskedRegions.tmpdir],
+            cachedir=TestGetMaskedRegions.tmpdir)
+        result1 = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom, registry=registry)
+        registry.bands_table = []
+        result2 = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom, registry=registry)
+        assert_equal(result1.shape, (2, 2))
+        assert_equal(result2.shape, (0, 2))
+        atmosphere = throughput.AtmosphericTransparency(
+            wlen=TestGetMaskedRegions.atmosphere.wlen,
+            transmission=TestGetMaskedRegions.atmosphere.transmission.copy())
+        result3 = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom, atmosphere=atmosphere,
+            registry=TestGetMaskedRegions.registry)
+        atmosphere.transmission[:] = 1.
+        result4 = specplot.get_masked_regions(
+            TestGetMaskedRegions.wlen, u.Angstrom, atmosphere=atmosphere,
+            registry=TestGetMaskedRegions.registry)
+        assert_equal(result3.shape, (3, 2))
+        assert_equal(result4.shape, (2, 2))
+
+
+class TestDrawBandLimits:
+
+    def test_single_artist(self):
+        plot = plottools.SpPlot()
+        plot.axplot.plot([1000., 2000.], [0., 1.])
+        artist = plot.draw_band_limits([[1100., 1200.], [1500., 1600.],
+                                        [1900., 2000.]])
+        assert_equal(len(plot.axplot.collections), 1)
+        assert_true(artist is plot.axplot.collections[0])
+        plt.close(plot.fig)
+
+    def test_no_regions(self):
+        plot = plottools.SpPlot()
+        assert_is_none(plot.draw_band_limits(np.empty((0, 2))))
+        assert_equal(len(plot.axplot.collections), 0)
+        plt.close(plot.fig)
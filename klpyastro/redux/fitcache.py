@@ -0,0 +1,147 @@
+# fitcache.py
+"""
+Persistent, on-disk cache of profile fit results.
+"""
+from __future__ import print_function
+
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+
+class FitCache(object):
+    """
+    Store the converged parameters and covariance of profile fits on disk.
+
+    Each result is stored in its own small .npz file named after a key.
+    The keys are hashes of whatever defines the fit, eg. the data
+    being fitted, the profile type and the initial parameters.  Identical
+    inputs give identical keys, therefore a fit can be retrieved instead of
+    being repeated.
+
+    Parameters
+    ----------
+    cachedir : str, optional
+        Directory where the fit results are stored.  If not specified,
+        the 'fits' subdirectory of the klpyastro cache directory is used.
+
+    Attributes
+    ----------
+    cachedir : str
+        Directory where the fit results are stored.
+
+    See Also
+    --------
+    klpyastro.utils.fileutils.get_cache_dir : Default cache location.
+
+    Examples
+    --------
+    >>> cache = FitCache('/tmp/fitcache')
+    >>> key = FitCache.make_key(linedata, 'voigt', [1., 0., -5., 200., 3., 3.])
+    >>> cache.put(key, [1., 0.1, -4.5, 201.2, 2.8, 3.1])
+    >>> (params, covar) = cache.get(key)
+    """
+
+    def __init__(self, cachedir=None):
+        if cachedir is None:
+            from klpyastro.utils.fileutils import get_cache_dir
+            cachedir = get_cache_dir('fits')
+        elif not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.cachedir = cachedir
+
+    @classmethod
+    def make_key(cls, *items):
+        """
+        Hash the items defining a fit into a key.
+
+        Parameters
+        ----------
+        items : ndarray, str, float, or list of those
+            The items to hash.  Arrays are hashed by content, dtype and
+            shape.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest.
+        """
+        digest = hashlib.sha1()
+        for item in items:
+            if isinstance(item, np.ndarray):
+                item = np.ascontiguousarray(item)
+                digest.update(str((item.dtype.str, item.shape)).encode('ascii'))
+                digest.update(item.tobytes())
+            else:
+                digest.update(repr(item).encode('utf-8'))
+            digest.update(b'|')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Retrieve a fit result.
+
+        Parameters
+        ----------
+        key : str
+            Key obtained from make_key().
+
+        Returns
+        -------
+        tuple of ndarray or None
+            The parameters and the covariance matrix.  The covariance is None
+            if it was not stored.  None is returned if the key is not in the
+            cache.
+        """
+        filename = self._get_filename(key)
+        try:
+            with np.load(filename) as result:
+                params = result['params']
+                covar = result['covar'] if 'covar' in result.files else None
+        except (IOError, OSError, KeyError, ValueError, EOFError,
+                zipfile.BadZipfile):
+            # missing, or truncated by an interrupted writer
+            return None
+        return (params, covar)
+
+    def put(self, key, params, covar=None):
+        """
+        Store a fit result.  The file is written under a temporary name
+        then renamed, so that a concurrent reader never sees a partial file.
+
+        Parameters
+        ----------
+        key : str
+            Key obtained from make_key().
+        params : list of float or ndarray
+            Converged parameters.
+        covar : ndarray, optional
+            Covariance matrix of the parameters.
+        """
+        arrays = {'params': np.asarray(params, dtype=np.float64)}
+        if covar is not None:
+            arrays['covar'] = np.asarray(covar, dtype=np.float64)
+        (fd, tmpname) = tempfile.mkstemp(suffix='.npz', dir=self.cachedir)
+        try:
+            with os.fdopen(fd, 'wb') as tmpfile:
+                np.savez(tmpfile, **arrays)
+            os.rename(tmpname, self._get_filename(key))
+        except Exception:
+            os.remove(tmpname)
+            raise
+        return
+
+    def clear(self):
+        """
+        Remove all the fit results from the cache directory.
+        """
+        for filename in os.listdir(self.cachedir):
+            if filename.endswith('.npz'):
+                os.remove(os.path.join(self.cachedir, filename))
+        return
+
+    def _get_filename(self, key):
+        return os.path.join(self.cachedir, key + '.npz')
@@ -1,14 +1,23 @@
 from __future__ import print_function
 
+import os
 from math import pi
 from astropy.io import fits
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import ndimage, signal
 import stsci.convolve._lineshape as ls
 
 from klpysci.fit import fittools as ft
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
 # Utility function to open and plot original spectrum
+# The file is left open for write_replaced_data().  astropy memory-maps
+# it, unless the data is scaled (BZERO/BSCALE/BLANK).
 def openNplot1d (filename, extname=('SCI',1)):
     hdulist = fits.open(filename, 'readonly')
     sp = hdulist[extname].data
@@ -19,10 +28,13 @@ def openNplot1d (filename, extname=('SCI',1)):
     return hdulist
 
 # Interactive specification of the section around the feature to work on
-def getsubspec (sp):
+# The user is prompted for the edges that are not given.
+def getsubspec (sp, x1=None, x2=None):
     # here it should be graphical, but I'm still working on that
-    x1 = input("Left edge pixel: ")
-    x2 = input("Right edge pixel: ")
+    if x1 is None:
+        x1 = int(input("Left edge pixel: "))
+    if x2 is None:
+        x2 = int(input("Right edge pixel: "))
 
     flux = sp[x1:x2]
     pixel = np.arange(x1,x2,1)
@@ -38,48 +50,146 @@ def getsubspec (sp):
 
     return sub
 
-def plotresult (sp, bf, nsp):
+def plotresult (sp, bf, nsp, bfx=None):
     plt.clf()
     x = np.arange(0,sp.shape[0],1)
     plt.plot (x, sp)
     plt.plot (x, nsp)
-    x = np.arange(0,bf.shape[0],1)
-    plt.plot (x, bf)
+    if bfx is None:
+        bfx = np.arange(0,bf.shape[0],1)
+    plt.plot (bfx, bf)
 
-def rmfeature (inspec, outspec, params=None, profile='voigt'):
-    #---- plot and get data
-    spin = openNplot1d(inspec)
-    specdata = spin['SCI'].data
-    spin.close()
+# Write a copy of the file opened as 'hdulist' with the data of extension
+# 'extname' replaced by 'newdata'.  Only that extension is rewritten.  The
+# bytes before and after it (headers and data of the other extensions)
+# are streamed from the input file as is, without being parsed.
+# If the input cannot be copied byte-for-byte (eg. compressed, or modified
+# in memory), the whole HDUList is written with astropy.
+def write_replaced_data (hdulist, newdata, outspec, extname='SCI',
+                         chunksize=2**20):
+    index = hdulist.index_of(extname)
+    fileinfo = hdulist.fileinfo(index)
 
-    #---- Get data for section around feature
-    linedata = getsubspec(specdata)
+    # Setting the data updates BITPIX, NAXISn, BSCALE, etc. in the header.
+    # The checksums of the input would be stale: they are recomputed.
+    # The other extensions are copied as is, theirs are still valid.
+    hdulist[index].data = newdata
+    header = hdulist[index].header
+    if 'CHECKSUM' in header:
+        hdulist[index].add_checksum()
+    elif 'DATASUM' in header:
+        hdulist[index].add_datasum()
+    if fileinfo is None or fileinfo['filename'] is None or \
+            fileinfo['resized'] or \
+            getattr(fileinfo['file'], 'compression', None) is not None:
+        hdulist.writeto(outspec, output_verify='ignore')
+        return
 
-    #---- Calculate and set initial parameter from linedata
+    data = np.ascontiguousarray(newdata,
+                                dtype=newdata.dtype.newbyteorder('>'))
+    padding = (-data.nbytes) % 2880
 
-    if params is None:
-        contslope = (linedata[1][0] - linedata[1][-1]) / \
-                    (linedata[0][0] - linedata[0][-1])
-        contlevel = linedata[1][0] - (contslope * linedata[0][0])
-        lineindex = linedata.argmin(1)[1]
-        lineposition = linedata[0][lineindex]
-        linestrength = linedata[1][lineindex] - \
-                       ((contslope*linedata[0][lineindex]) + contlevel)
-        linewidth = 20.   # pixels.  should find a better way.
+    if os.path.exists(outspec):
+        raise IOError('File exists: %s' % outspec)
+    with open(fileinfo['filename'], 'rb') as fin, \
+            open(outspec, 'wb') as fout:
+        _copy_bytes(fin, fout, 0, fileinfo['hdrLoc'], chunksize)
+        fout.write(header.tostring().encode('ascii'))
+        fout.write(data.tobytes())
+        fout.write(b'\0' * padding)
+        fin.seek(fileinfo['datLoc'] + fileinfo['datSpan'])
+        _copy_bytes(fin, fout, None, None, chunksize)
+    return
 
-        cte = ft.Parameter(contlevel)
-        m = ft.Parameter(contslope)
-        A = ft.Parameter(linestrength)
-        mu = ft.Parameter(lineposition)
-        fwhmL = ft.Parameter(linewidth)
-        fwhmD = ft.Parameter(linewidth)
-    else:
-        cte = ft.Parameter(params[0])
-        m = ft.Parameter(params[1])
-        A = ft.Parameter(params[2])
-        mu = ft.Parameter(params[3])
-        fwhmL = ft.Parameter(params[4])
-        fwhmD = ft.Parameter(params[5])
+# Copy 'length' bytes (or up to EOF if None) from 'start' (or the current
+# position if None), 'chunksize' bytes at a time.
+def _copy_bytes (fin, fout, start, length, chunksize):
+    if start is not None:
+        fin.seek(start)
+    while length is None or length > 0:
+        size = chunksize if length is None else min(chunksize, length)
+        chunk = fin.read(size)
+        if not chunk:
+            break
+        fout.write(chunk)
+        if length is not None:
+            length -= len(chunk)
+
+# Approximate FWHM of a Voigt profile (Olivero & Longbothum, 1977)
+def voigt_fwhm (fwhmL, fwhmD):
+    fwhmL = abs(fwhmL)
+    fwhmD = abs(fwhmD)
+    return 0.5346 * fwhmL + np.sqrt(0.2166 * fwhmL**2 + fwhmD**2)
+
+# Pixel section [x1, x2) extending nfwhm * fwhm on each side of the
+# line center, clipped to the spectrum.  nfwhm=None selects everything.
+# A Lorentzian is still at 1/(1+4*nfwhm**2) of its peak at the edge,
+# eg. 0.25% for nfwhm=10.
+def profile_window (mu, fwhm, nfwhm, npix):
+    if nfwhm is None:
+        return (0, npix)
+    halfwidth = nfwhm * abs(fwhm)
+    x1 = min(max(int(np.floor(mu - halfwidth)), 0), npix)
+    x2 = max(min(int(np.ceil(mu + halfwidth)) + 1, npix), x1)
+    return (x1, x2)
+
+# Subtract, in place, a profile evaluated only within the window.
+# The cost scales with the width of the feature, not of the spectrum.
+def subtract_profile (spdata, profile, window):
+    (x1, x2) = window
+    spdata[x1:x2] -= profile(np.arange(x1, x2))
+    return spdata
+
+# Set the values of a list of fit Parameters
+def set_parameters (parameters, values):
+    for (p, value) in zip(parameters, values):
+        p.set(value)
+
+# Covariance of the fitted parameters from a finite-difference Jacobian
+# of the model at the solution, scaled by the variance of the residuals.
+def fit_covariance (function, parameters, y, x):
+    p0 = np.array([p() for p in parameters], dtype=np.float64)
+    model0 = function(x)
+    jacobian = np.empty((y.shape[0], p0.shape[0]))
+    for (i, p) in enumerate(parameters):
+        step = 1e-6 * max(abs(p0[i]), 1.)
+        p.set(p0[i] + step)
+        jacobian[:, i] = (function(x) - model0) / step
+        p.set(p0[i])
+    dof = max(y.shape[0] - p0.shape[0], 1)
+    variance = np.sum((y - model0)**2) / dof
+    try:
+        covar = np.linalg.inv(np.dot(jacobian.T, jacobian)) * variance
+    except np.linalg.LinAlgError:
+        covar = None
+    return covar
+
+# Initial parameters [cte, m, A, mu, fwhmL, fwhmD] estimated from the
+# data section: straight continuum between the edges of the section and
+# line center at the minimum.
+def initial_parameters (linedata, linewidth=20.):
+    contslope = (linedata[1][0] - linedata[1][-1]) / \
+                (linedata[0][0] - linedata[0][-1])
+    contlevel = linedata[1][0] - (contslope * linedata[0][0])
+    lineindex = linedata.argmin(1)[1]
+    lineposition = linedata[0][lineindex]
+    linestrength = linedata[1][lineindex] - \
+                   ((contslope*linedata[0][lineindex]) + contlevel)
+
+    return [contlevel, contslope, linestrength, lineposition,
+            linewidth, linewidth]
+
+# Fit the profile to the data section, starting from the initial
+# parameters 'init'.  If 'fit' is False, 'init' is used as is.
+# Returns the Parameters [cte, m, A, mu, fwhmL, fwhmD], the line profile
+# function and the continuum+profile function.
+def fit_feature (linedata, init, profile='voigt', cache=None, fit=True):
+    cte = ft.Parameter(init[0])
+    m = ft.Parameter(init[1])
+    A = ft.Parameter(init[2])
+    mu = ft.Parameter(init[3])
+    fwhmL = ft.Parameter(init[4])
+    fwhmD = ft.Parameter(init[5])
 
     #---- Define function [linear (continuum) + lorentz (feature)]
     #     I don't know where the factor 10 I need to apply to A() comes from.
@@ -109,32 +219,184 @@ def rmfeature (inspec, outspec, params=None, profile='voigt'):
     def contvoigt(x):
         return line(x) + voigt(x)
 
+    if profile=='voigt':
+        fitfunction = contvoigt
+        fitparams = [cte, m, A, mu, fwhmD, fwhmL]
+    elif profile=='lorentz':
+        fitfunction = contlorentz
+        fitparams = [cte, m, A, mu, fwhmL]
+    else:
+        raise ValueError('Unknown profile: %s' % profile)
+
     #---- Non-linear least square fit (optimize.leastsq)
-    if (params==None):
-        if profile=='voigt':    # Get initial params from Lorentz fit.
-            ft.nlfit(contlorentz, [cte, m, A, mu, fwhmL], linedata[1], x=linedata[0])
-            ft.nlfit(contvoigt, [cte, m, A, mu, fwhmD, fwhmL], linedata[1], x=linedata[0])
-        elif profile=='lorentz':
-            ft.nlfit(contlorentz, [cte, m, A, mu, fwhmL], linedata[1], x=linedata[0])
+    #     With a fit cache, a fit of the same data with the same profile
+    #     and initial parameters is reused as is.  A fit of the same data
+    #     with the same profile from other initial parameters, eg. the
+    #     automatic ones instead of the interactive ones, is used as the
+    #     starting point instead of the rough initial parameters.
+    if fit:
+        solution = None
+        seed = None
+        if cache is not None:
+            fitkey = cache.make_key(linedata, profile,
+                                    [p() for p in fitparams])
+            seedkey = cache.make_key(linedata, profile)
+            solution = cache.get(fitkey)
+            if solution is None:
+                seed = cache.get(seedkey)
+
+        if solution is not None:
+            print("Fit retrieved from cache.")
+            set_parameters(fitparams, solution[0])
+        else:
+            if seed is not None:
+                set_parameters(fitparams, seed[0])
+            elif profile=='voigt':    # Get initial params from Lorentz fit.
+                ft.nlfit(contlorentz, [cte, m, A, mu, fwhmL], linedata[1], x=linedata[0])
+            ft.nlfit(fitfunction, fitparams, linedata[1], x=linedata[0])
+            if cache is not None:
+                covar = fit_covariance(fitfunction, fitparams,
+                                       linedata[1], linedata[0])
+                solution = [p() for p in fitparams]
+                cache.put(fitkey, solution, covar)
+                cache.put(seedkey, solution, covar)
+
+        if profile=='lorentz':
             fwhmD=ft.Parameter(None)
+
+    if profile=='voigt':
+        return ([cte, m, A, mu, fwhmL, fwhmD], voigt, contvoigt)
+    else:
+        return ([cte, m, A, mu, fwhmL, fwhmD], lorentz, contlorentz)
+
+# FWHM of the fitted profile
+def feature_fwhm (fitted, profile='voigt'):
+    if profile=='voigt':
+        return voigt_fwhm(fitted[4](), fitted[5]())
     else:
-        pass
+        return abs(fitted[4]())
+
+# Automatic detection of absorption features.
+#   The continuum is estimated with a running median over 'contwidth'
+#   pixels (default: 5 x linewidth).  The continuum-subtracted spectrum
+#   is matched-filtered with a Gaussian of FWHM 'linewidth' pixels and
+#   the minima deeper than 'threshold' times the (MAD) noise of the
+#   filtered spectrum are the candidate features.
+#   'spectrum' is a Spectrum or an array of counts.  Returns a list of
+#   dictionaries, one per feature, with the section [x1, x2) to fit, the
+#   estimated FWHM and the initial parameters for the profile fitter.
+def find_features (spectrum, linewidth=20., threshold=5., contwidth=None):
+    counts = np.asarray(getattr(spectrum, 'counts', spectrum),
+                        dtype=np.float64)
+    npix = counts.shape[0]
+    if contwidth is None:
+        contwidth = 5. * linewidth
+
+    continuum = ndimage.median_filter(counts, size=int(contwidth) | 1,
+                                      mode='nearest')
+    residual = counts - continuum
+    kernel_sigma = linewidth / (2. * np.sqrt(2. * np.log(2.)))
+    filtered = ndimage.gaussian_filter1d(residual, kernel_sigma,
+                                         mode='nearest')
+    noise = 1.4826 * np.median(np.abs(filtered - np.median(filtered)))
+
+    (peaks, _) = signal.find_peaks(-filtered, height=threshold * noise,
+                                   distance=max(linewidth / 2., 1.))
+    if peaks.size == 0:
+        return []
+
+    # The filtered feature is the line convolved with the kernel.
+    widths = signal.peak_widths(-filtered, peaks, rel_height=0.5)[0]
+    fwhm = np.sqrt(np.clip(widths**2 - linewidth**2, 1., None))
+
+    # Sections of +/- 2 filtered widths, with continuum on both sides,
+    # and the initial parameters, for all the features at once.
+    x1 = np.clip(np.floor(peaks - 2. * widths).astype(int), 0, npix - 2)
+    x2 = np.clip(np.ceil(peaks + 2. * widths).astype(int) + 1, x1 + 2, npix)
+    contslope = (counts[x1] - counts[x2 - 1]) / (x1 - (x2 - 1))
+    contlevel = counts[x1] - contslope * x1
+    linestrength = counts[peaks] - (contslope * peaks + contlevel)
+
+    features = []
+    for i in range(peaks.size):
+        features.append({'section': (x1[i], x2[i]),
+                         'fwhm': fwhm[i],
+                         'params': [contlevel[i], contslope[i],
+                                    linestrength[i], float(peaks[i]),
+                                    fwhm[i], fwhm[i]]})
+    return features
+
+# Headless removal of all the features found by find_features().
+# Returns the list of features, each with the fitted parameters added
+# under 'fit', or None if the fit failed and the feature was left alone.
+def rmfeature_auto (inspec, outspec, profile='voigt', window=None,
+                    cache=None, linewidth=20., threshold=5.):
+    spin = fits.open(inspec, 'readonly')
+    specdata = spin['SCI'].data
+    newspecdata = np.array(specdata, dtype=np.float64)
+
+    features = find_features(newspecdata, linewidth, threshold)
+    for feature in features:
+        (x1, x2) = feature['section']
+        linedata = getsubspec(newspecdata, x1, x2)
+        init = initial_parameters(linedata, feature['fwhm'])
+        (fitted, lineprofile, _) = fit_feature(linedata, init, profile, cache)
+        values = [p() for p in fitted]
+        fwhm = feature_fwhm(fitted, profile)
+        if not (x1 <= values[3] < x2 and np.isfinite(fwhm)):
+            print("Fit failed for section", x1, x2, "- feature not removed.")
+            feature['fit'] = None
+            continue
+        section = profile_window(values[3], fwhm, window,
+                                 newspecdata.shape[0])
+        subtract_profile(newspecdata, lineprofile, section)
+        feature['fit'] = values
+
+    write_replaced_data(spin, newspecdata, outspec)
+    spin.close()
+
+    return features
+
+def rmfeature (inspec, outspec, params=None, profile='voigt', window=None,
+               cache=None):
+    #---- plot and get data
+    #     The input stays open; the output is written from it.
+    spin = openNplot1d(inspec)
+    specdata = spin['SCI'].data
+
+    #---- Get data for section around feature
+    linedata = getsubspec(specdata)
+
+    #---- Calculate initial parameters from linedata and fit the profile
+    #     If the parameters are given, they are used as is.
+
+    if params is None:
+        linewidth = 20.   # pixels.  should find a better way.
+        init = initial_parameters(linedata, linewidth)
+    else:
+        init = params
+    (fitted, lineprofile, bestfitprofile) = \
+        fit_feature(linedata, init, profile, cache, fit=(params is None))
+    (cte, m, A, mu, fwhmL, fwhmD) = fitted
 
     #---- retrieve line profile parameters only and create a profile
-    #     with zero continuum for the entire range for the original spectrum
-    #     Then remove the feature
+    #     with zero continuum for the entire range (window=None) or
+    #     over a window of 'window' FWHM on each side of the feature.
+    #     Then remove the feature from a copy of the original spectrum.
+    #     With a window, the Lorentzian wings beyond it are left in the
+    #     spectrum: a step of the size of the profile at the window edge.
 
-    if profile=='voigt':
-        newspecdata = specdata - voigt(np.arange(0,specdata.shape[0],1))
-        bestfit = contvoigt(np.arange(0,specdata.shape[0],1))
-    elif profile=='lorentz':
-        newspecdata = specdata - lorentz(np.arange(0,specdata.shape[0],1))
-        bestfit = contlorentz(np.arange(0,specdata.shape[0],1))
+    newspecdata = np.array(specdata, dtype=np.float64)
+    section = profile_window(mu(), feature_fwhm(fitted, profile), window,
+                             specdata.shape[0])
+    subtract_profile(newspecdata, lineprofile, section)
+    bestfitx = np.arange(section[0], section[1])
+    bestfit = bestfitprofile(bestfitx)
 
     #---- display the original spectrum, the best fit and the
     #     new spectrum.  The feature should be gone
 
-    plotresult(specdata, bestfit, newspecdata)
+    plotresult(specdata, bestfit, newspecdata, bestfitx)
     print("Best Fit Parameters:")
     print(" section = ",linedata[0][0],",",linedata[0][-1]+1)
     print("     cte = ",cte())
@@ -144,19 +406,13 @@ def rmfeature (inspec, outspec, params=None, profile='voigt'):
     print("   fwhmL = ",fwhmL())
     print("   fwhmD = ",fwhmD())
 
-    try:
-        input = raw_input
-    except NameError:
-        pass
     write = input('Write corrected spectrum to '+outspec+'? (y/n): ')
 
     #---- write output spectrum
     if write=='y':
-        spout = fits.open(inspec,'readonly')  # just to create copy of HDUList
-        spout['SCI'].data = newspecdata
-        spout.writeto(outspec, output_verify='ignore')
-        #print ("Not implemented yet, but it isn't the app cool!")
+        write_replaced_data(spin, newspecdata, outspec)
     else:
         print("Too bad.")
+    spin.close()
 
 
@@ -0,0 +1,433 @@
+# telluric.py
+"""
+Telluric correction of 1-D spectra.
+
+The science spectra are divided by a transmission curve resampled to
+their wavelength grid.  The transmission comes either from an atmospheric
+model (throughput.AtmosphericTransparency) or from a telluric standard
+star from which the stellar features have been removed (eg. with
+rmfeature).  The transmission is scaled to the airmass of each science
+spectrum and shifted by the sub-pixel amount that best removes the
+telluric features.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+import hashlib
+
+from astropy import units as u
+import numpy as np
+from scipy import sparse
+
+
+def resampling_matrix(src_wlen, dst_wlen):
+    """
+    Build the sparse matrix that resamples a curve from one wavelength
+    grid to another.
+
+    Destination pixels that contain several source points get the mean of
+    those points.  This degrades a finely sampled model to the destination
+    sampling.  The other destination pixels are linearly interpolated.
+    Outside the source range, the rows are empty.
+
+    Parameters
+    ----------
+    src_wlen : ndarray
+        Source wavelength grid, in increasing order.
+    dst_wlen : ndarray
+        Destination wavelength grid, in increasing order.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Matrix of shape (dst_wlen.size, src_wlen.size).  The resampled
+        curve is matrix.dot(curve).
+    """
+    src_wlen = np.asarray(src_wlen, dtype=np.float64)
+    dst_wlen = np.asarray(dst_wlen, dtype=np.float64)
+    nsrc = src_wlen.size
+    ndst = dst_wlen.size
+
+    # Pixel edges of the destination grid, half-way between the centers.
+    edges = np.empty(ndst + 1)
+    edges[1:-1] = (dst_wlen[1:] + dst_wlen[:-1]) / 2.
+    edges[0] = dst_wlen[0] - (edges[1] - dst_wlen[0])
+    edges[-1] = dst_wlen[-1] + (dst_wlen[-1] - edges[-2])
+
+    # Averaging of the source points inside each destination pixel,
+    # where the source is sampled more finely than the destination.
+    srcbin = np.searchsorted(edges, src_wlen, side='right') - 1
+    inside = (srcbin >= 0) & (srcbin < ndst)
+    srcbin = srcbin[inside]
+    srcidx = np.flatnonzero(inside)
+    counts = np.bincount(srcbin, minlength=ndst)
+    averaged = counts[srcbin] > 1
+    avg_rows = srcbin[averaged]
+    avg_cols = srcidx[averaged]
+    avg_vals = 1. / counts[avg_rows]
+
+    # Linear interpolation for the other destination pixels.
+    interpolated = np.flatnonzero((counts < 2) &
+                                  (dst_wlen >= src_wlen[0]) &
+                                  (dst_wlen <= src_wlen[-1]))
+    left = np.clip(np.searchsorted(src_wlen, dst_wlen[interpolated],
+                                   side='right') - 1, 0, nsrc - 2)
+    frac = (dst_wlen[interpolated] - src_wlen[left]) / \
+           (src_wlen[left + 1] - src_wlen[left])
+    int_rows = np.concatenate((interpolated, interpolated))
+    int_cols = np.concatenate((left, left + 1))
+    int_vals = np.concatenate((1. - frac, frac))
+
+    rows = np.concatenate((avg_rows, int_rows))
+    cols = np.concatenate((avg_cols, int_cols))
+    vals = np.concatenate((avg_vals, int_vals))
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(ndst, nsrc))
+
+
+class TelluricCorrector(object):
+    """
+    Divide science spectra by a telluric transmission curve.
+
+    The resampling matrices from the transmission grid to a science grid,
+    one per trial shift, are cached.  All the spectra of a night that
+    share a grid reuse them.  The least recently used matrices are
+    dropped once the cache is full.
+
+    Parameters
+    ----------
+    wlen : ndarray
+        Wavelengths of the transmission curve, in increasing order.
+    transmission : ndarray
+        Transmission, 0 to 1.
+    airmass : float, optional
+        Airmass of the transmission curve.  Default = 1.
+    wunit : str or Unit, optional
+        Units of the wavelengths.  If None, the units are unknown and the
+        spectra are assumed to use the same.  Default = None
+    cachesize : int, optional
+        Number of resampling matrices to keep in memory, one per grid
+        and trial shift.  Default = 64
+
+    Attributes
+    ----------
+    wlen : ndarray
+        Wavelengths of the transmission curve.
+    transmission : ndarray
+        Transmission.
+    airmass : float
+        Airmass of the transmission curve.
+    wunit : Unit or None
+        Units of the wavelengths.
+
+    See Also
+    --------
+    TelluricCorrector.from_model : Corrector from an atmospheric model.
+    TelluricCorrector.from_standard : Corrector from a telluric standard.
+
+    Examples
+    --------
+    >>> atmos = throughput.AtmosphericTransparency('mktrans_zm_10_10.dat')
+    >>> corrector = TelluricCorrector.from_model(atmos)
+    >>> (corrected, shifts) = corrector.correct(wlen, spectra,
+    ...                                         airmass=[1.1, 1.3, 1.6])
+    """
+    def __init__(self, wlen, transmission, airmass=1., wunit=None,
+                 cachesize=64):
+        self.wlen = np.asarray(wlen, dtype=np.float64)
+        self.transmission = np.asarray(transmission, dtype=np.float64)
+        self.airmass = airmass
+        self.wunit = None if wunit is None else u.Unit(wunit)
+        # Optical depth, for the airmass scaling.  Tiny floor on the
+        # transmission to keep the logarithm finite.
+        self._tau = -np.log(np.clip(self.transmission, 1e-30, None))
+        self.cachesize = cachesize
+        self._matrices = OrderedDict()
+
+    @classmethod
+    def from_model(cls, atmos, airmass=1.):
+        """
+        Create a corrector from an atmospheric transmission model.
+
+        Parameters
+        ----------
+        atmos : AtmosphericTransparency
+            The transmission model.
+        airmass : float, optional
+            Airmass of the model.  Default = 1.
+        """
+        return cls(atmos.wlen, atmos.transmission, airmass, atmos.wunit)
+
+    @classmethod
+    def from_standard(cls, wlen, counts, airmass, order=3, niter=5,
+                      nsigma=2., wunit=None):
+        """
+        Create a corrector from a telluric standard star spectrum from
+        which the stellar features have already been removed.
+
+        The continuum of the standard is fitted with a polynomial,
+        iteratively rejecting the points below the fit (the telluric
+        features), and the transmission is the spectrum divided by
+        that continuum.
+
+        Parameters
+        ----------
+        wlen : ndarray
+            Wavelengths of the standard star spectrum.
+        counts : ndarray
+            Feature-cleaned standard star spectrum.
+        airmass : float
+            Airmass of the standard star observation.
+        order : int, optional
+            Order of the continuum polynomial.  Default = 3
+        niter : int, optional
+            Number of rejection iterations.  Default = 5
+        nsigma : float, optional
+            Rejection threshold below the fit, in standard deviations.
+            Default = 2.
+        wunit : str or Unit, optional
+            Units of the wavelengths.  Default = None, unknown.
+        """
+        wlen = np.asarray(wlen, dtype=np.float64)
+        counts = np.asarray(counts, dtype=np.float64)
+        # scale the abscissa to [-1, 1] for a well-conditioned fit
+        xnorm = (2. * wlen - wlen[0] - wlen[-1]) / (wlen[-1] - wlen[0])
+        keep = np.isfinite(counts)
+        for _ in range(niter):
+            coeffs = np.polynomial.polynomial.polyfit(xnorm[keep],
+                                                      counts[keep], order)
+            continuum = np.polynomial.polynomial.polyval(xnorm, coeffs)
+            residuals = counts - continuum
+            sigma = np.std(residuals[keep])
+            keep = np.isfinite(counts) & (residuals > -nsigma * sigma)
+        transmission = np.clip(counts / continuum, 0., None)
+        return cls(wlen, transmission, airmass, wunit)
+
+    def get_resampling_matrix(self, wlen, shift=0.):
+        """
+        Return, from the cache if possible, the matrix resampling the
+        transmission curve onto the grid 'wlen' shifted by 'shift' pixels.
+        """
+        wlen = np.ascontiguousarray(wlen, dtype=np.float64)
+        key = (hashlib.sha1(wlen.tobytes()).hexdigest(), round(shift, 6))
+        if key in self._matrices:
+            matrix = self._matrices.pop(key)
+        else:
+            shifted = wlen - shift * np.gradient(wlen)
+            matrix = resampling_matrix(self.wlen, shifted)
+        self._matrices[key] = matrix
+        while len(self._matrices) > self.cachesize:
+            self._matrices.popitem(last=False)
+        return matrix
+
+    def get_transmission(self, wlen, airmass=None, shift=0.):
+        """
+        Return the transmission on the grid 'wlen' for one or several
+        airmasses.
+
+        Parameters
+        ----------
+        wlen : ndarray
+            Wavelength grid.
+        airmass : float or ndarray, optional
+            Airmass(es).  Default is the airmass of the curve.
+        shift : float, optional
+            Shift, in pixels of the grid, applied to the curve.
+
+        Returns
+        -------
+        ndarray
+            Shape (npix,) for a single airmass, else (nairmass, npix).
+        """
+        if airmass is None:
+            airmass = self.airmass
+        scale = np.atleast_1d(np.asarray(airmass, dtype=np.float64)) / \
+                self.airmass
+        # Beer-Lambert: the optical depth scales with the airmass.
+        scaled = np.exp(-np.outer(self._tau, scale))
+        transmission = self.get_resampling_matrix(wlen, shift).dot(scaled).T
+        if np.ndim(airmass) == 0:
+            return transmission[0]
+        return transmission
+
+    def correct(self, wlen, spectra, airmass=None, shifts=None,
+                threshold=0.05, wunit=None):
+        """
+        Correct a batch of spectra sharing the same wavelength grid.
+
+        For each spectrum, the transmission is scaled to the airmass of
+        the spectrum and every trial shift is applied.  The shift that
+        leaves the smoothest corrected spectrum (smallest sum of squared
+        second differences) is selected.  All the spectra and all the
+        shifts are processed together.
+
+        Parameters
+        ----------
+        wlen : ndarray
+            Wavelength grid shared by the spectra.
+        spectra : ndarray
+            A spectrum or a 2-D stack of spectra, one per row.
+        airmass : float or ndarray, optional
+            Airmass of each spectrum.  Default is the airmass of the curve.
+        shifts : ndarray, optional
+            Trial shifts, in pixels.  Default: -1 to 1 by 0.1 pixel.
+        threshold : float, optional
+            Pixels where the transmission is below threshold cannot be
+            corrected and are set to NaN.  Default = 0.05
+        wunit : str or Unit, optional
+            Units of 'wlen'.  The grid is converted to the units of the
+            transmission curve.  If either is unknown, they are assumed
+            to be the same.  Default = None
+
+        Returns
+        -------
+        tuple of ndarray
+            The corrected spectra, same shape as 'spectra', and the shift
+            applied to each spectrum.
+
+        Raises
+        ------
+        astropy.units.UnitConversionError
+            'wunit' is not a unit of length.
+        ValueError
+            The grid does not overlap the transmission curve, eg. because
+            the units differ.
+        """
+        wlen = self._convert_wlen(wlen, wunit)
+        spectra = np.asarray(spectra, dtype=np.float64)
+        single = spectra.ndim == 1
+        spectra = np.atleast_2d(spectra)
+        nspec = spectra.shape[0]
+        if airmass is None:
+            airmass = self.airmass
+        airmass = np.broadcast_to(np.asarray(airmass, dtype=np.float64),
+                                  (nspec,))
+        if shifts is None:
+            shifts = np.linspace(-1., 1., 21)
+        shifts = np.atleast_1d(np.asarray(shifts, dtype=np.float64))
+
+        # (nshift, nspec, npix)
+        transmission = np.array([self.get_transmission(wlen, airmass, shift)
+                                 for shift in shifts])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corrected = spectra[np.newaxis, :, :] / transmission
+            valid = transmission >= threshold
+            scale = np.nanmedian(np.abs(np.where(valid, corrected, np.nan)),
+                                 axis=2)
+            curvature = np.diff(corrected, n=2, axis=2) / \
+                        scale[:, :, np.newaxis]
+        curvature[~(valid[:, :, 2:] & valid[:, :, 1:-1] & valid[:, :, :-2])] \
+            = 0.
+        curvature[~np.isfinite(curvature)] = 0.
+        roughness = np.sum(curvature**2, axis=2)     # (nshift, nspec)
+
+        best = np.argmin(roughness, axis=0)
+        index = np.arange(nspec)
+        result = corrected[best, index]
+        result[~valid[best, index]] = np.nan
+
+        if single:
+            return (result[0], shifts[best][0])
+        return (result, shifts[best])
+
+    def _convert_wlen(self, wlen, wunit):
+        """
+        The grid 'wlen' in the units of the transmission curve.  Without
+        any overlap, every pixel would silently be NaN: raise instead.
+        """
+        wlen = np.asarray(wlen, dtype=np.float64)
+        if wunit is not None and self.wunit is not None:
+            wlen = (wlen * u.Unit(wunit)).to(self.wunit).value
+        if wlen.max() < self.wlen[0] or wlen.min() > self.wlen[-1]:
+            raise ValueError('The wavelengths, %g to %g %s, do not overlap '
+                             'the transmission curve, %g to %g %s' %
+                             (wlen.min(), wlen.max(),
+                              wunit if self.wunit is None else self.wunit,
+                              self.wlen[0], self.wlen[-1],
+                              self.wunit or ''))
+        return wlen
+
+
+def correct_files(corrector, infiles, outfiles, extname='SCI',
+                  airmass_keyword='AIRMASS', **kwargs):
+    """
+    Telluric-correct a list of FITS spectra, eg. all the science spectra
+    of a night.
+
+    The spectra are grouped by wavelength grid and each group is corrected
+    in one call to TelluricCorrector.correct, sharing the resampling
+    matrices.  The airmass is read from the primary header.  The units of
+    the wavelengths are read from CUNIT1, or from the IRAF WAT1_001
+    keyword, and converted to those of the corrector.
+
+    Parameters
+    ----------
+    corrector : TelluricCorrector
+        The corrector.
+    infiles : list of str
+        Input FITS files.
+    outfiles : list of str
+        Output FITS files, one per input.
+    extname : str, optional
+        Extension with the spectrum.  Default = 'SCI'
+    airmass_keyword : str, optional
+        Primary header keyword with the airmass.  Default = 'AIRMASS'
+    kwargs
+        Passed to TelluricCorrector.correct.
+
+    Returns
+    -------
+    dict
+        The shift applied to each input file.
+    """
+    from astropy.io import fits
+    from astropy import wcs
+
+    groups = {}
+    for (infile, outfile) in zip(infiles, outfiles):
+        with fits.open(infile) as hdulist:
+            hdu = hdulist[extname]
+            pix = np.arange(hdu.data.shape[0])
+            spwcs = wcs.WCS(hdu.header, naxis=1)
+            wlen = spwcs.wcs_pix2world(pix, 0)[0]
+            wunit = _get_wunit(hdu.header, spwcs)
+            airmass = hdulist[0].header[airmass_keyword]
+            key = (hashlib.sha1(wlen.tobytes()).hexdigest(), str(wunit))
+            group = groups.setdefault(key, {'wlen': wlen, 'wunit': wunit,
+                                            'files': [], 'spectra': [],
+                                            'airmass': []})
+            group['files'].append((infile, outfile))
+            # a copy: the data may be memory-mapped from the closed file
+            group['spectra'].append(np.array(hdu.data, dtype=float))
+            group['airmass'].append(airmass)
+
+    applied_shifts = {}
+    for group in groups.values():
+        (corrected, shifts) = corrector.correct(group['wlen'],
+                                                np.array(group['spectra']),
+                                                group['airmass'],
+                                                wunit=group['wunit'], **kwargs)
+        for (i, (infile, outfile)) in enumerate(group['files']):
+            with fits.open(infile) as hdulist:
+                hdulist[extname].data = corrected[i]
+                hdulist.writeto(outfile, output_verify='ignore')
+            applied_shifts[infile] = shifts[i]
+
+    return applied_shifts
+
+
+def _get_wunit(header, spwcs):
+    """
+    Units of the world coordinates of a 1-D WCS, None if unknown.
+    astropy converts some spectral axes, eg. WAVE, to SI units, so the
+    units are taken from the WCS when CUNIT1 is set.
+    """
+    if 'CUNIT1' in header:
+        return u.Unit(spwcs.wcs.cunit[0])
+    # IRAF: WAT1_001 = 'wtype=linear label=Wavelength units=angstroms'
+    for item in str(header.get('WAT1_001', '')).split():
+        if item.startswith('units='):
+            unit_str = item.split('=')[1]
+            if unit_str.endswith('s'):
+                unit_str = unit_str[:-1]
+            return u.Unit(unit_str)
+    return None
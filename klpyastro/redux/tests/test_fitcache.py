@@ -0,0 +1,75 @@
+from klpyastro.redux.fitcache import FitCache
+from nose.tools import assert_equal
+from nose.tools import assert_not_equal
+from nose.tools import assert_is_none
+from numpy.testing import assert_array_equal
+import numpy as np
+import shutil
+import tempfile
+
+
+class TestFitCache:
+
+    @classmethod
+    def setup_class(cls):
+        TestFitCache.cachedir = tempfile.mkdtemp()
+        TestFitCache.linedata = np.array([np.arange(10.), np.ones(10)])
+        TestFitCache.params = [1., 0.1, -4.5, 201.2, 2.8, 3.1]
+        TestFitCache.covar = np.eye(6)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestFitCache.cachedir)
+
+    def test_make_key1(self):
+        # same inputs, same key
+        key1 = FitCache.make_key(TestFitCache.linedata, 'voigt', [1., 2.])
+        key2 = FitCache.make_key(TestFitCache.linedata.copy(), 'voigt',
+                                 [1., 2.])
+        assert_equal(key1, key2)
+
+    def test_make_key2(self):
+        # different data, different key
+        key1 = FitCache.make_key(TestFitCache.linedata, 'voigt', [1., 2.])
+        key2 = FitCache.make_key(TestFitCache.linedata * 2., 'voigt',
+                                 [1., 2.])
+        assert_not_equal(key1, key2)
+
+    def test_make_key3(self):
+        # different profile, different key
+        key1 = FitCache.make_key(TestFitCache.linedata, 'voigt', [1., 2.])
+        key2 = FitCache.make_key(TestFitCache.linedata, 'lorentz', [1., 2.])
+        assert_not_equal(key1, key2)
+
+    def test_put_get(self):
+        cache = FitCache(TestFitCache.cachedir)
+        key = FitCache.make_key(TestFitCache.linedata, 'voigt', 'put_get')
+        cache.put(key, TestFitCache.params, TestFitCache.covar)
+        (params, covar) = FitCache(TestFitCache.cachedir).get(key)
+        assert_array_equal(params, TestFitCache.params)
+        assert_array_equal(covar, TestFitCache.covar)
+
+    def test_put_get_nocovar(self):
+        cache = FitCache(TestFitCache.cachedir)
+        key = FitCache.make_key(TestFitCache.linedata, 'voigt', 'nocovar')
+        cache.put(key, TestFitCache.params)
+        (params, covar) = cache.get(key)
+        assert_array_equal(params, TestFitCache.params)
+        assert_is_none(covar)
+
+    def test_get_missing(self):
+        cache = FitCache(TestFitCache.cachedir)
+        assert_is_none(cache.get(FitCache.make_key('not in cache')))
+
+    def test_get_truncated(self):
+        # a file left partial by an interrupted writer is a cache miss
+        cache = FitCache(TestFitCache.cachedir)
+        key = FitCache.make_key(TestFitCache.linedata, 'voigt', 'truncated')
+        cache.put(key, TestFitCache.params, TestFitCache.covar)
+        filename = cache._get_filename(key)
+        with open(filename, 'rb') as npzfile:
+            content = npzfile.read()
+        for size in (0, 10, len(content) // 2):
+            with open(filename, 'wb') as npzfile:
+                npzfile.write(content[:size])
+            assert_is_none(cache.get(key))
@@ -0,0 +1,189 @@
+from klpyastro.redux import spec1d
+from klpyastro.redux.fitcache import FitCache
+from astropy.io import fits
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from nose.tools import assert_is_none
+from numpy.testing import assert_allclose
+from numpy.testing import assert_array_equal
+import numpy as np
+import os.path
+import shutil
+import tempfile
+import warnings
+
+
+def lorentzian(x, depth, center, fwhm):
+    return depth * (fwhm / 2.)**2 / ((x - center)**2 + (fwhm / 2.)**2)
+
+
+class TestProfileWindow:
+
+    def test_voigt_fwhm(self):
+        # pure Lorentzian and pure Gaussian limits
+        assert_allclose(spec1d.voigt_fwhm(4., 0.), 4., rtol=1e-3)
+        assert_allclose(spec1d.voigt_fwhm(0., 4.), 4.)
+        assert_equal(spec1d.voigt_fwhm(-4., 3.), spec1d.voigt_fwhm(4., 3.))
+        assert_true(spec1d.voigt_fwhm(4., 3.) > 4.)
+
+    def test_profile_window(self):
+        assert_equal(spec1d.profile_window(500., 10., 2., 1000), (480, 521))
+        assert_equal(spec1d.profile_window(500., -10., 2., 1000), (480, 521))
+        assert_equal(spec1d.profile_window(500., 10., None, 1000), (0, 1000))
+        # clipped to the spectrum
+        assert_equal(spec1d.profile_window(5., 10., 2., 1000), (0, 26))
+        assert_equal(spec1d.profile_window(995., 10., 2., 1000), (975, 1000))
+        assert_equal(spec1d.profile_window(2000., 10., 2., 1000),
+                     (1000, 1000))
+
+    def test_subtract_profile(self):
+        x = np.arange(1000.)
+
+        def profile(x):
+            return lorentzian(x, -50., 500.3, 8.)
+
+        spdata = 100. + profile(x)
+        result = spec1d.subtract_profile(spdata, profile, (0, 1000))
+        assert_true(result is spdata)
+        assert_allclose(result, 100.)
+
+    def test_windowed_subtraction(self):
+        # within the window, the same as the full subtraction; beyond
+        # it, the Lorentzian wings are left
+        x = np.arange(1000.)
+
+        def profile(x):
+            return lorentzian(x, -50., 500.3, 8.)
+
+        spectrum = 100. + profile(x)
+        full = spec1d.subtract_profile(spectrum.copy(), profile, (0, 1000))
+        window = spec1d.profile_window(500.3, 8., 10., 1000)
+        windowed = spec1d.subtract_profile(spectrum.copy(), profile, window)
+        (x1, x2) = window
+        assert_array_equal(windowed[x1:x2], full[x1:x2])
+        assert_allclose(windowed[:x1], full[:x1] + profile(x[:x1]))
+        assert_allclose(windowed[x2:], full[x2:] + profile(x[x2:]))
+        # the residual wing at the edge is 1/(1+4*10**2) of the depth
+        assert_allclose(windowed[x1 - 1] - full[x1 - 1], -50. / 401.,
+                        rtol=0.05)
+
+
+class TestFitFeature:
+
+    @classmethod
+    def setup_class(cls):
+        TestFitFeature.cachedir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestFitFeature.cachedir)
+
+    def test_cache_seed(self):
+        # a fit seeds the fits of the same data only, not of another
+        # spectrum over the same pixels
+        cache = FitCache(TestFitFeature.cachedir)
+        x = np.arange(400., 600.)
+        linedata1 = np.array([x, 100. + lorentzian(x, -30., 480., 10.)])
+        linedata2 = np.array([x, 100. + lorentzian(x, -30., 520., 10.)])
+        init = spec1d.initial_parameters(linedata1, 10.)
+        (fitted, _, _) = spec1d.fit_feature(linedata1, init, 'lorentz', cache)
+        assert_allclose(fitted[3](), 480., atol=0.01)
+        (seed, _) = cache.get(FitCache.make_key(linedata1, 'lorentz'))
+        assert_allclose(seed[3], 480., atol=0.01)
+        assert_is_none(cache.get(FitCache.make_key(linedata2, 'lorentz')))
+        # the same data from other initial parameters
+        init[3] += 5.
+        (fitted, _, _) = spec1d.fit_feature(linedata1, init, 'lorentz', cache)
+        assert_allclose(fitted[3](), 480., atol=0.01)
+
+
+class TestFindFeatures:
+
+    @classmethod
+    def setup_class(cls):
+        TestFindFeatures.tmpdir = tempfile.mkdtemp()
+        TestFindFeatures.centers = [300., 700., 1500.]
+        x = np.arange(2048.)
+        TestFindFeatures.continuum = 1000. + 0.05 * x
+        noise = np.random.RandomState(1).normal(0., 2., x.shape[0])
+        TestFindFeatures.counts = TestFindFeatures.continuum + noise
+        for center in TestFindFeatures.centers:
+            TestFindFeatures.counts += lorentzian(x, -200., center, 12.)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestFindFeatures.tmpdir)
+
+    def test_find_features(self):
+        features = spec1d.find_features(TestFindFeatures.counts,
+                                        linewidth=12.)
+        assert_equal(len(features), len(TestFindFeatures.centers))
+        for (feature, center) in zip(features, TestFindFeatures.centers):
+            (x1, x2) = feature['section']
+            assert_true(x1 < center < x2)
+            assert_allclose(feature['params'][3], center, atol=2.)
+            assert_true(feature['params'][2] < 0.)
+
+    def test_find_features_none(self):
+        assert_equal(spec1d.find_features(TestFindFeatures.continuum), [])
+
+    def test_rmfeature_auto(self):
+        inspec = os.path.join(TestFindFeatures.tmpdir, 'in.fits')
+        outspec = os.path.join(TestFindFeatures.tmpdir, 'out.fits')
+        fits.HDUList([fits.PrimaryHDU(),
+                      fits.ImageHDU(TestFindFeatures.counts.astype(np.float32),
+                                    name='SCI')]).writeto(inspec)
+        features = spec1d.rmfeature_auto(inspec, outspec, profile='lorentz',
+                                         linewidth=12.)
+        assert_equal(len(features), len(TestFindFeatures.centers))
+        for (feature, center) in zip(features, TestFindFeatures.centers):
+            assert_allclose(feature['fit'][3], center, atol=0.5)
+        result = fits.getdata(outspec, 'SCI')
+        # the features are gone, only the noise is left
+        residual = result - TestFindFeatures.continuum
+        assert_true(np.abs(residual).max() < 15.)
+        assert_allclose(np.std(residual), 2., rtol=0.2)
+
+
+class TestWriteReplacedData:
+
+    @classmethod
+    def setup_class(cls):
+        TestWriteReplacedData.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestWriteReplacedData.tmpdir)
+
+    def write_input(self, name, sci):
+        filename = os.path.join(TestWriteReplacedData.tmpdir, name)
+        fits.HDUList([fits.PrimaryHDU(), sci,
+                      fits.ImageHDU(np.ones(10), name='VAR')]).writeto(
+            filename, checksum=True)
+        return filename
+
+    def test_checksum(self):
+        inspec = self.write_input('checksum.fits',
+                                  fits.ImageHDU(np.arange(100.), name='SCI'))
+        outspec = os.path.join(TestWriteReplacedData.tmpdir,
+                               'checksum_out.fits')
+        hdulist = fits.open(inspec)
+        spec1d.write_replaced_data(hdulist, np.arange(100.) * 2., outspec)
+        hdulist.close()
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            with fits.open(outspec, checksum=True) as result:
+                assert_array_equal(result['SCI'].data, np.arange(100.) * 2.)
+                assert_array_equal(result['VAR'].data, np.ones(10))
+
+    def test_scaled_input(self):
+        # BZERO/BSCALE data cannot be memory-mapped
+        sci = fits.ImageHDU(np.arange(100, dtype=np.float32) * 0.5 + 10.,
+                            name='SCI')
+        sci.scale('int16', bscale=0.5, bzero=10.)
+        inspec = self.write_input('scaled.fits', sci)
+        outspec = os.path.join(TestWriteReplacedData.tmpdir,
+                               'scaled_out.fits')
+        assert_equal(spec1d.rmfeature_auto(inspec, outspec), [])
+        assert_allclose(fits.getdata(outspec, 'SCI'),
+                        np.arange(100) * 0.5 + 10.)
@@ -0,0 +1,184 @@
+from klpyastro.redux import telluric
+from klpyastro.utils import throughput
+from astropy.io import fits
+from astropy import units as u
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_allclose
+import numpy as np
+import os.path
+import shutil
+import tempfile
+
+
+def absorption_depth(wlen):
+    # optical depth: weak floor and a series of gaussian lines
+    centers = np.linspace(19500., 24500., 30)
+    return 0.02 + np.sum(0.3 * np.exp(-0.5 * ((wlen[:, np.newaxis] -
+                                                centers) / 10.)**2), axis=1)
+
+
+class TestResamplingMatrix:
+
+    def test_same_grid(self):
+        wlen = np.linspace(1., 2., 11)
+        matrix = telluric.resampling_matrix(wlen, wlen)
+        assert_array_almost_equal(matrix.toarray(), np.eye(11))
+
+    def test_interpolation(self):
+        # coarse source grid: linear interpolation
+        src = np.linspace(0., 10., 11)
+        dst = np.arange(2., 4., 0.25)
+        result = telluric.resampling_matrix(src, dst).dot(3. * src + 1.)
+        assert_array_almost_equal(result, 3. * dst + 1.)
+
+    def test_averaging(self):
+        # fine source grid: mean of the points inside each pixel
+        src = np.arange(0., 10., 0.25) + 0.125
+        dst = np.array([2., 3., 4.])
+        result = telluric.resampling_matrix(src, dst).dot(src)
+        assert_array_almost_equal(result, [2., 3., 4.])
+
+    def test_outside(self):
+        src = np.linspace(5., 10., 11)
+        dst = np.array([1., 6.])
+        result = telluric.resampling_matrix(src, dst).dot(np.ones(11))
+        assert_array_almost_equal(result, [0., 1.])
+
+
+class TestTelluricCorrector:
+
+    @classmethod
+    def setup_class(cls):
+        TestTelluricCorrector.model_wlen = np.linspace(19000., 25000., 30001)
+        TestTelluricCorrector.model_tau = \
+            absorption_depth(TestTelluricCorrector.model_wlen)
+        TestTelluricCorrector.wlen = np.linspace(19200., 24800., 1000)
+        TestTelluricCorrector.continuum = \
+            1000. * (1. + 0.3 * ((TestTelluricCorrector.wlen - 22000.) /
+                                 3000.)**2)
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def observe(self, airmass, shift):
+        wlen = TestTelluricCorrector.wlen
+        matrix = telluric.resampling_matrix(TestTelluricCorrector.model_wlen,
+                                            wlen - shift * np.gradient(wlen))
+        transmission = np.exp(-TestTelluricCorrector.model_tau * airmass)
+        return TestTelluricCorrector.continuum * matrix.dot(transmission)
+
+    def test_correct_model(self):
+        corrector = telluric.TelluricCorrector(
+            TestTelluricCorrector.model_wlen,
+            np.exp(-TestTelluricCorrector.model_tau), airmass=1.)
+        airmass = [1.1, 1.5, 2.]
+        spectra = np.array([self.observe(1.1, 0.), self.observe(1.5, 0.3),
+                            self.observe(2., -0.5)])
+        (corrected, shifts) = corrector.correct(TestTelluricCorrector.wlen,
+                                                spectra, airmass)
+        assert_array_almost_equal(shifts, [0., 0.3, -0.5])
+        for spectrum in corrected:
+            assert_allclose(spectrum, TestTelluricCorrector.continuum,
+                            rtol=1e-6)
+
+    def test_correct_single(self):
+        corrector = telluric.TelluricCorrector(
+            TestTelluricCorrector.model_wlen,
+            np.exp(-TestTelluricCorrector.model_tau * 1.2), airmass=1.2)
+        (corrected, shift) = corrector.correct(TestTelluricCorrector.wlen,
+                                               self.observe(1.2, 0.2))
+        assert_equal(corrected.shape, TestTelluricCorrector.wlen.shape)
+        assert_array_almost_equal(shift, 0.2)
+
+    def test_correct_standard(self):
+        corrector = telluric.TelluricCorrector.from_standard(
+            TestTelluricCorrector.wlen, self.observe(1.2, 0.), airmass=1.2)
+        spectra = np.array([self.observe(1.2, 0.3), self.observe(1.5, 0.)])
+        (corrected, shifts) = corrector.correct(TestTelluricCorrector.wlen,
+                                                spectra, [1.2, 1.5])
+        assert_array_almost_equal(shifts, [0.3, 0.])
+        # first pixel of the shifted spectrum is outside the standard
+        assert_equal(np.isnan(corrected[0, 0]), True)
+        assert_allclose(corrected[:, 1:-1],
+                        [TestTelluricCorrector.continuum[1:-1]] * 2, rtol=0.1)
+
+    def test_resampling_matrix_cached(self):
+        corrector = telluric.TelluricCorrector(
+            TestTelluricCorrector.model_wlen,
+            np.exp(-TestTelluricCorrector.model_tau))
+        matrix1 = corrector.get_resampling_matrix(TestTelluricCorrector.wlen)
+        matrix2 = corrector.get_resampling_matrix(
+            TestTelluricCorrector.wlen.copy())
+        assert_equal(matrix1 is matrix2, True)
+
+    def test_resampling_matrix_cachesize(self):
+        corrector = telluric.TelluricCorrector(
+            TestTelluricCorrector.model_wlen,
+            np.exp(-TestTelluricCorrector.model_tau), cachesize=2)
+        wlen = TestTelluricCorrector.wlen
+        matrix = corrector.get_resampling_matrix(wlen)
+        corrector.get_resampling_matrix(wlen, 0.5)
+        # the most recently used are kept
+        corrector.get_resampling_matrix(wlen)
+        corrector.get_resampling_matrix(wlen, -0.5)
+        assert_equal(len(corrector._matrices), 2)
+        assert_equal(corrector.get_resampling_matrix(wlen) is matrix, True)
+        corrector.correct(wlen, self.observe(1.2, 0.))
+        assert_equal(len(corrector._matrices), 2)
+
+    def test_units(self):
+        # model in micron, spectra in Angstrom
+        atmos = throughput.AtmosphericTransparency(
+            wunit='micron', wlen=TestTelluricCorrector.model_wlen / 1.e4,
+            transmission=np.exp(-TestTelluricCorrector.model_tau))
+        corrector = telluric.TelluricCorrector.from_model(atmos)
+        assert_equal(corrector.wunit, u.micron)
+        (corrected, shift) = corrector.correct(TestTelluricCorrector.wlen,
+                                               self.observe(1.5, 0.3), 1.5,
+                                               wunit='Angstrom')
+        assert_array_almost_equal(shift, 0.3)
+        assert_allclose(corrected, TestTelluricCorrector.continuum,
+                        rtol=1e-4)
+        # without the units, nothing overlaps: error, not NaN
+        assert_raises(ValueError, corrector.correct,
+                      TestTelluricCorrector.wlen, self.observe(1.5, 0.3))
+        assert_raises(u.UnitConversionError, corrector.correct,
+                      TestTelluricCorrector.wlen, self.observe(1.5, 0.3),
+                      wunit='s')
+
+    def test_correct_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            atmos = throughput.AtmosphericTransparency(
+                wunit='micron', wlen=TestTelluricCorrector.model_wlen / 1.e4,
+                transmission=np.exp(-TestTelluricCorrector.model_tau))
+            corrector = telluric.TelluricCorrector.from_model(atmos)
+            wlen = TestTelluricCorrector.wlen
+            infiles = []
+            outfiles = []
+            for (i, cunit) in enumerate(['Angstrom', None]):
+                sci = fits.ImageHDU(self.observe(1.2, 0.), name='SCI')
+                sci.header['CTYPE1'] = 'LINEAR'
+                sci.header['CRPIX1'] = 1.
+                sci.header['CRVAL1'] = wlen[0]
+                sci.header['CDELT1'] = wlen[1] - wlen[0]
+                if cunit is None:
+                    sci.header['WAT1_001'] = \
+                        'wtype=linear label=Wavelength units=angstroms'
+                else:
+                    sci.header['CUNIT1'] = cunit
+                primary = fits.PrimaryHDU()
+                primary.header['AIRMASS'] = 1.2
+                infiles.append(os.path.join(tmpdir, 'in%d.fits' % i))
+                outfiles.append(os.path.join(tmpdir, 'out%d.fits' % i))
+                fits.HDUList([primary, sci]).writeto(infiles[-1])
+            shifts = telluric.correct_files(corrector, infiles, outfiles)
+            for (infile, outfile) in zip(infiles, outfiles):
+                assert_array_almost_equal(shifts[infile], 0.)
+                assert_allclose(fits.getdata(outfile, 'SCI'),
+                                TestTelluricCorrector.continuum, rtol=1e-4)
+        finally:
+            shutil.rmtree(tmpdir)
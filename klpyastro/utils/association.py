@@ -0,0 +1,152 @@
+# association.py
+"""
+Association of the calibrations to the observations they apply to.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+# Columns that must match between a calibration and the observation it
+# applies to, by type of calibration.  Not a single join on band, grism,
+# exptime, LNRS and read mode for all the types: a dark is taken with
+# the blank filter, so its band and grism never match those of the
+# observations, and the flats, arcs and tellurics are taken with their
+# own exposure settings, eg. a 4 s flat for a 90 s science frame.  The
+# darks therefore must have the same exposure settings, and the flats,
+# arcs and tellurics the same configuration, listed under the same
+# science target.  The lookups use the indexes of ObsTable.DEFAULT_INDEXES.
+ASSOCIATION_KEYS = {
+    'Dark': ('exptime', 'lnrs', 'rdmode'),
+    'Flat': ('targetname', 'band', 'grism'),
+    'Arc': ('targetname', 'band', 'grism'),
+    'Telluric': ('targetname', 'band', 'grism')
+}
+
+# Types of data a calibration applies to when its applyto column is not set.
+DEFAULT_APPLYTO = {
+    'Dark': ('Science', 'Arc', 'Flat', 'Telluric'),
+    'Flat': ('Science', 'Arc', 'Telluric'),
+    'Arc': ('Science', 'Telluric'),
+    'Telluric': ('Science',)
+}
+
+
+def associate(table, keys=None):
+    """
+    Associate the calibrations of a table to the observations they apply
+    to, all in one call.
+
+    Each observation looks up its calibrations of each type in the
+    composite-key indexes of the table, see ObsTable.create_index(),
+    with ObsTable.get_selected_rows(), and keeps those whose applyto
+    column lists its type of data.  The lookup is done once per distinct
+    key: the observations sharing a key share the result.  The cost is
+    therefore proportional to the size of the table, there is no
+    comparison of every row with every other row.  Without an index on
+    the key, each distinct key scans the table.  Rows with a missing
+    value in a matching column are not associated.
+
+    :param table: The observations summary table.
+    :type table: ObsTable
+    :param keys: Columns to match for each type of calibration.
+        [Default: ASSOCIATION_KEYS]
+    :type keys: dict of tuple of str
+    :return: For each row that can receive calibrations, a dictionary
+        from the type of calibration to the array of the matching
+        calibration rows.  The array is empty when this type of
+        calibration exists for that type of data but none matches.  The
+        arrays are shared between rows and read-only.
+    :rtype: dict of dict of numpy.ndarray
+    """
+    if keys is None:
+        keys = ASSOCIATION_KEYS
+    datatypes = table.get_column('datatype')
+    applyto = table.get_column('applyto')
+
+    # The types of data that receive each type of calibration, and the
+    # types of data each calibration row applies to.
+    targets = {}
+    receivers = {}
+    for caltype in keys:
+        for row in table.get_selected_rows({'datatype': caltype}).tolist():
+            targets[row] = parse_applyto(applyto[row], caltype)
+            for datatype in targets[row]:
+                receivers.setdefault(datatype, set()).add(caltype)
+
+    associations = {}
+    for row in _get_rows_of_types(table, receivers.keys()).tolist():
+        associations[row] = {}
+    for (caltype, columns) in keys.items():
+        targettypes = [datatype for (datatype, caltypes) in receivers.items()
+                       if caltype in caltypes]
+        if not targettypes:
+            continue
+        values = [table.get_column(column) for column in columns]
+        found = {}
+        for row in _get_rows_of_types(table, targettypes).tolist():
+            key = (datatypes[row],) + tuple(value[row] for value in values)
+            if key not in found:
+                found[key] = _find_calibrations(table, caltype, columns, key,
+                                                targets)
+            associations[row][caltype] = found[key]
+
+    return associations
+
+
+def parse_applyto(applyto, datatype=None):
+    """
+    Convert the applyto column to a tuple of types of data.  Eg.
+    'Science,Arc' gives ('Science', 'Arc').  If it is not set, ie. None,
+    'None' or empty, the default for the type of calibration is used.
+
+    :param applyto: Value of the applyto column, a comma-separated string
+        or a list.
+    :type applyto: str or list of str
+    :param datatype: Type of the calibration, for the default.
+    :type datatype: str
+    :rtype: tuple of str
+    """
+    if isinstance(applyto, (list, tuple)):
+        types = tuple(applyto)
+    elif applyto is None or applyto.strip() in ('', 'None'):
+        types = ()
+    else:
+        types = tuple(item.strip() for item in applyto.split(',')
+                      if item.strip())
+    if not types:
+        types = DEFAULT_APPLYTO.get(datatype, ())
+    return types
+
+
+def _readonly_rows(rows):
+    """
+    Convert a list of row numbers to a read-only array.
+    """
+    rows = np.array(rows, dtype=np.intp)
+    rows.flags.writeable = False
+    return rows
+
+
+def _find_calibrations(table, caltype, columns, key, targets):
+    """
+    Rows of the calibrations of type 'caltype' whose columns match the
+    values of 'key', (datatype, values), and that apply to the datatype.
+    """
+    if any(value is None for value in key[1:]):
+        return _readonly_rows([])
+    criteria = dict(zip(columns, key[1:]))
+    criteria['datatype'] = caltype
+    return _readonly_rows([row for row
+                           in table.get_selected_rows(criteria).tolist()
+                           if key[0] in targets[row]])
+
+
+def _get_rows_of_types(table, datatypes):
+    """
+    Rows whose datatype is one of 'datatypes', tested once per category.
+    """
+    datatypes = set(datatypes)
+    lookup = np.array([category in datatypes for category
+                       in table.get_categories('datatype')] + [False],
+                      dtype=bool)
+    return np.flatnonzero(lookup[table.data['datatype']])
@@ -4,11 +4,18 @@ Bookkeeping functions to help reduce F2 data.
 """
 
 
-def mkdirectories(program, targetname, obsdate, reduxdate, bands):
+def mkdirectories(program, targetname, obsdate, reduxdate, bands,
+                  rootdir=None):
     """
     Create the directory structure organizing the reduction of data.
     Can process only one target and obsdate/reduxdate combination
-    at a time.  Multiple bands is okay.
+    at a time.  Multiple bands is okay.  Use mkdirectories_batch() for
+    several targets or dates.
+
+    The paths are built from 'rootdir' and the working directory is
+    never changed, so that several structures can be created at the
+    same time from different threads.  The directories that already
+    exist are left untouched.
 
     :param program: Program name, eg. GS-2013B-Q-73
     :type program: str
@@ -21,56 +28,132 @@ def mkdirectories(program, targetname, obsdate, reduxdate, bands):
     :param bands: List of bands for which data was taken that night.
         Each band will be given its own directory. Eg. ['JH', 'HK']
     :type bands: list of str
+    :param rootdir: Directory in which the program directory is
+        created.  [Default: None, the current directory]
+    :type rootdir: str
+    :return: The directories and files that were created.
+    :rtype: list of str
     """
 
     import os.path
 
-    rootdir = os.getcwd()
+    if rootdir is None:
+        rootdir = os.getcwd()
+    programdir = os.path.join(os.path.abspath(rootdir), program)
+    targetdir = os.path.join(programdir, targetname)
+    datedir = os.path.join(targetdir, '-'.join([obsdate, reduxdate]))
+
+    # Program # directory, raw directory, target directory,
+    # sciproducts directory, date directory, redux directories
+    paths = [programdir,
+             os.path.join(programdir, 'raw'),
+             targetdir,
+             os.path.join(targetdir, 'sciproducts'),
+             datedir]
+    paths.extend(os.path.join(datedir, ''.join(['redux', band]))
+                 for band in bands)
+    created = [path for path in paths if _makedirs(path)]
 
-    # Program # directory
-    if not os.path.exists(program):
-        os.makedirs(program)
+    # README file
+    readme = os.path.join(datedir, 'README')
+    if write_readme_template(readme):
+        created.append(readme)
 
-    # -----
-    os.chdir(program)
+    # Possibly create and add the redux scripts once the tool
+    # has been created.
 
-    # Raw directory
-    if not os.path.exists('raw'):
-        os.makedirs('raw')
-    # Target directory
-    if not os.path.exists(targetname):
-        os.makedirs(targetname)
+    return created
 
-    # -----
-    os.chdir(targetname)
 
-    # sciproducts directory
-    if not os.path.exists('sciproducts'):
-        os.makedirs('sciproducts')
-    # date directory
-    datedir = '-'.join([obsdate, reduxdate])
-    if not os.path.exists(datedir):
-        os.makedirs(datedir)
+def mkdirectories_batch(manifest, rootdir=None, nthreads=None):
+    """
+    Create the directory structures of many reductions at once, in a
+    pool of threads.  The entries can share a program or a target.
+
+    :param manifest: The structures to create, as tuples of the
+        arguments of mkdirectories(): (program, targetname, obsdate,
+        reduxdate, bands).  See read_manifest().
+    :type manifest: list of tuple
+    :param rootdir: Directory in which the program directories are
+        created.  [Default: None, the current directory]
+    :type rootdir: str
+    :param nthreads: Number of threads.  [Default: None, one per CPU]
+    :type nthreads: int
+    :return: The directories and files that were created, sorted.
+    :rtype: list of str
+    """
+    from multiprocessing.pool import ThreadPool
+    import os
 
-    # -----
-    os.chdir(datedir)
+    if rootdir is None:
+        rootdir = os.getcwd()
 
-    # redux directories
-    for band in bands:
-        reduxdir = ''.join(['redux', band])
-        if not os.path.exists(reduxdir):
-            os.makedirs(reduxdir)
+    def create(entry):
+        (program, targetname, obsdate, reduxdate, bands) = entry
+        return mkdirectories(program, targetname, obsdate, reduxdate,
+                             bands, rootdir=rootdir)
 
-    # README file
-    if not os.path.exists('README'):
-        write_readme_template()
+    pool = ThreadPool(nthreads)
+    try:
+        results = pool.map(create, manifest)
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(path for created in results for path in created)
 
-    # Possibly create and add the redux scripts once the tool
-    # has been created.
 
-    os.chdir(rootdir)
+def read_manifest(filename):
+    """
+    Read a manifest of directory structures for mkdirectories_batch().
+    Each line gives the program, the target name, the observation
+    date, the reduction date and the bands, separated by spaces, eg.
+
+        GS-2013B-Q-73 SDSSJ022721.25-010445.8 20131002 15Oct2013 JH HK
 
-    return
+    Empty lines and lines starting with # are ignored.
+
+    :param filename: Name of the manifest file.
+    :type filename: str
+    :rtype: list of tuple
+    :raises ValueError: If a line does not have at least one band.
+    """
+    manifest = []
+    with open(filename) as manifest_file:
+        for (number, line) in enumerate(manifest_file, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) < 5:
+                raise ValueError('%s, line %d: expected program, target, '
+                                 'obsdate, reduxdate and bands' %
+                                 (filename, number))
+            manifest.append(tuple(fields[:4]) + (fields[4:],))
+    return manifest
+
+
+def _makedirs(path):
+    """
+    Create a directory and its parents, unless it already exists.
+    Safe when other threads create the same directories.
+
+    :return: True if the directory was created.
+    :rtype: bool
+    """
+    import errno
+    import os
+
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+        if os.path.isdir(path):
+            return False
+        if os.path.exists(path):
+            raise
+        # only a parent was created by another thread in the meantime
+        return _makedirs(path)
+    return True
 
 
 def mktable_helper(tablename, auto=True, rawdir="./"):
@@ -79,7 +162,8 @@ def mktable_helper(tablename, auto=True, rawdir="./"):
     This function is interactive and requires input from the users.
 
     :param tablename: Filename for the table.  If it exists it will
-        be extended.
+        be extended.  A name ending with .db, .sqlite or .sqlite3 is
+        an SQLite table, see obsdb.
     :type tablename: str
     :param auto: If True, get some of the information directly from
         the FITS headers.  [Default: True]
@@ -88,26 +172,22 @@ def mktable_helper(tablename, auto=True, rawdir="./"):
         [Default: "./"]
     :type rawdir: str
     """
-    from klpyastro.utils import obstable
+    from klpyastro.utils import descriptors
+    from klpyastro.utils import obsdb
     import os.path
-    # TODO: change to new astrodata when ready
-    if auto:
-        from astrodata import AstroData
 
-    # Create an ObsTable.  If the file already exists on disk,
-    # then read it.  Otherwise, leave it empty.
+    # Create an ObsTable, stored in SQLite if the extension of the file
+    # is one of obsdb.DATABASE_EXTENSIONS.  If the file already exists
+    # on disk, then read it.  Otherwise, leave it empty.
     # Error handling: If the file exists but there's an read error,
     # raise, otherwise assume that you are creating a new file.
-    table = obstable.ObsTable()
-    table.filename = tablename
     try:
-        table.read_table()
+        table = obsdb.open_table(tablename)
     except IOError:
-        if os.path.exists(tablename):
-            print("Error reading table %s\n" % tablename)
-            raise
-        else:
-            print("New table will be created.")
+        print("Error reading table %s\n" % tablename)
+        raise
+    if not os.path.exists(tablename):
+        print("New table will be created.")
 
     # Start the prompting the user and the data for the information
     # that needs to go in the table.
@@ -145,19 +225,20 @@ def mktable_helper(tablename, auto=True, rawdir="./"):
                 # Probe only the first file in 'filerange' since all the
                 # files in 'filerange' should be similar.
                 #
-                # Once we know the name of the first MEF file, open it
-                # and keep it open until we're done requesting inputs
-                # (instead of opening and closing it every time).
+                # Once we know the name of the first MEF file, get its
+                # descriptors.  The header is read once, on the first
+                # request, and only the requested descriptors are
+                # computed.
                 if auto and filename_not_known:
                     if 'rootname' in user_inputs and 'filerange' in user_inputs:
                         # parse filerange, build filename (with rawdir path)
                         filenumbers = parse_filerange(user_inputs['filerange'])
                         filename = "%sS%04d.fits" % \
-                                   (user_inputs['rootname'], filenumbers[0])
+                                   (user_inputs['rootname'],
+                                    filenumbers[0])
                         filename = os.path.join(rawdir, filename)
 
-                        # open ad
-                        ad = AstroData(filename)
+                        ad = descriptors.get_descriptors(filename)
                         filename_not_known = False
             else:
 
@@ -165,9 +246,6 @@ def mktable_helper(tablename, auto=True, rawdir="./"):
                 input_value = query_header(ad, input_request['id'])
                 user_inputs[input_request['id']] = input_value
 
-        if auto:
-            ad.close()
-
         # Create record
         new_record = create_record(user_inputs)
 
@@ -183,9 +261,12 @@ def mktable_helper(tablename, auto=True, rawdir="./"):
         user_not_done = ((answer == 'y') or False)
 
     # All the info is now in the ObsTable.
-    # Write the ObsTable to disk and close everything, we're done.
-    table.write_table()
-    table.pretty_table()
+    # Write the new records to disk and close everything, we're done.
+    # An existing table is only appended to.
+    if os.path.exists(tablename):
+        table.append_table()
+    else:
+        table.pretty_table()
 
     return
 
@@ -250,27 +331,23 @@ def query_header(ad, requested_input):
     string.  The requested_input strings are defined in get_req_input_list(),
     and they correspond to columns in the observation summary table.
 
-    :param ad: AstroData object that contains the header information.
-    :type ad: AstroData object
+    Only the requested descriptor is computed, and it is kept for the
+    next request, see descriptors.Descriptors.
+
+    :param ad: Descriptors of the file, or its name.
+    :type ad: descriptors.Descriptors or str
     :param requested_input: Information to retrieve from the header.  The
         valid strings correspond to the 'id' in the dictionaries returned
         by get_req_input_list().  Only the prompts with 'in_hdr'=True are
-        valid.
+        valid, and 'targetname'.
     :type requested_input: str
     :rtype: str
     """
+    from klpyastro.utils import descriptors
 
-    # warning: might not be efficient if the descriptor system is slow
-    # might have to change to if-elif sequence.  (but it's kinda cool
-    # looking this way.)
-    return {
-        'targetname' : ad.object().as_str(),
-        'band'       : ad.filter_name(pretty=True).as_str(),
-        'grism'      : ad.disperser(pretty=True).as_str(),
-        'exptime'    : ad.exposure_time().as_float(),
-        'lnrs'       : ad.phu_get_key_value('LNRS'),
-        'rdmode'     : ad.read_mode(pretty=True).as_str()
-    }[requested_input]
+    if not isinstance(ad, descriptors.Descriptors):
+        ad = descriptors.get_descriptors(ad)
+    return ad.get(requested_input)
 
 def create_record(user_inputs):
     """
@@ -305,44 +382,51 @@ def parse_filerange(filerange):
         215
         216,217
         218-221,223-225
-    and produce a list of integers corresponding to the range expressed
-    in the string.
+    and produce the set of integers corresponding to the range expressed
+    in the string.  The set is stored as ranges and behaves as a
+    sequence of the integers in increasing order, without building a
+    list: len(), indexing, 'in' and iteration are all cheap, and
+    np.asarray() expands it when needed.  Use
+    framerange.compress_frames() for the inverse.
 
     :param filerange: String representing a range of integers.
     :type filerange: str
-    :rtype: list of int
+    :rtype: framerange.FrameRange
     """
-    filenumbers = []
-    ranges = filerange.split(',')
-    for range_limits in ranges:
-        boundaries = range_limits.split('-')
-        if len(boundaries) == 1:
-            filenumbers.append(int(boundaries[0]))
-        elif len(boundaries) == 2:
-            number = int(boundaries[0])
-            while number <= int(boundaries[1]):
-                filenumbers.append(number)
-                number += 1
-        else:
-            raise RuntimeError
-
-    return filenumbers
-
-
-def write_readme_template():
+    from klpyastro.utils.framerange import FrameRange
+
+    return FrameRange.from_string(filerange)
+
+
+def write_readme_template(filename='README'):
     """
     When creating a directory structure, create also a short README
     file in which the version numbers of the DR software will be stored.
+    An existing README is never overwritten.
+
+    :param filename: Path of the README file.  [Default: 'README']
+    :type filename: str
+    :return: True if the file was created, False if it already existed.
+    :rtype: bool
     """
+    import errno
+    import os
 
-    readme_file = open('README', 'w')
+    # O_EXCL: only one of several concurrent writers creates the file.
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except OSError as err:
+        if err.errno == errno.EEXIST:
+            return False
+        raise
+    readme_file = os.fdopen(fd, 'w')
     readme_file.write("Reduced with\n")
     readme_file.write("  reduxF2LS-BELR  [hg #:sha / github sha]\n")
     readme_file.write("  gemini_iraf [version]\n")
     readme_file.write("\n")
     readme_file.write("QUICKLOOK ONLY - NOT SQ or FOR SCIENCE\n")
     readme_file.close()
-    return
+    return True
 
 
 def get_valid_extension(extension_string):
@@ -0,0 +1,247 @@
+# descriptors.py
+"""
+Lightweight descriptors of the raw data, computed from the primary
+header with astropy.io.fits, without astrodata.
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+
+from astropy.io import fits
+
+# Keywords of the primary header the descriptors are computed from.
+KEYWORDS = ('OBJECT', 'OBSTYPE', 'OBSCLASS', 'FILTER1', 'FILTER2', 'GRISM',
+            'EXPTIME', 'LNRS')
+
+# Type of data for each value of OBSTYPE.
+DATATYPES = {
+    'OBJECT': 'Science',
+    'DARK': 'Dark',
+    'FLAT': 'Flat',
+    'ARC': 'Arc'
+}
+
+# OBSCLASS of the OBJECT frames that are telluric standards, and of the
+# frames that are not part of the table, eg. acquisitions.
+TELLURIC_CLASSES = ('partnerCal', 'progCal')
+SKIPPED_CLASSES = ('acq', 'acqCal')
+
+# Number of threads reading the headers in get_batch().
+DEFAULT_NTHREADS = 8
+
+# Number of files whose descriptors are kept by get_descriptors().
+CACHE_SIZE = 1024
+
+
+def _get_component(name):
+    """
+    Name of a filter or grism without its Gemini component number,
+    eg. 'HK_G0806' gives 'HK'.
+    """
+    if name is None:
+        return None
+    return str(name).split('_')[0]
+
+
+def _targetname(header):
+    return header.get('OBJECT')
+
+
+def _band(header):
+    # The band from the two filter wheels, ignoring the open positions.
+    # DK is the dark position.
+    filters = [_get_component(header.get(keyword))
+               for keyword in ('FILTER1', 'FILTER2')]
+    filters = [name for name in filters
+               if name is not None and name.lower() != 'open']
+    if 'DK' in filters:
+        return 'dark'
+    if not filters:
+        return 'Open'
+    return '&'.join(filters)
+
+
+def _grism(header):
+    return _get_component(header.get('GRISM'))
+
+
+def _exptime(header):
+    exptime = header.get('EXPTIME')
+    return None if exptime is None else float(exptime)
+
+
+def _lnrs(header):
+    lnrs = header.get('LNRS')
+    return None if lnrs is None else int(lnrs)
+
+
+def _rdmode(header):
+    # F2 reports its read mode as the number of reads.
+    lnrs = _lnrs(header)
+    return None if lnrs is None else str(lnrs)
+
+
+def _datatype(header):
+    # None for the frames that are not part of the table.
+    datatype = DATATYPES.get(str(header.get('OBSTYPE', '')).upper())
+    obsclass = header.get('OBSCLASS')
+    if obsclass in SKIPPED_CLASSES:
+        return None
+    if datatype == 'Science' and obsclass in TELLURIC_CLASSES:
+        return 'Telluric'
+    return datatype
+
+# The descriptors, by name of the column of the table they fill.
+DESCRIPTORS = OrderedDict([
+    ('targetname', _targetname),
+    ('band', _band),
+    ('grism', _grism),
+    ('datatype', _datatype),
+    ('exptime', _exptime),
+    ('lnrs', _lnrs),
+    ('rdmode', _rdmode)
+])
+
+
+class Descriptors(object):
+    """
+    Descriptors of a raw FITS file.  The primary header is read only
+    when a descriptor is first requested, and each descriptor is
+    computed only when it is requested, then kept.
+
+    :param filename: Name of the FITS file.  [Default: None]
+    :type filename: str
+    :param header: The primary header, or a dictionary of the values of
+        KEYWORDS, eg. from hdrindex.HeaderIndex.  If None, it is read
+        from the file when needed.  [Default: None]
+    :type header: astropy.io.fits.Header or dict
+    """
+    def __init__(self, filename=None, header=None):
+        if filename is None and header is None:
+            raise ValueError('A file name or a header is required.')
+        self.filename = filename
+        self._header = header
+        self._values = {}
+
+    @property
+    def header(self):
+        """
+        The primary header, read on first access.
+
+        :rtype: astropy.io.fits.Header
+        """
+        if self._header is None:
+            self._header = fits.getheader(self.filename, 0)
+        return self._header
+
+    def get(self, name):
+        """
+        Value of a descriptor.
+
+        :param name: Name of the descriptor, one of DESCRIPTORS.
+        :type name: str
+        """
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        try:
+            descriptor = DESCRIPTORS[name]
+        except KeyError:
+            raise ValueError('Invalid descriptor: %s' % name)
+        value = descriptor(self.header)
+        self._values[name] = value
+        return value
+
+    def as_dict(self, names=None):
+        """
+        Values of several descriptors.
+
+        :param names: Names of the descriptors.  [Default: all]
+        :type names: list of str
+        :rtype: dict
+        """
+        if names is None:
+            names = DESCRIPTORS.keys()
+        return dict((name, self.get(name)) for name in names)
+
+
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def get_descriptors(filename):
+    """
+    Descriptors of a file, memoized: the same Descriptors are returned
+    as long as the file is not modified, so that its header is read and
+    each descriptor computed only once.  The CACHE_SIZE most recently
+    used files are kept.
+
+    :param filename: Name of the FITS file.
+    :type filename: str
+    :rtype: Descriptors
+    """
+    status = os.stat(filename)
+    key = (os.path.abspath(filename), status.st_size, status.st_mtime)
+    with _CACHE_LOCK:
+        descriptors = _CACHE.pop(key, None)
+        if descriptors is None:
+            descriptors = Descriptors(filename)
+        _CACHE[key] = descriptors
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return descriptors
+
+
+def clear_cache():
+    """
+    Forget the descriptors kept by get_descriptors().
+    """
+    with _CACHE_LOCK:
+        _CACHE.clear()
+    return
+
+
+def get_batch(filenames, names=None, nthreads=None, index=None):
+    """
+    Descriptors of many files at once.  The headers are read in a pool
+    of threads, or taken from a header index.  The files that cannot
+    be read are skipped with a warning.
+
+    :param filenames: Names of the FITS files.
+    :type filenames: list of str
+    :param names: Names of the descriptors.  [Default: all]
+    :type names: list of str
+    :param nthreads: Number of threads.  [Default: DEFAULT_NTHREADS]
+    :type nthreads: int
+    :param index: Index to get the headers from.  It must include
+        KEYWORDS.  [Default: None, read the files]
+    :type index: hdrindex.HeaderIndex
+    :return: The values of the descriptors of each file.
+    :rtype: dict of dict
+    """
+    if nthreads is None:
+        nthreads = DEFAULT_NTHREADS
+    if index is not None:
+        headers = index.get_headers(filenames, nthreads)
+        return dict((filename, Descriptors(filename, header).as_dict(names))
+                    for (filename, header) in headers.items())
+
+    def get_values(filename):
+        try:
+            return get_descriptors(filename).as_dict(names)
+        except (IOError, OSError) as err:
+            print('Warning: cannot read %s (%s)' % (filename, err))
+            return None
+
+    pool = ThreadPool(nthreads)
+    try:
+        values = pool.map(get_values, filenames, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return dict((filename, value) for (filename, value)
+                in zip(filenames, values) if value is not None)
@@ -182,4 +182,34 @@ def atglobparser(inputstring):
         else:
             filelist.append(element)
 
-    return filelist
\ No newline at end of file
+    return filelist
+
+
+def get_cache_dir(subdir=None):
+    """
+    Returns the path to the klpyastro cache directory, creating it if
+    needed.  The location is set by the KLPYASTRO_CACHE environment
+    variable, otherwise it defaults to ~/.klpyastro/cache.
+
+    Parameters
+    ----------
+    subdir : str, optional
+        Name of a subdirectory of the cache directory, eg. 'fits'.
+
+    Returns
+    -------
+    Path to the cache directory.
+
+    """
+    cachedir = os.environ.get('KLPYASTRO_CACHE',
+                              os.path.join(os.path.expanduser('~'),
+                                           '.klpyastro', 'cache'))
+    if subdir is not None:
+        cachedir = os.path.join(cachedir, subdir)
+    try:
+        os.makedirs(cachedir)
+    except OSError:
+        if not os.path.isdir(cachedir):
+            raise
+
+    return cachedir
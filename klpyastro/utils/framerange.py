@@ -0,0 +1,311 @@
+# framerange.py
+"""
+Sets of frame numbers stored as ranges, eg. the filerange column of
+the observations summary table: '218-221,223-225'.
+"""
+from __future__ import print_function
+
+import operator
+
+import numpy as np
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+
+class FrameRange(object):
+    """
+    Set of frame numbers, stored as sorted, disjoint and non-adjacent
+    inclusive intervals.  The frames are never expanded into a list:
+    the set operations work on the intervals with vectorized NumPy
+    operations, and iterating over the set yields the frame numbers
+    lazily.
+
+    The set is also a read-only sequence of the frame numbers in
+    increasing order.  len() is O(1), and indexing and membership
+    testing are binary searches over the intervals.  np.asarray()
+    expands the frames into an array.
+
+    :param intervals: Lower and upper frame numbers of each range,
+        limits included.  They can be unsorted and can overlap.
+        [Default: None, empty set]
+    :type intervals: list of tuple of int
+    """
+    def __init__(self, intervals=None):
+        if intervals is None or len(intervals) == 0:
+            bounds = np.empty((0, 2), dtype=np.int64)
+        else:
+            bounds = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+        self._set_bounds(*_normalize(bounds[:, 0], bounds[:, 1]))
+
+    def _set_bounds(self, lowers, uppers):
+        """
+        Set the normalized bounds of the intervals, and the number of
+        frames up to the end of each interval.
+        """
+        self.lowers = lowers
+        self.uppers = uppers
+        self._ends = np.cumsum(uppers - lowers + 1)
+        return
+
+    @classmethod
+    def from_string(cls, filerange):
+        """
+        Parse a file range string, eg. '218-221,223-225'.
+
+        :param filerange: The file range.
+        :type filerange: str
+        :rtype: FrameRange
+        :raises ValueError: If the string is not a file range.
+        """
+        intervals = []
+        for range_limits in str(filerange).split(','):
+            boundaries = range_limits.split('-')
+            if len(boundaries) == 1:
+                intervals.append((int(boundaries[0]), int(boundaries[0])))
+            elif len(boundaries) == 2:
+                intervals.append((int(boundaries[0]), int(boundaries[1])))
+            else:
+                raise ValueError('Invalid file range: %s' % filerange)
+        return cls(intervals)
+
+    @classmethod
+    def from_frames(cls, frames):
+        """
+        Set of the given frame numbers.  Consecutive numbers are merged
+        into ranges, vectorized.
+
+        :param frames: Frame numbers, in any order, duplicates allowed.
+        :type frames: array of int
+        :rtype: FrameRange
+        """
+        frames = np.asarray(frames, dtype=np.int64).ravel()
+        steps = np.diff(frames)
+        if np.any(steps < 0):
+            # frame numbers usually come sorted, sort only if needed
+            frames = np.sort(frames)
+            steps = np.diff(frames)
+        framerange = cls()
+        if frames.size > 0:
+            # a duplicate, step 0, does not break a range
+            breaks = np.flatnonzero(steps > 1)
+            framerange._set_bounds(
+                np.concatenate((frames[:1], frames[breaks + 1])),
+                np.concatenate((frames[breaks], frames[-1:])))
+        return framerange
+
+    @property
+    def intervals(self):
+        """
+        The ranges, as (lower, upper) tuples, limits included.
+
+        :rtype: list of tuple of int
+        """
+        return list(zip(self.lowers.tolist(), self.uppers.tolist()))
+
+    def __str__(self):
+        return ','.join('%d' % lower if lower == upper
+                        else '%d-%d' % (lower, upper)
+                        for (lower, upper) in self.intervals)
+
+    def __repr__(self):
+        return 'FrameRange(%r)' % str(self)
+
+    def iter_ranges(self):
+        """
+        Iterate over the intervals, as range objects of the frame
+        numbers.  Eg. '218-221,223' yields range(218, 222) and
+        range(223, 224).
+        """
+        for (lower, upper) in self.intervals:
+            yield range(lower, upper + 1)
+
+    def __iter__(self):
+        for frames in self.iter_ranges():
+            for frame in frames:
+                yield frame
+
+    def __len__(self):
+        return int(self._ends[-1]) if self._ends.size > 0 else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(len(self))
+            if step != 1:
+                return np.asarray(self)[index]
+            if start >= stop:
+                return FrameRange()
+            # the frames between the first and the last one of the slice
+            return self & FrameRange([(self[start], self[stop - 1])])
+        try:
+            position = operator.index(index)
+        except TypeError:
+            raise TypeError('FrameRange indices must be integers or '
+                            'slices, not %s' % type(index).__name__)
+        length = len(self)
+        if position < 0:
+            position += length
+        if not 0 <= position < length:
+            raise IndexError('FrameRange index out of range')
+        # the first interval that ends after the position
+        interval = np.searchsorted(self._ends, position, side='right')
+        start = self._ends[interval - 1] if interval > 0 else 0
+        return int(self.lowers[interval] + position - start)
+
+    def __contains__(self, frame):
+        try:
+            frame = operator.index(frame)
+        except TypeError:
+            return False
+        # the first interval that ends at or after the frame
+        interval = np.searchsorted(self.uppers, frame, side='left')
+        return bool(interval < self.lowers.size and
+                    self.lowers[interval] <= frame)
+
+    def __array__(self, dtype=None, copy=None):
+        # the frame number at each position: the lower bound of its
+        # interval plus its offset in the interval
+        counts = self.uppers - self.lowers + 1
+        frames = np.repeat(self.lowers - (self._ends - counts), counts) + \
+            np.arange(len(self), dtype=np.int64)
+        return frames if dtype is None else frames.astype(dtype)
+
+    def __bool__(self):
+        return self.lowers.size > 0
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if not isinstance(other, FrameRange):
+            return NotImplemented
+        return np.array_equal(self.lowers, other.lowers) and \
+            np.array_equal(self.uppers, other.uppers)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash((self.lowers.tobytes(), self.uppers.tobytes()))
+
+    def union(self, other):
+        """
+        Frames in either set.
+
+        :param other: The other set.
+        :type other: FrameRange
+        :rtype: FrameRange
+        """
+        return _from_bounds(*_normalize(
+            np.concatenate((self.lowers, other.lowers)),
+            np.concatenate((self.uppers, other.uppers))))
+
+    def intersection(self, other):
+        """
+        Frames in both sets.
+
+        :param other: The other set.
+        :type other: FrameRange
+        :rtype: FrameRange
+        """
+        return _from_bounds(*_intersect(self.lowers, self.uppers,
+                                        other.lowers, other.uppers))
+
+    def difference(self, other):
+        """
+        Frames in this set but not in the other.
+
+        :param other: The other set.
+        :type other: FrameRange
+        :rtype: FrameRange
+        """
+        if self.lowers.size == 0 or other.lowers.size == 0:
+            return _from_bounds(self.lowers, self.uppers)
+        # the gaps of the other set, over the span of this one
+        gap_lowers = np.concatenate((self.lowers[:1], other.uppers + 1))
+        gap_uppers = np.concatenate((other.lowers - 1, self.uppers[-1:]))
+        keep = gap_lowers <= gap_uppers
+        return _from_bounds(*_intersect(self.lowers, self.uppers,
+                                        gap_lowers[keep], gap_uppers[keep]))
+
+    def overlaps(self, other):
+        """
+        Whether the two sets share at least one frame.
+
+        :param other: The other set.
+        :type other: FrameRange
+        :rtype: bool
+        """
+        # the first range of the other set ending at or after each
+        # range of this one must start before this one ends
+        index = np.searchsorted(other.uppers, self.lowers)
+        inside = index < other.lowers.size
+        return bool(np.any(other.lowers[index[inside]] <=
+                           self.uppers[inside]))
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
+def compress_frames(frames):
+    """
+    Compact file range string of frame numbers, the inverse of
+    parse_filerange().  Eg. [218, 219, 220, 221, 223, 224, 225] gives
+    '218-221,223-225'.
+
+    :param frames: Frame numbers, in any order, duplicates allowed.
+    :type frames: array of int
+    :rtype: str
+    """
+    return str(FrameRange.from_frames(frames))
+
+
+def _from_bounds(lowers, uppers):
+    """
+    FrameRange from normalized bounds, without normalizing them again.
+    """
+    framerange = FrameRange()
+    framerange._set_bounds(lowers, uppers)
+    return framerange
+
+
+def _normalize(lowers, uppers):
+    """
+    Sort the intervals and merge the ones that overlap or touch.  Empty
+    intervals, lower > upper, are dropped.
+    """
+    keep = lowers <= uppers
+    lowers = lowers[keep]
+    uppers = uppers[keep]
+    if lowers.size == 0:
+        return (lowers, uppers)
+    order = np.argsort(lowers, kind='mergesort')
+    lowers = lowers[order]
+    uppers = uppers[order]
+    reach = np.maximum.accumulate(uppers)
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            lowers[1:] > reach[:-1] + 1)))
+    return (lowers[starts], np.maximum.reduceat(uppers, starts))
+
+
+def _intersect(lowers1, uppers1, lowers2, uppers2):
+    """
+    Intersection of two sets of normalized intervals.  Each interval of
+    the first set is paired with the intervals of the second set that
+    it overlaps, found by binary search.
+    """
+    first = np.searchsorted(uppers2, lowers1, side='left')
+    last = np.searchsorted(lowers2, uppers1, side='right')
+    counts = np.maximum(last - first, 0)
+    index1 = np.repeat(np.arange(lowers1.size), counts)
+    # the indices first[i], first[i] + 1, ... last[i] - 1, for each i
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    index2 = np.repeat(first, counts) + offsets
+    return (np.maximum(lowers1[index1], lowers2[index2]),
+            np.minimum(uppers1[index1], uppers2[index2]))
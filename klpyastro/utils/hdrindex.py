@@ -0,0 +1,204 @@
+# hdrindex.py
+"""
+Persistent index of the headers of FITS files, so that the tools
+reading the headers do not open the files again on every run.
+"""
+from __future__ import print_function
+
+from contextlib import closing
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+
+from astropy.io import fits
+
+# Name of the SQL table holding the headers.
+SQL_TABLE = 'headers'
+
+# Number of threads reading the headers of new or modified files.
+DEFAULT_NTHREADS = 8
+
+# Number of files whose entry is looked up or stored per SQL statement.
+BATCH_SIZE = 500
+
+
+class HeaderIndex(object):
+    """
+    Index of selected keywords of the primary header of FITS files,
+    stored in an SQLite database.
+
+    Each file is indexed by its absolute path, with its size and
+    modification time.  When headers are requested, each file is
+    checked with a stat.  Only the files that are not in the index,
+    or whose size or modification time changed, are opened and their
+    headers read, in parallel.  Re-reading the headers of a large
+    archive that did not change therefore costs one stat per file.
+
+    Indexes with different keywords can share a database: the keywords
+    read for a file are added to those already stored for it, as long
+    as the file did not change.
+
+    :param filename: Name of the database.  It is created if it does
+        not exist.
+    :type filename: str
+    :param keywords: Keywords to index.
+    :type keywords: list of str
+    """
+    def __init__(self, filename, keywords):
+        self.filename = filename
+        self.keywords = [keyword.upper() for keyword in keywords]
+        with closing(self._connect()):
+            pass
+
+    def get_headers(self, filenames, nthreads=None):
+        """
+        Values of the keywords in the primary header of the files.  The
+        new or modified files are read and the index is updated.  The
+        files that cannot be read are skipped with a warning.
+
+        :param filenames: Names of the FITS files.
+        :type filenames: list of str
+        :param nthreads: Number of threads reading the headers.
+            [Default: DEFAULT_NTHREADS]
+        :type nthreads: int
+        :return: For each file that could be read, a dictionary of
+            the keywords to their value, None if the keyword is not in
+            the header.
+        :rtype: dict of dict
+        """
+        if nthreads is None:
+            nthreads = DEFAULT_NTHREADS
+
+        signatures = {}
+        for filename in filenames:
+            try:
+                status = os.stat(filename)
+            except OSError as err:
+                print('Warning: cannot read %s (%s)' % (filename, err))
+                continue
+            signatures[filename] = (os.path.abspath(filename),
+                                    status.st_size, status.st_mtime)
+
+        headers = {}
+        outdated = []
+        with closing(self._connect()) as connection:
+            entries = self._get_entries(
+                connection, [signature[0] for signature
+                             in signatures.values()])
+            for (filename, signature) in signatures.items():
+                entry = entries.get(signature[0])
+                if entry is not None and entry[:2] == signature[1:]:
+                    header = json.loads(entry[2])
+                    if all(keyword in header for keyword in self.keywords):
+                        headers[filename] = self._select(header)
+                        continue
+                outdated.append(filename)
+
+            if outdated:
+                pool = ThreadPool(nthreads)
+                try:
+                    new_headers = pool.map(self._read_header_or_warn,
+                                           outdated, chunksize=16)
+                finally:
+                    pool.close()
+                    pool.join()
+                with connection:
+                    # the entries are read again in the transaction, so
+                    # that the keywords stored meanwhile by another index
+                    # are kept.
+                    connection.execute('BEGIN IMMEDIATE')
+                    entries = self._get_entries(
+                        connection, [signatures[filename][0]
+                                     for filename in outdated])
+                    rows = []
+                    for (filename, header) in zip(outdated, new_headers):
+                        if header is None:
+                            continue
+                        headers[filename] = header
+                        signature = signatures[filename]
+                        entry = entries.get(signature[0])
+                        if entry is not None and entry[:2] == signature[1:]:
+                            stored = json.loads(entry[2])
+                            stored.update(header)
+                            header = stored
+                        rows.append(signature +
+                                    (json.dumps(header, sort_keys=True),))
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO %s (path, size, mtime, header)'
+                        ' VALUES (?, ?, ?, ?)' % SQL_TABLE, rows)
+        return headers
+
+    def prune(self):
+        """
+        Remove from the index the files that no longer exist.
+
+        :return: Number of files removed.
+        :rtype: int
+        """
+        with closing(self._connect()) as connection:
+            paths = [row[0] for row
+                     in connection.execute('SELECT path FROM %s' % SQL_TABLE)]
+            missing = [(path,) for path in paths if not os.path.exists(path)]
+            with connection:
+                connection.executemany('DELETE FROM %s WHERE path = ?' %
+                                       SQL_TABLE, missing)
+        return len(missing)
+
+    def read_header(self, filename):
+        """
+        Read the values of the keywords from the primary header of a
+        file, without using the index.
+
+        :param filename: Name of the FITS file.
+        :type filename: str
+        :rtype: dict
+        """
+        header = fits.getheader(filename, 0)
+        return dict((keyword, _to_json(header.get(keyword)))
+                    for keyword in self.keywords)
+
+    def _select(self, header):
+        # The keywords of this index, out of a stored header.
+        return dict((keyword, header[keyword]) for keyword in self.keywords)
+
+    def _read_header_or_warn(self, filename):
+        try:
+            return self.read_header(filename)
+        except (IOError, OSError) as err:
+            print('Warning: cannot read %s (%s)' % (filename, err))
+            return None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.filename)
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS %s '
+                               '(path TEXT PRIMARY KEY, size INTEGER, '
+                               'mtime REAL, header TEXT)' % SQL_TABLE)
+        return connection
+
+    def _get_entries(self, connection, paths):
+        # The size, modification time and header of the paths in the
+        # index, BATCH_SIZE paths per query.
+        entries = {}
+        for first in range(0, len(paths), BATCH_SIZE):
+            batch = paths[first:first + BATCH_SIZE]
+            query = 'SELECT path, size, mtime, header FROM %s ' \
+                    'WHERE path IN (%s)' % (SQL_TABLE,
+                                            ', '.join(['?'] * len(batch)))
+            for row in connection.execute(query, batch):
+                entries[row[0]] = row[1:]
+        return entries
+
+
+def _to_json(value):
+    """
+    Header value that can be stored in JSON: the undefined values
+    become None and other types their string.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, fits.card.Undefined):
+        return None
+    return str(value)
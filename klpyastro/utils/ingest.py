@@ -0,0 +1,276 @@
+# ingest.py
+"""
+Build the observations summary table from the headers of the raw data,
+without prompting the user.
+"""
+from __future__ import print_function
+
+import glob
+from multiprocessing.pool import ThreadPool
+import os
+import re
+
+from klpyastro.utils import association
+from klpyastro.utils import descriptors
+from klpyastro.utils.framerange import FrameRange
+from klpyastro.utils import hdrindex
+from klpyastro.utils import obsdb
+from klpyastro.utils import obstable
+
+# Name of the raw files: rootname, 'S', frame number.  Eg. S20130719S0496.fits
+FILENAME_PATTERN = re.compile(r'^(?P<rootname>.+)S(?P<number>\d+)\.fits$')
+
+# Number of threads reading the headers.
+DEFAULT_NTHREADS = 8
+
+# Keywords of the primary header that are read.
+HEADER_KEYWORDS = descriptors.KEYWORDS
+
+# Columns whose values must be the same for frames to share a row.
+GROUP_COLUMNS = ('targetname', 'band', 'grism', 'datatype', 'exptime', 'lnrs',
+                 'rdmode')
+
+# Columns whose values must be the same for a new record to extend a row
+# of the table.  Not the targetname: that of a calibration changes when
+# a nearer science target arrives, see group_frames().
+EXTEND_COLUMNS = ('rootname', 'band', 'grism', 'datatype', 'exptime', 'lnrs',
+                  'rdmode')
+
+
+def ingest(rawdir, tablename, nthreads=None, verbose=False, index=None):
+    """
+    Add the raw data of a directory to an observations summary table,
+    in one go.  See scan_headers() and group_frames().
+
+    The records already in the table are not added again, so that a
+    directory can be ingested again as new data arrive.  A new record
+    that shares frames with rows of the table replaces them, with the
+    union of their file ranges, eg. when the frame 13 arrives, the
+    record 10-14 replaces the rows 10-12 and 14.  The table is
+    stored in SQLite or in the text format depending on its
+    extension, see obsdb.open_table().
+
+    :param rawdir: Directory with the raw FITS files.
+    :type rawdir: str
+    :param tablename: Name of the table.  It is created if it does not
+        exist.
+    :type tablename: str
+    :param nthreads: Number of threads reading the headers.
+        [Default: DEFAULT_NTHREADS]
+    :type nthreads: int
+    :param verbose: Print the progress.  [Default: False]
+    :type verbose: bool
+    :param index: Name of a header index, see hdrindex.HeaderIndex.
+        Only the files that are new or modified since the last use of
+        the index are opened.  [Default: None, read all the headers]
+    :type index: str
+    :return: Number of records added to the table, extended rows
+        included.
+    :rtype: int
+    """
+    filenames = sorted(glob.glob(os.path.join(rawdir, '*.fits')))
+    if index is not None:
+        index = hdrindex.HeaderIndex(index, HEADER_KEYWORDS)
+    frames = scan_headers(filenames, nthreads, index)
+    records = group_frames(frames)
+    if verbose:
+        print('%d frames in %d records' % (len(frames), len(records)))
+
+    table = obsdb.open_table(tablename)
+    (records, replaced) = extend_records(table, records)
+    table.remove_rows(replaced)
+    nadded = table.merge(records)
+    if os.path.exists(tablename):
+        table.append_table()
+    else:
+        table.pretty_table()
+    if verbose:
+        print('%d records added to %s' % (nadded, tablename))
+    return nadded
+
+
+def scan_headers(filenames, nthreads=None, index=None):
+    """
+    Read the information of the frames from their primary headers, with
+    a pool of threads.  See get_frame_info().  The files that cannot be
+    read or are not part of the table are skipped.
+
+    :param filenames: Names of the raw FITS files.
+    :type filenames: list of str
+    :param nthreads: Number of threads.  [Default: DEFAULT_NTHREADS]
+    :type nthreads: int
+    :param index: Index of the headers to get them from, instead of
+        opening every file.  It must include HEADER_KEYWORDS.
+        [Default: None]
+    :type index: hdrindex.HeaderIndex
+    :return: Information on each frame, in the order of 'filenames'.
+    :rtype: list of dict
+    """
+    if nthreads is None:
+        nthreads = DEFAULT_NTHREADS
+    if index is not None:
+        headers = index.get_headers(filenames, nthreads)
+        frames = [get_frame_info(filename, headers[filename])
+                  for filename in filenames if filename in headers]
+        return [frame for frame in frames if frame is not None]
+    pool = ThreadPool(nthreads)
+    try:
+        frames = pool.map(_get_frame_info_or_warn, filenames, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return [frame for frame in frames if frame is not None]
+
+
+def get_frame_info(filename, header=None):
+    """
+    Read the information on a frame needed for the table from its
+    primary header, and its rootname and frame number from its name.
+    Only the primary header is read.
+
+    :param filename: Name of the raw FITS file, eg. S20130719S0496.fits
+    :type filename: str
+    :param header: The values of HEADER_KEYWORDS, if they are already
+        known.  [Default: None, read the header]
+    :type header: dict
+    :return: The rootname, number, targetname (OBJECT), band, grism,
+        datatype, exptime, lnrs and rdmode of the frame.  None if the
+        file name does not follow FILENAME_PATTERN or if the frame is
+        not part of the table, eg. an acquisition.
+    :rtype: dict
+    """
+    match = FILENAME_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None
+    if header is None:
+        frame = descriptors.get_descriptors(filename).as_dict()
+    else:
+        frame = descriptors.Descriptors(filename, header).as_dict()
+    if frame['datatype'] is None:
+        return None
+    frame['rootname'] = match.group('rootname')
+    frame['number'] = int(match.group('number'))
+    return frame
+
+
+def group_frames(frames):
+    """
+    Group consecutive frames into the records of the table.
+
+    The frames are sorted by rootname and number.  Consecutive frames
+    with the same target, configuration and type of data form one
+    record, whose filerange is the range of their numbers.  Each
+    calibration takes the name of the nearest science target of the
+    same rootname, since the table lists the calibrations under the
+    science target they are for.  The applyto column of a calibration
+    is the default for its type of data, see
+    association.DEFAULT_APPLYTO.
+
+    :param frames: Information on the frames, as returned by
+        get_frame_info().
+    :type frames: list of dict
+    :rtype: list of ObsRecord
+    """
+    groups = []
+    previous = None
+    for frame in sorted(frames, key=lambda frame: (frame['rootname'],
+                                                   frame['number'])):
+        if previous is not None and \
+                frame['rootname'] == previous['rootname'] and \
+                frame['number'] == previous['number'] + 1 and \
+                all(frame[column] == previous[column]
+                    for column in GROUP_COLUMNS):
+            groups[-1]['last'] = frame['number']
+        else:
+            group = dict(frame)
+            group['first'] = group['last'] = frame['number']
+            groups.append(group)
+        previous = frame
+
+    science = {}
+    for group in groups:
+        if group['datatype'] == 'Science':
+            science.setdefault(group['rootname'], []).append(group)
+
+    records = []
+    for group in groups:
+        targetname = group['targetname']
+        applyto = 'None'
+        if group['datatype'] != 'Science':
+            nearest = _get_nearest(group, science.get(group['rootname'], []))
+            if nearest is not None:
+                targetname = nearest['targetname']
+            applyto = ','.join(association.DEFAULT_APPLYTO.get(
+                group['datatype'], ())) or 'None'
+        if group['first'] == group['last']:
+            filerange = '%d' % group['first']
+        else:
+            filerange = '%d-%d' % (group['first'], group['last'])
+        records.append(obstable.ObsRecord(
+            targetname=targetname, rootname=group['rootname'],
+            band=group['band'], grism=group['grism'],
+            datatype=group['datatype'], applyto=applyto,
+            filerange=filerange, exptime=group['exptime'],
+            lnrs=group['lnrs'], rdmode=group['rdmode']))
+    return records
+
+
+def extend_records(table, records):
+    """
+    Match new records with the rows of a table that hold some of their
+    frames.  The rows with the same EXTEND_COLUMNS whose filerange
+    overlaps that of a new record are replaced by the record, with the
+    union of the file ranges.  A record whose frames are all in one row
+    already is dropped, the row is kept as it is.
+
+    :param table: The table the records are added to.
+    :type table: ObsTable
+    :param records: The new records.  Their filerange is modified.
+    :type records: list of ObsRecord
+    :return: The records to add to the table, and the rows of the table
+        that they replace.
+    :rtype: tuple of (list of ObsRecord, set of int)
+    """
+    fileranges = table.get_column('filerange')
+    replaced = set()
+    extended = []
+    for record in records:
+        criteria = dict((column, getattr(record, column))
+                        for column in EXTEND_COLUMNS)
+        criteria['filerange'] = [record.filerange, 'overlap']
+        rows = table.get_selected_rows(criteria)
+        frames = FrameRange.from_string(record.filerange)
+        for row in rows:
+            frames = frames.union(FrameRange.from_string(fileranges[row]))
+        if rows.size == 1 and \
+                FrameRange.from_string(fileranges[rows[0]]) == frames:
+            continue
+        record.filerange = str(frames)
+        replaced.update(rows.tolist())
+        extended.append(record)
+    return (extended, replaced)
+
+
+def _get_frame_info_or_warn(filename):
+    # A file that cannot be read does not stop the scan.
+    try:
+        return get_frame_info(filename)
+    except (IOError, OSError) as err:
+        print('Warning: cannot read %s (%s)' % (filename, err))
+        return None
+
+
+def _get_nearest(group, candidates):
+    """
+    The candidate group whose frame numbers are the closest to those of
+    'group'.
+    """
+    nearest = None
+    nearest_distance = None
+    for candidate in candidates:
+        distance = max(0, candidate['first'] - group['last'],
+                       group['first'] - candidate['last'])
+        if nearest is None or distance < nearest_distance:
+            nearest = candidate
+            nearest_distance = distance
+    return nearest
@@ -0,0 +1,393 @@
+# obsdb.py
+"""
+SQLite storage for the observations summary table.
+"""
+from __future__ import print_function
+
+from contextlib import closing
+import os
+import sqlite3
+
+import numpy as np
+
+from klpyastro.utils import association
+from klpyastro.utils import obstable
+
+# Extensions of the table files stored in SQLite.  Any other file name
+# is a text table.
+DATABASE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Name of the SQL table holding the observations.
+SQL_TABLE = 'observations'
+
+# SQL type of each column of ObsTable.COLUMNS.
+SQL_TYPES = {
+    'exptime': 'REAL',
+    'lnrs': 'INTEGER'
+}
+
+# Columns stored as text whose values may be lists, eg. applyto.
+TEXT_COLUMNS = ('rootname', 'applyto', 'filerange')
+
+
+def _get_sql_indexes():
+    # The association lookups: the columns of each type of calibration,
+    # and datatype alone, used to find the calibrations and the
+    # observations they apply to.
+    indexes = [('datatype',)]
+    for columns in sorted(association.ASSOCIATION_KEYS.values()):
+        if columns not in indexes:
+            indexes.append(columns)
+    for columns in obstable.ObsTable.DEFAULT_INDEXES:
+        if columns not in indexes:
+            indexes.append(columns)
+    return indexes
+
+# Composite keys indexed in the database.
+SQL_INDEXES = _get_sql_indexes()
+
+
+class SQLiteObsTable(obstable.ObsTable):
+    """
+    Observations summary table stored in an SQLite database, for
+    archives too large for the text format.  Subclasses ObsTable.
+
+    In memory, the table is the same as an ObsTable: the records,
+    the selection and the indexes work the same way.  Only the storage
+    differs.  The database has one row per record, with the columns of
+    ObsRecord, and indexes on the columns used by the association of
+    the calibrations, see SQL_INDEXES.  It is opened in WAL mode, so
+    that readers are not blocked while the table is written to.  The
+    records are inserted in batches, with executemany.
+
+    Use select_records() to select rows with the database indexes
+    without loading the whole table, and import_text() and
+    export_text() to convert from and to the text format.
+
+    :param filename: File name of the database.  [Default: None]
+    :type filename: str
+    :param records: List of observation records.  [Default: None]
+    :type records: list of ObsRecord
+    :param indexes: Composite keys to index in memory, see
+        ObsTable.create_index().  [Default: ObsTable.DEFAULT_INDEXES]
+    :type indexes: list of tuple of str
+    """
+    def read_table(self, filename=None, criteria=None):
+        """
+        Read the table from the database.
+
+        :param filename: Name of the database to read.  If filename is
+            None, then the instance's filename attribute must be defined.
+        :type filename: str
+        :param criteria: If set, read only the rows that may match these
+            selection criteria, see select_records().  [Default: None]
+        :type criteria: dict
+        """
+        if filename is None and self.filename is None:
+            raise ValueError
+        elif filename is None:
+            filename = self.filename
+        if not os.path.exists(filename):
+            raise IOError('No such table: %s' % filename)
+
+        with closing(_connect(filename)) as connection:
+            self._reset()
+            for columns in _iter_column_chunks(connection, criteria,
+                                               obstable.READ_CHUNKSIZE):
+                self.add_columns_to_table(columns)
+        self._nwritten = self.length
+        self._removed = set()
+        return
+
+    def write_table(self, filename=None, clobber=True):
+        """
+        Write the table to the database, replacing its content.  The
+        rows are replaced in a single transaction, so that readers see
+        either the old or the new table, never a partial one.
+
+        :param filename: Name of the database to write to.  If filename
+            is None, then the instance's filename attribute must be set.
+        :type filename: str
+        :param clobber: Set whether the database can be overwritten or
+            not.  [Default: True]
+        :type clobber: bool
+        """
+        if filename is None and self.filename is None:
+            raise IOError
+        elif filename is None:
+            filename = self.filename
+
+        if os.path.exists(filename) and clobber==False:
+            print("Error: File exists (%s) and overwrite not allowed\n" %
+                  filename)
+            raise IOError
+        with closing(_connect(filename)) as connection:
+            with connection:
+                connection.execute('DELETE FROM %s' % SQL_TABLE)
+                _insert_rows(connection, self, 0)
+        self._nwritten = self.length
+        self._removed = set()
+        return
+
+    def append_table(self, filename=None):
+        """
+        Insert in the database the records added since the table was
+        last read or written, and delete those removed with
+        remove_rows().  Only the new and removed records are written,
+        in one transaction, so that the rows inserted meanwhile by
+        another process are kept.  There is no check for duplicated
+        records.
+
+        :param filename: Name of the database to append to.  If filename
+            is None, then the instance's filename attribute must be set.
+        :type filename: str
+        """
+        if filename is None and self.filename is None:
+            raise IOError
+        elif filename is None:
+            filename = self.filename
+
+        if not os.path.exists(filename):
+            self.write_table(filename)
+            return
+        if self._nwritten >= self.length and not self._removed:
+            return
+        with closing(_connect(filename)) as connection:
+            with connection:
+                _delete_rows(connection, self._removed)
+                _insert_rows(connection, self, self._nwritten)
+        self._nwritten = self.length
+        self._removed = set()
+        return
+
+    def pretty_table(self, filename=None):
+        """
+        The database has no layout to make pretty, it is written as
+        with write_table().  Use export_text() to get a human readable
+        table.
+
+        :param filename: Name of the database to write to.  If filename
+            is None, then the instance's filename attribute must be set.
+        :type filename: str
+        """
+        self.write_table(filename)
+        return
+
+
+def is_database(filename):
+    """
+    Whether a table file is an SQLite database, from its extension.
+
+    :param filename: Name of the table file.
+    :type filename: str
+    :rtype: bool
+    """
+    return os.path.splitext(filename)[1].lower() in DATABASE_EXTENSIONS
+
+
+def open_table(filename):
+    """
+    Get the table stored in a file, in the text format or in SQLite
+    depending on the extension, see DATABASE_EXTENSIONS.  If the file
+    exists, it is read.  Otherwise the table is empty and the file is
+    created when the table is written.
+
+    :param filename: Name of the table file.
+    :type filename: str
+    :rtype: ObsTable or SQLiteObsTable
+    """
+    if is_database(filename):
+        table = SQLiteObsTable()
+    else:
+        table = obstable.ObsTable()
+    table.filename = filename
+    if os.path.exists(filename):
+        table.read_table()
+    return table
+
+
+def select_records(filename, criteria):
+    """
+    Select records from the database without reading the whole table.
+
+    The criteria are translated to an SQL query, which uses the indexes
+    of the database.  'overlap' is not translated, it is evaluated,
+    along with the exact form of the other criteria, on the rows
+    returned by the query.
+
+    :param filename: Name of the database.
+    :type filename: str
+    :param criteria: Selection criteria, as for
+        ObsTable.select_records_from_table().
+    :type criteria: dict
+    :return: View of the selected rows.
+    :rtype: ObsTableView
+    """
+    table = SQLiteObsTable(indexes=[])
+    table.read_table(filename, criteria)
+    return table.select_records_from_table(criteria)
+
+
+def import_text(textfile, dbfile, chunksize=None):
+    """
+    Insert the records of a table in the text format, tab or pretty,
+    into a database.  The text table is read in chunks, so that
+    the memory used does not depend on its size.
+
+    :param textfile: Name of the table in the text format.
+    :type textfile: str
+    :param dbfile: Name of the database.  It is created if needed.
+    :type dbfile: str
+    :param chunksize: Number of lines read at a time.
+        [Default: obstable.READ_CHUNKSIZE]
+    :type chunksize: int
+    :return: Number of records inserted.
+    :rtype: int
+    """
+    nrecords = 0
+    with closing(_connect(dbfile)) as connection:
+        with connection:
+            for view in obstable.iter_table_chunks(textfile,
+                                                   chunksize=chunksize):
+                _insert_rows(connection, view.table, 0)
+                nrecords += len(view)
+    return nrecords
+
+
+def export_text(dbfile, textfile, pretty=True):
+    """
+    Write the records of a database to a table in the text format.  An
+    existing text table is replaced, in both formats.
+
+    :param dbfile: Name of the database.
+    :type dbfile: str
+    :param textfile: Name of the table in the text format.
+    :type textfile: str
+    :param pretty: Write the pretty format, otherwise the tab format.
+        [Default: True]
+    :type pretty: bool
+    """
+    table = SQLiteObsTable(dbfile, indexes=[])
+    # The text writers of ObsTable, on the same data.
+    if pretty:
+        # Not pretty_table(), which keeps the records of an existing
+        # file: the export replaces it, as write_table() does.
+        with obstable._locked(textfile):
+            obstable.ObsTable._pretty_table(table, textfile)
+    else:
+        obstable.ObsTable.write_table(table, textfile)
+    return
+
+
+def _connect(filename):
+    """
+    Open the database in WAL mode, creating the table and its indexes
+    if they do not exist.
+    """
+    connection = sqlite3.connect(filename)
+    connection.execute('PRAGMA journal_mode=WAL')
+    definitions = ', '.join('%s %s' % (name, SQL_TYPES.get(name, 'TEXT'))
+                            for name in obstable.ObsTable.COLUMNS)
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS %s '
+                           '(id INTEGER PRIMARY KEY, %s)' %
+                           (SQL_TABLE, definitions))
+        for columns in SQL_INDEXES:
+            connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' %
+                               (SQL_TABLE, '_'.join(columns), SQL_TABLE,
+                                ', '.join(columns)))
+    return connection
+
+
+def _insert_rows(connection, table, first):
+    """
+    Insert the rows of the table from row 'first', with one executemany.
+    """
+    columns = []
+    for name in obstable.ObsTable.COLUMNS:
+        values = table.get_column(name)[first:].tolist()
+        if name in TEXT_COLUMNS:
+            values = [None if value is None else obstable._to_text(value)
+                      for value in values]
+        columns.append(values)
+    connection.executemany('INSERT INTO %s (%s) VALUES (%s)' %
+                           (SQL_TABLE, ', '.join(obstable.ObsTable.COLUMNS),
+                            ', '.join(['?'] * len(columns))),
+                           zip(*columns))
+    return
+
+
+def _delete_rows(connection, keys):
+    """
+    Delete the rows with the given keys, as returned by
+    ObsRecord.get_key(), with one executemany.
+    """
+    conditions = ' AND '.join('%s IS ?' % name
+                              for name in obstable.ObsTable.COLUMNS)
+    parameters = []
+    for key in keys:
+        parameters.append([
+            obstable._to_text(value)
+            if name in TEXT_COLUMNS and value is not None else value
+            for (name, value) in zip(obstable.ObsTable.COLUMNS, key)])
+    connection.executemany('DELETE FROM %s WHERE %s' %
+                           (SQL_TABLE, conditions), parameters)
+    return
+
+
+def _get_where_clause(criteria):
+    """
+    Translate selection criteria into an SQL WHERE clause and its
+    parameters.  The clause selects a superset of the matching rows,
+    the criteria that cannot be translated are left out.
+    """
+    conditions = []
+    parameters = []
+    for (column, criterion) in (criteria or {}).items():
+        if isinstance(criterion, list) and len(criterion) == 2 and \
+                criterion[1] in obstable.OPERATIONS:
+            (value, operation) = criterion
+        else:
+            (value, operation) = (criterion, 'equals')
+        column = column.lower()
+        if column not in obstable.ObsTable.COLUMNS:
+            raise ValueError('Invalid column name: %s' % column)
+        if operation == 'equals':
+            if value is None:
+                conditions.append('%s IS NULL' % column)
+            else:
+                conditions.append('%s = ?' % column)
+                parameters.append(value)
+        elif operation == 'contain':
+            conditions.append('instr(%s, ?) > 0' % column)
+            parameters.append(value)
+        elif operation == 'range':
+            (lower, upper) = value
+            if lower is not None:
+                conditions.append('%s >= ?' % column)
+                parameters.append(lower)
+            if upper is not None:
+                conditions.append('%s <= ?' % column)
+                parameters.append(upper)
+    if not conditions:
+        return ('', [])
+    return (' WHERE ' + ' AND '.join(conditions), parameters)
+
+
+def _iter_column_chunks(connection, criteria, chunksize):
+    """
+    Query the rows matching the criteria, see _get_where_clause(), and
+    return them as columns, 'chunksize' rows at a time.
+    """
+    (where, parameters) = _get_where_clause(criteria)
+    cursor = connection.execute('SELECT %s FROM %s%s ORDER BY id' %
+                                (', '.join(obstable.ObsTable.COLUMNS),
+                                 SQL_TABLE, where), parameters)
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            return
+        columns = dict(zip(obstable.ObsTable.COLUMNS, zip(*rows)))
+        # NULL becomes NaN
+        columns['exptime'] = np.array(columns['exptime'], dtype=np.float64)
+        yield columns
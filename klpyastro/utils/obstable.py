@@ -4,6 +4,22 @@ Table access Classes
 """
 from __future__ import print_function
 
+from contextlib import contextmanager
+import itertools
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from klpyastro.utils.framerange import FrameRange
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
 # pylint: disable=C0301
 # Targetname rootname  band grism  datatype applyto     filerange exptime LNRS rdmode
 #SDSS..       S20130719 HK   HK     Science  None        496-499   90      6    faint
@@ -13,24 +29,59 @@ from __future__ import print_function
 #etc.
 # pylint: enable=C0301
 
-class ObsTable:
+class ObsTable(object):
     """
     Represents an observations summary table.  Create or extend
     an observations summary table.  The object can be created empty
     with the information like file name and records added later.
 
+    The table is stored by column in a NumPy structured array, see
+    ObsTable.DTYPE.  The columns with few distinct values, targetname,
+    band, grism, datatype and rdmode, are stored as int32 codes into
+    a per-column list of categories, with -1 for None.  A missing
+    exptime is NaN and a missing LNRS is -1.  Scans and filters can
+    therefore run as vectorized operations on the columns.  The
+    records attribute is an ObsRecord view of the table, built only
+    when it is requested.
+
     :param filename: File name of the table.  If the file does not
         exist, create it.  [Default: None]
     :type filename: str
     :param records: List of observation records, each containing the
         information for one line of the table.  [Default: None]
     :type records: ObsRecords
+    :param indexes: Composite keys to index, see create_index().
+        [Default: ObsTable.DEFAULT_INDEXES]
+    :type indexes: list of tuple of str
     """
+    COLUMNS = ('targetname', 'rootname', 'band', 'grism', 'datatype',
+               'applyto', 'filerange', 'exptime', 'lnrs', 'rdmode')
+    CATEGORICAL_COLUMNS = ('targetname', 'band', 'grism', 'datatype',
+                           'rdmode')
+    DTYPE = np.dtype([('targetname', np.int32),
+                      ('rootname', object),
+                      ('band', np.int32),
+                      ('grism', np.int32),
+                      ('datatype', np.int32),
+                      ('applyto', object),
+                      ('filerange', object),
+                      ('exptime', np.float64),
+                      ('lnrs', np.int64),
+                      ('rdmode', np.int32)])
+    # The keys of the calibration lookups: darks match the exposure time,
+    # LNRS and read mode, flats and arcs match the band and grism.
+    DEFAULT_INDEXES = [('exptime', 'lnrs', 'rdmode'), ('band', 'grism')]
 
-    def __init__(self, filename=None, records=None):
-        self.records = []
+    def __init__(self, filename=None, records=None, indexes=None):
+        self._indexes = {}
+        self._synced = None
+        self._removed = set()
+        self._reset()
+        if indexes is None:
+            indexes = self.DEFAULT_INDEXES
+        for columns in indexes:
+            self.create_index(columns)
         self.add_records_to_table(records)
-        self.length = len(self.records)
         self.filename = ObsTable.validate_filename(filename)
         if self.filename is not None:
             self.read_table(self.filename)
@@ -39,6 +90,39 @@ class ObsTable:
             'filerange', 'exptime', 'LNRS', 'rdmode')
         return
 
+    def __len__(self):
+        return self.length
+
+    @property
+    def data(self):
+        """
+        Structured array view of the rows of the table.  The categorical
+        columns contain the codes, see get_categories().
+
+        :rtype: numpy.ndarray
+        """
+        return self._data[:self.length]
+
+    @property
+    def records(self):
+        """
+        The rows of the table as a list of ObsRecord.  The list is built
+        on first access and kept until the table changes.  Modifying the
+        records does not modify the table.
+
+        :rtype: list of ObsRecord
+        """
+        if self._records is None:
+            columns = [self.get_column(name) for name in self.COLUMNS]
+            self._records = [ObsRecord(*values) for values in zip(*columns)]
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        self._reset()
+        self.add_records_to_table(list(records))
+        return
+
     @classmethod
     def validate_filename(cls, filename):
         """
@@ -65,31 +149,403 @@ class ObsTable:
         :type records: ObsRecord or list of ObsRecord
         """
 
-        if isinstance(records, list):
-            self.records.extend(records)
-        elif isinstance(records, ObsRecord):
-            self.records.append(records)
+        if isinstance(records, ObsRecord):
+            records = [records]
         elif records is None:
-            pass
-        else:
+            return
+        elif not isinstance(records, list):
             raise RuntimeError
-        self.length = len(self.records)
+
+        columns = {}
+        for name in self.COLUMNS:
+            columns[name] = [getattr(record, name) for record in records]
+        self.add_columns_to_table(columns)
+        return
+
+    def add_columns_to_table(self, columns):
+        """
+        Add rows to the table, given column by column.
+
+        :param columns: The values of the new rows for each column in
+            ObsTable.COLUMNS.  All the sequences have the same length.
+        :type columns: dict of sequences
+        """
+        nrows = len(columns[self.COLUMNS[0]])
+        if nrows == 0:
+            return
+        self._reserve(self.length + nrows)
+        new_rows = self._data[self.length:self.length + nrows]
+        for name in self.COLUMNS:
+            values = columns[name]
+            if name in self.CATEGORICAL_COLUMNS:
+                new_rows[name] = self._categories[name].encode(values)
+            elif isinstance(values, np.ndarray):
+                new_rows[name] = values
+            elif name == 'exptime':
+                new_rows[name] = [np.nan if value is None else float(value)
+                                  for value in values]
+            elif name == 'lnrs':
+                new_rows[name] = [-1 if value is None else int(value)
+                                  for value in values]
+            else:
+                new_rows[name] = _object_array(values)
+        for (key_columns, index) in self._indexes.items():
+            _update_index(index, new_rows, key_columns, self.length)
+        self.length += nrows
+        self._records = None
+        self._filerange_intervals = None
+        self._index_rows = {}
+        self._keys = None
+        return
+
+    def merge(self, other):
+        """
+        Add the records of another table that are not already in this
+        one.  The duplicates, within the other table as well, are found
+        by hashing the records, so that the cost is proportional to the
+        number of records, not to its square.  The hashes of this table
+        are kept until it is modified another way, so that merging the
+        tables of many nights one after the other stays linear.  The
+        records of this table are not deduplicated.
+
+        :param other: The table to merge into this one.
+        :type other: ObsTable, ObsTableView or list of ObsRecord
+        :return: Number of records added.
+        :rtype: int
+        """
+        if isinstance(other, list):
+            other = ObsTable(records=other, indexes=[])
+        keys = self._keys
+        if keys is None:
+            keys = set(_get_row_keys(self))
+        rows = []
+        for (row, key) in enumerate(_get_row_keys(other)):
+            if key not in keys:
+                keys.add(key)
+                rows.append(row)
+        if rows:
+            columns = {}
+            for name in self.COLUMNS:
+                columns[name] = other.get_column(name)[rows].tolist()
+            self.add_columns_to_table(columns)
+        self._keys = keys
+        return len(rows)
+
+    def remove_rows(self, rows):
+        """
+        Remove rows from the table.  The file on disk keeps them until
+        the table is written, with write_table(), pretty_table() or
+        append_table().  If another process wrote to the file
+        meanwhile, its records are merged then, without the removed
+        ones, see write_table().
+
+        :param rows: Indices of the rows to remove.
+        :type rows: list of int
+        """
+        rows = set(rows)
+        if not rows:
+            return
+        keys = _get_row_keys(self)
+        kept = [row for row in range(self.length) if row not in rows]
+        nwritten = len([row for row in kept if row < self._nwritten])
+        columns = dict((name, self.get_column(name)[kept].tolist())
+                       for name in self.COLUMNS)
+        self._reset()
+        self.add_columns_to_table(columns)
+        self._nwritten = nwritten
+        self._removed.update(keys[row] for row in rows)
         return
 
-#    def select_records_from_table(self, criteria):
-#        # criteria is a dictionary
-#        #   targetname: ["selection string",equals/contain]
-#        #   rootname:  ["selection string", equals/contain]
-#        #   band: ["string", equals]
-#        #   grism: ["string", equals]
-#        #   datatype: ["string", equals]
-#        #   applyto:  ["string", equals]
-#        #   exptime:  [float, equals]
-#        #   LNRS:     [integer, equals]
-#        #   rdmode:   [string, equals]
-#        #
-#        selected_records = []
-#        return selected_records
+    def get_column(self, name):
+        """
+        Values of a column, decoded: the categorical columns are returned
+        as an object array of their values, None where missing.
+
+        :param name: Name of the column, one of ObsTable.COLUMNS.
+        :type name: str
+        :rtype: numpy.ndarray
+        """
+        if name in self.CATEGORICAL_COLUMNS:
+            return self._categories[name].decode(self.data[name])
+        elif name == 'exptime':
+            exptime = self.data[name].astype(object)
+            exptime[np.isnan(self.data[name])] = None
+            return exptime
+        elif name == 'lnrs':
+            lnrs = self.data[name].astype(object)
+            lnrs[self.data[name] < 0] = None
+            return lnrs
+        return self.data[name]
+
+    def get_categories(self, name):
+        """
+        Distinct values of a categorical column.  The code stored in the
+        column is the index in this list.
+
+        :param name: Name of the column, one of ObsTable.CATEGORICAL_COLUMNS.
+        :type name: str
+        :rtype: list
+        """
+        return self._categories[name].values
+
+    @property
+    def indexes(self):
+        """
+        The composite keys that are indexed.
+
+        :rtype: list of tuple of str
+        """
+        return list(self._indexes.keys())
+
+    def create_index(self, columns):
+        """
+        Index the rows of the table on a composite key.
+
+        The index is a dictionary from the values of the columns, as
+        stored (ie. codes for the categorical columns), to the list of
+        rows with those values.  It is kept up to date as records are
+        added.  select_records_from_table() uses it automatically when
+        the criteria include 'equals' on all the columns of the key, so
+        that the rows are found without scanning the table.
+
+        :param columns: Names of the columns forming the key, eg.
+            ('exptime', 'lnrs', 'rdmode').
+        :type columns: tuple of str
+        """
+        columns = tuple(column.lower() for column in columns)
+        for column in columns:
+            if column not in self.COLUMNS:
+                raise ValueError('Invalid column name: %s' % column)
+        if columns not in self._indexes:
+            index = {}
+            _update_index(index, self.data, columns, 0)
+            self._indexes[columns] = index
+        return
+
+    def drop_index(self, columns):
+        """
+        Remove the index on a composite key.
+
+        :param columns: Names of the columns forming the key.
+        :type columns: tuple of str
+        """
+        del self._indexes[tuple(column.lower() for column in columns)]
+        self._index_rows = {}
+        return
+
+    def _reset(self):
+        self._data = np.empty(0, dtype=self.DTYPE)
+        self._categories = dict((name, _Categories())
+                                for name in self.CATEGORICAL_COLUMNS)
+        self._records = None
+        self._filerange_intervals = None
+        self._indexes = dict((columns, {}) for columns in self._indexes)
+        self._index_rows = {}
+        self._keys = None
+        self._nwritten = 0
+        self.length = 0
+        return
+
+    def _reserve(self, nrows):
+        # Grow the storage geometrically, so that adding records one at
+        # a time stays cheap.
+        if nrows <= self._data.size:
+            return
+        capacity = max(nrows, 2 * self._data.size, 16)
+        data = np.empty(capacity, dtype=self.DTYPE)
+        data[:self.length] = self._data[:self.length]
+        self._data = data
+        return
+
+    def select_records_from_table(self, criteria):
+        """
+        Select the rows matching all the criteria.
+
+        Each criterion is compiled into a boolean mask over the columns.
+        On the categorical columns, the comparison is done once per
+        category, then looked up by code, so the cost does not depend on
+        the length of the strings.
+
+        The criteria are given as a dictionary with the column names as
+        keys and [value, operation] as values.  A bare value means
+        'equals'.  The operations are:
+
+            * 'equals' : The column is equal to the value.
+            * 'contain' : The column contains the value string, eg.
+              {'applyto': ['Arc', 'contain']}.
+            * 'range' : exptime and LNRS only.  The value is a (lower,
+              upper) tuple, limits included.  None means no limit.
+            * 'overlap' : filerange only.  The file range shares at least
+              one file number with the value, eg.
+              {'filerange': ['496-499,501', 'overlap']}.
+
+        :param criteria: Selection criteria, eg.
+            {'datatype': ['Dark', 'equals'], 'exptime': 90.,
+            'lnrs': [(1, 6), 'range']}
+        :type criteria: dict
+        :return: View of the selected rows.
+        :rtype: ObsTableView
+        """
+        return ObsTableView(self, self.get_selected_rows(criteria))
+
+    def get_selection_mask(self, criteria):
+        """
+        Boolean mask of the rows matching all the criteria.  See
+        select_records_from_table() for the format of the criteria.
+
+        :param criteria: Selection criteria.
+        :type criteria: dict
+        :rtype: numpy.ndarray of bool
+        """
+        mask = np.zeros(self.length, dtype=bool)
+        mask[self.get_selected_rows(criteria)] = True
+        return mask
+
+    def get_selected_rows(self, criteria, rows=None):
+        """
+        Indices of the rows matching all the criteria.  See
+        select_records_from_table() for the format of the criteria.
+
+        If an index covers some of the 'equals' criteria, the candidate
+        rows are looked up in the index and only the other criteria are
+        evaluated, on the candidates only.
+
+        :param criteria: Selection criteria.
+        :type criteria: dict
+        :param rows: If set, select among these rows only.  They must be
+            in increasing order.
+        :type rows: numpy.ndarray of int
+        :rtype: numpy.ndarray of int
+        """
+        compiled = []
+        for (column, criterion) in criteria.items():
+            if isinstance(criterion, list) and len(criterion) == 2 and \
+                    criterion[1] in OPERATIONS:
+                (value, operation) = criterion
+            else:
+                (value, operation) = (criterion, 'equals')
+            column = column.lower()
+            if column not in self.COLUMNS:
+                raise ValueError('Invalid column name: %s' % column)
+            if operation not in SELECTION_OPERATIONS[column]:
+                raise ValueError("Invalid operation '%s' for column %s" %
+                                 (operation, column))
+            compiled.append((column, value, operation))
+
+        (indexed_rows, compiled) = self._lookup_index(compiled)
+        if indexed_rows is not None:
+            if rows is None:
+                rows = indexed_rows
+            else:
+                rows = np.intersect1d(rows, indexed_rows, assume_unique=True)
+
+        if rows is None:
+            mask = np.ones(self.length, dtype=bool)
+        else:
+            mask = np.ones(rows.size, dtype=bool)
+        for (column, value, operation) in compiled:
+            mask &= self._get_criterion_mask(column, value, operation, rows)
+        if rows is None:
+            return np.flatnonzero(mask)
+        return rows[mask]
+
+    def _lookup_index(self, compiled):
+        # Use the index covering the most 'equals' criteria.  Return the
+        # candidate rows, or None if no index applies, and the criteria
+        # left to evaluate.
+        equals = dict((column, value) for (column, value, operation)
+                      in compiled if operation == 'equals')
+        best = None
+        for columns in self._indexes:
+            if all(column in equals for column in columns) and \
+                    (best is None or len(columns) > len(best)):
+                best = columns
+        if best is None:
+            return (None, compiled)
+
+        key = []
+        for column in best:
+            value = equals[column]
+            if column in self.CATEGORICAL_COLUMNS:
+                value = self._categories[column].get_code(value)
+                if value is None:
+                    return (np.empty(0, dtype=np.intp), [])
+            elif value is None:
+                # a missing exptime or LNRS never matches
+                return (np.empty(0, dtype=np.intp), [])
+            elif column == 'exptime':
+                value = float(value)
+            elif column == 'lnrs':
+                value = int(value)
+            key.append(value)
+        key = (best, tuple(key))
+        rows = self._index_rows.get(key)
+        if rows is None:
+            rows = np.array(self._indexes[best].get(key[1], []),
+                            dtype=np.intp)
+            self._index_rows[key] = rows
+        remaining = [criterion for criterion in compiled
+                     if criterion[2] != 'equals' or criterion[0] not in best]
+        return (rows, remaining)
+
+    def _get_criterion_mask(self, column, value, operation, rows=None):
+        # Mask of the rows, or of the given rows only, matching one
+        # criterion.
+        data = self.data[column]
+        if rows is not None:
+            data = data[rows]
+
+        if column in self.CATEGORICAL_COLUMNS:
+            categories = self._categories[column]
+            if operation == 'equals':
+                code = categories.get_code(value)
+                if code is None:
+                    return np.zeros(data.size, dtype=bool)
+                return data == code
+            # one test per category, the last entry is for None (-1)
+            lookup = np.array([value in category
+                               for category in categories.values] + [False],
+                              dtype=bool)
+            return lookup[data]
+
+        if operation == 'range':
+            (lower, upper) = value
+            mask = data >= 0 if column == 'lnrs' else ~np.isnan(data)
+            if lower is not None:
+                mask &= data >= lower
+            if upper is not None:
+                mask &= data <= upper
+            return mask
+        elif operation == 'overlap':
+            (intervals_rows, lowers, uppers) = self._get_filerange_intervals()
+            overlap = np.zeros(intervals_rows.size, dtype=bool)
+            for (lower, upper) in _filerange_intervals(value):
+                overlap |= (lowers <= upper) & (uppers >= lower)
+            mask = np.zeros(self.length, dtype=bool)
+            mask[intervals_rows[overlap]] = True
+            return mask if rows is None else mask[rows]
+        elif operation == 'contain':
+            return np.array([item is not None and value in item
+                             for item in data], dtype=bool)
+        return np.asarray(data == value, dtype=bool)
+
+    def _get_filerange_intervals(self):
+        # The file ranges of all the rows parsed into intervals, as three
+        # arrays: row index, lower and upper file numbers.  Cached until
+        # the table changes.
+        if self._filerange_intervals is None:
+            rows = []
+            lowers = []
+            uppers = []
+            for (row, filerange) in enumerate(self.data['filerange']):
+                for (lower, upper) in _filerange_intervals(filerange):
+                    rows.append(row)
+                    lowers.append(lower)
+                    uppers.append(upper)
+            self._filerange_intervals = (np.array(rows, dtype=np.intp),
+                                         np.array(lowers, dtype=np.int64),
+                                         np.array(uppers, dtype=np.int64))
+        return self._filerange_intervals
 
     def print_table(self):
         """
@@ -102,7 +558,8 @@ class ObsTable:
 
     def read_table(self, filename=None):
         """
-        Read table from file on disk.
+        Read table from file on disk.  A shared lock is held on the
+        table while it is read, see write_table().
 
         :param filename: Name of the file to read.  If filename is None,
             then the instance's filename attribute must be defined.
@@ -114,31 +571,43 @@ class ObsTable:
         elif filename is None:
             filename = self.filename
 
+        with _locked(filename, shared=True):
+            self._read_table(filename)
+        self._removed = set()
+
+        return
+
+    def _read_table(self, filename):
         try:
             with open(filename, 'r') as table:
                 # reset the instance.
-                self.records = []
-                self.length = 0
-                for line in table:
-                    if line.startswith('#'):
-                        continue
-                    try:
-                        record = ObsRecord()
-                        record.read_record(line)
-                        self.add_records_to_table(record)
-                    except ValueError:
-                        #probably the title bar
-                        # (pretty format doesn't start with #)
-                        continue
+                self._reset()
+                for columns in _iter_column_chunks(table, READ_CHUNKSIZE):
+                    self.add_columns_to_table(columns)
+                signature = _get_signature(table.fileno())
         except IOError:
             raise
-        table.close()
-
+        self._nwritten = self.length
+        self._synced = (os.path.abspath(filename), signature)
         return
 
     def write_table(self, filename=None, clobber=True):
         """
-        Write table to file on disk.
+        Write table to file on disk.  The table is written to a
+        temporary file which then replaces the file, so that a reader
+        never sees an incomplete table and an interrupted write does
+        not destroy the existing table.
+
+        Several processes can update the same table.  While the table
+        is written, an exclusive advisory lock is held on a lock file,
+        the file name with '.lock' appended, which the other writers
+        and the readers of this class wait for.  If the file was
+        modified by another process since this table read or wrote it,
+        the records added by the other process are merged into this
+        table before it is written, see merge(), so that they are not
+        lost, and the rows removed with remove_rows() are left out of
+        them.  The locks are not available on systems without fcntl,
+        eg. Windows.
 
         :param filename: Name of the file to write to.  If filename is
             None, then the instance's filename attribute must be set.
@@ -148,58 +617,668 @@ class ObsTable:
         :type clobber: bool
 
         """
-        import os
-
         if filename is None and self.filename is None:
             raise IOError
         elif filename is None:
             filename = self.filename
 
-        try:
-            if os.path.exists(filename) and clobber==False:
-                print("Error: File exists (%s) and overwrite not allowed\n" %
-                      filename)
-                raise IOError
-            with open(filename, 'w') as table:
-                table.write(self.titlebar)
-                table.write("\n")
-                for record in self.records:
-                    table.write(record.print_record())
-                    table.write("\n")
-        except IOError:
-            raise
-        table.close()
+        if os.path.exists(filename) and clobber==False:
+            print("Error: File exists (%s) and overwrite not allowed\n" %
+                  filename)
+            raise IOError
+        with _locked(filename):
+            self._merge_concurrent_changes(filename)
+            self._write_table(filename)
 
         return
 
-#    def append_table(self, filename=None):
-#        # use case:  file on disk.  ObsTable contains all new records.
-#        # Append new records.
-#        # no checks whether there are duplication.  keep it simple for now.
-#        # Not sure if I really need this.  Probably easier to have the whole
-#        # table in memory in the ObsTable.  It's easy enough to merge the
-#        # records if I have two ObsTable.
-#        return
+    def _write_table(self, filename):
+        lines = [self.titlebar]
+        lines.extend(_format_tab_lines(self._format_columns()))
+        self._write_lines(filename, lines)
+        return
 
-    def pretty_table(self):
+    def append_table(self, filename=None):
+        """
+        Append to the file on disk the records added since the table was
+        last read or written.
+
+        Only the new records are formatted and written, in one write,
+        so the cost does not depend on the size of the table on disk.
+        A file in the tab format is extended with tab-separated lines.
+        A file in the pretty format is extended with lines aligned on
+        its columns, whose widths are obtained from its title line.  If
+        a new value is too wide for its column, the whole table, the
+        records on disk included, is rewritten in the pretty format
+        instead, see pretty_table().  A new file is created
+        under a temporary name and renamed once complete.
+
+        The file is locked while it is appended to, and records
+        appended by another process since this table read or wrote the
+        file are merged first, as in write_table().  The new records
+        already added to the file by another process are not appended
+        again.  If rows were removed with remove_rows(), the table is
+        rewritten in the format of the file instead.
+
+        :param filename: Name of the file to append to.  If filename is
+            None, then the instance's filename attribute must be set.
+        :type filename: str
+        """
+        if filename is None and self.filename is None:
+            raise IOError
+        elif filename is None:
+            filename = self.filename
+
+        with _locked(filename):
+            if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+                self._write_table(filename)
+                return
+            self._merge_concurrent_changes(filename)
+            with open(filename, 'r') as table:
+                titleline = table.readline()
+                table.seek(0, os.SEEK_END)
+                table.seek(table.tell() - 1)
+                ends_with_newline = table.read(1) == '\n'
+            if self._removed:
+                # the removed rows cannot be appended away: rewrite the
+                # table in its format
+                if titleline.startswith('#'):
+                    self._write_table(filename)
+                else:
+                    self._pretty_table(filename)
+                return
+            if self._nwritten >= self.length:
+                return
+
+            columns = self._format_columns(self._nwritten)
+            if titleline.startswith('#'):
+                lines = _format_tab_lines(columns)
+            else:
+                widths = _get_fixed_widths(titleline)
+                if widths is None or \
+                        any(len(value) > width for (column, width)
+                            in zip(columns, widths) for value in column):
+                    # keep the records on disk that this table did not
+                    # read, as in pretty_table()
+                    self._merge_concurrent_changes(filename, unsynced=True)
+                    self._pretty_table(filename)
+                    return
+                (_, lines) = format_fixed_width(PRETTY_TITLES, columns,
+                                                widths)
+
+            text = '\n'.join(lines) + '\n'
+            if not ends_with_newline:
+                text = '\n' + text
+            with open(filename, 'a') as table:
+                table.write(text)
+                table.flush()
+                signature = _get_signature(table.fileno())
+            self._nwritten = self.length
+            self._synced = (os.path.abspath(filename), signature)
+
+        return
+
+    def pretty_table(self, filename=None):
         """
         Rewrite the table into a pretty format to make it more human
-        readable.  The write_table routine does a good job but the
-        ascii.write() function makes it even better.  Unfortunately,
-        for ascii.write to work well, the table must be read from disk
-        by ascii.read.  This means double the i/o.  If the table were
-        big that would be a performance hit, but for now, it is not
-        a problem.
-        """
-        from astropy.io import ascii
-        table = ascii.read(self.filename)
-        ascii.write(table, output=self.filename,
-                    Writer=ascii.FixedWidth, bookend=False,
-                    delimiter=None)
+        readable.  The columns are right-justified to a common width and
+        separated by two spaces, as astropy's ascii.FixedWidth writer with
+        bookend=False and delimiter=None does.  The table is formatted
+        from memory in a single pass.  If the file was not read into or
+        written from this table, its records are read first and the
+        records of this table not in the file are added to them, so
+        that the whole table on disk is reformatted.  The file is locked
+        and concurrent changes are merged as in write_table().
+
+        :param filename: Name of the file to write to.  If filename is
+            None, then the instance's filename attribute must be set.
+        :type filename: str
+        """
+        if filename is None and self.filename is None:
+            raise IOError
+        elif filename is None:
+            filename = self.filename
+
+        with _locked(filename):
+            self._merge_concurrent_changes(filename, unsynced=True)
+            self._pretty_table(filename)
+        return
+
+    def _pretty_table(self, filename):
+        (titleline, lines) = format_fixed_width(PRETTY_TITLES,
+                                                self._format_columns())
+        self._write_lines(filename, [titleline] + lines)
+        return
+
+    def _write_lines(self, filename, lines):
+        # Replace the file and note that it is in sync with the table.
+        signature = _write_atomic(filename, lines)
+        self._nwritten = self.length
+        self._synced = (os.path.abspath(filename), signature)
+        self._removed = set()
+        return
+
+    def _merge_concurrent_changes(self, filename, unsynced=False):
+        # Optimistic concurrency: if the file is the one this table was
+        # read from or written to, and it has changed since, another
+        # process has written to it.  Reload it and add back the records
+        # of this table that were not written yet, minus the duplicates.
+        # With 'unsynced', a file this table was not read from or written
+        # to is merged too: all the records of the table are added back.
+        # The rows removed with remove_rows() are removed again from the
+        # file's records.  Must be called with the lock held.
+        if not os.path.exists(filename):
+            return
+        if self._synced is not None and \
+                self._synced[0] == os.path.abspath(filename):
+            if _get_signature(filename) == self._synced[1]:
+                return
+            first = self._nwritten
+        elif unsynced:
+            first = 0
+        else:
+            return
+        pending = ObsTable(indexes=[])
+        pending.add_columns_to_table(dict(
+            (name, self.get_column(name)[first:].tolist())
+            for name in self.COLUMNS))
+        self._read_table(filename)
+        if self._removed:
+            self.remove_rows([row for (row, key)
+                              in enumerate(_get_row_keys(self))
+                              if key in self._removed])
+        self.merge(pending)
         return
 
+    def _format_columns(self, first=0):
+        # The values of each column, from row 'first', as the strings
+        # that are written to disk.
+        data = self.data[first:]
+        columns = []
+        for name in self.COLUMNS:
+            if name in self.CATEGORICAL_COLUMNS:
+                lookup = np.array([_to_text(value) for value
+                                   in self._categories[name].values] +
+                                  ['None'], dtype=object)
+                columns.append(lookup[data[name]].tolist())
+            elif name == 'exptime':
+                columns.append(['%.1f' % value
+                                for value in data[name].tolist()])
+            elif name == 'lnrs':
+                columns.append(['%d' % value for value in data[name].tolist()])
+            else:
+                columns.append([_to_text(value) for value in data[name]])
+        return columns
+
+def iter_table_chunks(filename, criteria=None, chunksize=None):
+    """
+    Read a table from disk lazily, in chunks of rows.
+
+    The file is read one chunk of lines at a time, so the memory used
+    does not depend on the size of the table.  Both the tab format and
+    the pretty format are parsed, the title lines are skipped.  Each
+    chunk is converted to columns and, if criteria are given, filtered
+    with vectorized selection before it is handed out.
+
+    :param filename: Name of the table on disk.
+    :type filename: str
+    :param criteria: Selection criteria, as for
+        ObsTable.select_records_from_table().  [Default: None]
+    :type criteria: dict
+    :param chunksize: Number of lines of the file per chunk.
+        [Default: READ_CHUNKSIZE]
+    :type chunksize: int
+    :return: Generator of views of the selected rows of each chunk.
+        Chunks without selected rows are skipped.
+    :rtype: generator of ObsTableView
+    """
+    if chunksize is None:
+        chunksize = READ_CHUNKSIZE
+    with open(filename, 'r') as table:
+        for columns in _iter_column_chunks(table, chunksize):
+            chunk = ObsTable(indexes=[])
+            chunk.add_columns_to_table(columns)
+            if criteria:
+                rows = chunk.get_selected_rows(criteria)
+            else:
+                rows = np.arange(chunk.length)
+            if rows.size > 0:
+                yield ObsTableView(chunk, rows)
+
+
+def iter_records(filename, criteria=None, chunksize=None):
+    """
+    Read the records of a table from disk lazily.  See
+    iter_table_chunks().
+
+    :param filename: Name of the table on disk.
+    :type filename: str
+    :param criteria: Selection criteria, as for
+        ObsTable.select_records_from_table().  [Default: None]
+    :type criteria: dict
+    :param chunksize: Number of lines of the file parsed at a time.
+        [Default: READ_CHUNKSIZE]
+    :type chunksize: int
+    :return: Generator of the selected records.
+    :rtype: generator of ObsRecord
+    """
+    for view in iter_table_chunks(filename, criteria, chunksize):
+        for record in view.records:
+            yield record
+
+
+class ObsTableView(object):
+    """
+    Selection of rows of an ObsTable, as returned by
+    ObsTable.select_records_from_table().  The view stores only the row
+    indices.  The data stays in the table.
+
+    :param table: The table the rows belong to.
+    :type table: ObsTable
+    :param rows: Indices of the selected rows.
+    :type rows: numpy.ndarray of int
+    """
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows.size
+
+    @property
+    def length(self):
+        """
+        Number of selected rows.
+        """
+        return self.rows.size
+
+    @property
+    def data(self):
+        """
+        Structured array of the selected rows.
+
+        :rtype: numpy.ndarray
+        """
+        return self.table.data[self.rows]
+
+    @property
+    def records(self):
+        """
+        The selected rows as a list of ObsRecord.
+
+        :rtype: list of ObsRecord
+        """
+        columns = [self.get_column(name) for name in ObsTable.COLUMNS]
+        return [ObsRecord(*values) for values in zip(*columns)]
+
+    def get_column(self, name):
+        """
+        Decoded values of a column for the selected rows.  See
+        ObsTable.get_column().
+
+        :param name: Name of the column, one of ObsTable.COLUMNS.
+        :type name: str
+        :rtype: numpy.ndarray
+        """
+        return self.table.get_column(name)[self.rows]
+
+    def select_records_from_table(self, criteria):
+        """
+        Refine the selection.  See ObsTable.select_records_from_table().
+
+        :param criteria: Selection criteria.
+        :type criteria: dict
+        :rtype: ObsTableView
+        """
+        return ObsTableView(self.table,
+                            self.table.get_selected_rows(criteria, self.rows))
+
+
+# Operations of ObsTable.select_records_from_table(), and the ones allowed
+# on each column.
+OPERATIONS = ('equals', 'contain', 'range', 'overlap')
+SELECTION_OPERATIONS = {
+    'targetname': ('equals', 'contain'),
+    'rootname': ('equals', 'contain'),
+    'band': ('equals', 'contain'),
+    'grism': ('equals', 'contain'),
+    'datatype': ('equals', 'contain'),
+    'applyto': ('equals', 'contain'),
+    'filerange': ('equals', 'contain', 'overlap'),
+    'exptime': ('equals', 'range'),
+    'lnrs': ('equals', 'range'),
+    'rdmode': ('equals', 'contain')
+}
+
+
+# Title of the columns in the pretty format.
+PRETTY_TITLES = ('Targetname', 'rootname', 'band', 'grism', 'datatype',
+                 'applyto', 'filerange', 'exptime', 'LNRS', 'rdmode')
+
+
+def format_fixed_width(titles, columns, widths=None):
+    """
+    Format columns of strings in fixed width, right-justified and
+    separated by two spaces.  The output is the same as astropy's
+    ascii.FixedWidth writer with bookend=False and delimiter=None.
+
+    :param titles: Title of each column.
+    :type titles: list of str
+    :param columns: Values of each column, as strings.
+    :type columns: list of list of str
+    :param widths: Width of each column.  If None, the width of the
+        widest title or value is used.
+    :type widths: list of int
+    :return: The title line and the lines of values.
+    :rtype: tuple of (str, list of str)
+    """
+    if widths is None:
+        widths = [max([len(title)] + [len(value) for value in column])
+                  for (title, column) in zip(titles, columns)]
+    titleline = '  '.join(title.rjust(width)
+                          for (title, width) in zip(titles, widths))
+    justified = [[value.rjust(width) for value in column]
+                 for (column, width) in zip(columns, widths)]
+    lines = ['  '.join(values) for values in zip(*justified)]
+    return (titleline, lines)
+
+
+def _get_fixed_widths(titleline):
+    """
+    Widths of the columns of a table in the pretty format, from the
+    position of the end of each title.  None if the line is not the
+    title line of the pretty format.
+    """
+    matches = list(re.finditer(r'\S+', titleline))
+    if [match.group() for match in matches] != list(PRETTY_TITLES):
+        return None
+    widths = []
+    previous_end = -2
+    for match in matches:
+        widths.append(match.end() - previous_end - 2)
+        previous_end = match.end()
+    return widths
+
+
+def _format_tab_lines(columns):
+    """
+    Join the columns into lines in the tab format, the format of
+    ObsRecord.print_record().
+    """
+    return ["%s\t%s\t%s\t%s\t%s\t\t%s\t%s\t\t%s\t%s\t%s" % values
+            for values in zip(*columns)]
+
+
+def _to_text(value):
+    """
+    String written to disk for a value.  Lists are comma-separated, as
+    in the applyto column.
+    """
+    if isinstance(value, (list, tuple)):
+        return ','.join(str(item) for item in value)
+    return str(value)
+
+
+def _write_atomic(filename, lines):
+    """
+    Write the lines to a temporary file in the same directory, then
+    rename it to filename, so that the file is never seen incomplete.
+    The permissions of an existing file are kept.  Return the signature
+    of the new file, see _get_signature().
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    if os.path.exists(filename):
+        mode = os.stat(filename).st_mode & 0o777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    (fd, tmpname) = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as table:
+            table.write('\n'.join(lines))
+            table.write('\n')
+            table.flush()
+            os.fsync(table.fileno())
+            os.chmod(tmpname, mode)
+            signature = _get_signature(table.fileno())
+        _replace(tmpname, filename)
+    except Exception:
+        os.remove(tmpname)
+        raise
+    return signature
+
+
+# os.replace() is not available in Python 2, where os.rename() also
+# replaces the destination on POSIX systems.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _get_signature(file):
+    """
+    Signature of a file, by name or descriptor: its inode, size and
+    modification time.  It changes when the file is written to or
+    replaced.
+    """
+    if isinstance(file, int):
+        status = os.fstat(file)
+    else:
+        status = os.stat(file)
+    return (status.st_ino, status.st_size, status.st_mtime)
+
+
+@contextmanager
+def _locked(filename, shared=False):
+    """
+    Hold an advisory lock on a table, for the duration of a 'with'
+    block.  The lock is taken on filename + '.lock', not on the table,
+    since the table is replaced when it is written.  The lock file is
+    removed when the last holder releases it, so no lock file is left
+    next to the table.  There is no locking if fcntl is not available.
+    A shared lock is skipped if the table does not exist or the lock
+    file cannot be created, eg. in a read-only directory.
+    """
+    if fcntl is None or (shared and not os.path.exists(filename)):
+        yield
+        return
+    lockname = filename + '.lock'
+    while True:
+        try:
+            lockfile = open(lockname, 'a')
+        except (IOError, OSError):
+            if not shared:
+                raise
+            yield
+            return
+        fcntl.flock(lockfile.fileno(),
+                    fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        # the previous holder may have removed the lock file while this
+        # process was waiting for it; lock the new one then.
+        if _is_same_file(lockfile, lockname):
+            break
+        lockfile.close()
+    try:
+        yield
+    finally:
+        try:
+            # only the last holder gets the exclusive lock; those
+            # waiting on the removed file try again, see above.
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if _is_same_file(lockfile, lockname):
+                os.remove(lockname)
+        except (IOError, OSError):
+            pass
+        # closing the file releases the lock
+        lockfile.close()
+    return
+
+
+def _is_same_file(fileobj, filename):
+    """
+    Return whether filename is still the file open as fileobj.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return False
+    fstat = os.fstat(fileobj.fileno())
+    return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
+
+
+def _update_index(index, rows, columns, first):
+    """
+    Add rows to an index.  'rows' is a structured array of the rows
+    starting at row number 'first'.
+    """
+    keys = zip(*[rows[column].tolist() for column in columns])
+    for (row, key) in enumerate(keys, first):
+        index.setdefault(key, []).append(row)
+    return
+
+
+def _filerange_intervals(filerange):
+    """
+    Parse a file range string, eg. '58,60-62', into a list of
+    (lower, upper) file numbers.  A missing or invalid file range has
+    no intervals.
+    """
+    if filerange is None:
+        return []
+    try:
+        return FrameRange.from_string(filerange).intervals
+    except ValueError:
+        return []
+
+
+class _Categories(object):
+    """
+    Categorical encoding of a column: each distinct value gets an int32
+    code, its index in the 'values' list.  None is encoded as -1.
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, values):
+        values = _object_array(values)
+        codes = np.full(values.size, -1, dtype=np.int32)
+        present = np.not_equal(values, None)
+        if present.any():
+            (uniques, first, inverse) = np.unique(values[present],
+                                                  return_index=True,
+                                                  return_inverse=True)
+            # new values get their codes in order of appearance
+            mapping = np.empty(uniques.size, dtype=np.int32)
+            for index in np.argsort(first):
+                mapping[index] = self.get_code(uniques[index], add=True)
+            codes[present] = mapping[inverse.ravel()]
+        return codes
+
+    def decode(self, codes):
+        # The extra None at the end is what code -1 points to.
+        lookup = np.empty(len(self.values) + 1, dtype=object)
+        lookup[:-1] = self.values
+        return lookup[codes]
+
+    def get_code(self, value, add=False):
+        """
+        Code of value.  If value is not known, add it if 'add' is True,
+        otherwise return None.
+        """
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None and add:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[value] = code
+        return code
+
+
+def _get_key(values):
+    """
+    Hashable tuple of the values of a record.  Lists are converted to
+    tuples.
+    """
+    return tuple(tuple(value) if isinstance(value, list) else value
+                 for value in values)
+
+
+def _get_row_keys(table):
+    """
+    Keys of all the rows of a table or a view, as ObsRecord.get_key()
+    returns them, without building the records.
+    """
+    columns = [table.get_column(name).tolist() for name in ObsTable.COLUMNS]
+    return list(zip(*[[tuple(value) if isinstance(value, list) else value
+                       for value in column] for column in columns]))
+
+
+def _object_array(values):
+    """
+    Convert a sequence to a 1-D object array, even if the items are
+    sequences themselves.
+    """
+    array = np.empty(len(values), dtype=object)
+    try:
+        array[:] = list(values)
+    except ValueError:
+        for (i, value) in enumerate(values):
+            array[i] = value
+    return array
+
+
+# Number of lines parsed at a time when reading a table.
+READ_CHUNKSIZE = 10000
+
+
+def _iter_column_chunks(table, chunksize):
+    """
+    Parse an open table file, in the tab or the pretty format, into
+    columns, 'chunksize' lines at a time.  The numeric columns are
+    converted to arrays.  The comments, title lines and invalid lines
+    are skipped.
+    """
+    ncolumns = len(ObsTable.COLUMNS)
+    while True:
+        lines = list(itertools.islice(table, chunksize))
+        if not lines:
+            return
+        rows = [fields for fields in (line.split() for line in lines
+                                      if not line.startswith('#'))
+                if len(fields) == ncolumns]
+        try:
+            exptime = np.array([row[7] for row in rows], dtype=np.float64)
+            lnrs = np.array([row[8] for row in rows], dtype=np.int64)
+        except ValueError:
+            # probably the title bar
+            # (pretty format doesn't start with #)
+            rows = [row for row in rows if _is_record(row)]
+            exptime = np.array([row[7] for row in rows], dtype=np.float64)
+            lnrs = np.array([row[8] for row in rows], dtype=np.int64)
+        if not rows:
+            continue
+        columns = dict(zip(ObsTable.COLUMNS, zip(*rows)))
+        columns['exptime'] = exptime
+        columns['lnrs'] = lnrs
+        yield columns
+
+
+def _is_record(fields):
+    """
+    Check that the fields of a line of the table can be converted to
+    a record, ie. that the exptime and LNRS fields are numbers.
+    """
+    try:
+        float(fields[7])
+        int(fields[8])
+    except ValueError:
+        return False
+    return True
+
+
 # pylint: disable=R0902
-class ObsRecord:
+class ObsRecord(object):
     """
     Record that contains all the information needed for one line
     of the observation summary table.
@@ -230,7 +1309,14 @@ class ObsRecord:
     :type lnrs: int or str
     :param rdmode: Read mode.  'rdmode' column.  Eg. faint, bright, medium(?)
     :type rdmode: str
+
+    The attributes are stored in slots, there is no __dict__, so that
+    a large number of records stays compact.  The records are hashable,
+    the hash is computed from the values of the attributes: a record
+    must not be modified while it is in a set or a dictionary.
     """
+    __slots__ = ObsTable.COLUMNS
+
     # pylint: disable=R0913
     def __init__(self, targetname=None, rootname=None, band=None, grism=None,
                  datatype=None, applyto=None, filerange=None, exptime=None,
@@ -264,18 +1350,31 @@ class ObsRecord:
     #                 other.rdmode))
 
     def __eq__(self, other):
-        assert isinstance(other, ObsRecord)
-        return self.targetname == other.targetname and \
-               self.rootname == other.rootname and \
-               self.band == other.band and \
-               self.grism == other.grism and \
-               self.datatype == other.datatype and \
-               self.applyto == other.applyto and \
-               self.filerange == other.filerange and \
-               self.exptime == other.exptime and \
-               self.lnrs == other.lnrs and \
-               self.rdmode == other.rdmode
+        if not isinstance(other, ObsRecord):
+            return NotImplemented
+        return self.get_key() == other.get_key()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.get_key())
 
+    def __repr__(self):
+        return 'ObsRecord(%s)' % ', '.join('%s=%r' % (name, getattr(self, name))
+                                           for name in self.__slots__)
+
+    def get_key(self):
+        """
+        The values of the attributes, as a hashable tuple.  A list, eg.
+        in applyto, is converted to a tuple.
+
+        :rtype: tuple
+        """
+        return _get_key([getattr(self, name) for name in self.__slots__])
 
     def print_record(self):
         """
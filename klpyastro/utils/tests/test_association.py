@@ -0,0 +1,110 @@
+from klpyastro.utils import association
+from klpyastro.utils import obstable
+from nose.tools import assert_equal
+from nose.tools import assert_list_equal
+from nose.tools import assert_raises
+
+
+class TestAssociate:
+
+    @classmethod
+    def setup_class(cls):
+        rows = [('SDSS1', 'HK', 'Science', 'None', '496-499', 90, 6, 'faint'),
+                ('SDSS1', 'HK', 'Dark', 'Science,Arc', '592-595', 90, 6,
+                 'faint'),
+                ('SDSS1', 'HK', 'Flat', 'Science,Arc', '501', 4, 1, 'bright'),
+                ('SDSS1', 'HK', 'Dark', 'Flat', '588-591', 4, 1, 'bright'),
+                ('SDSS1', 'HK', 'Arc', 'Science', '502', 90, 6, 'faint'),
+                ('SDSS1', 'HK', 'Telluric', 'None', '510-513', 30, 1,
+                 'bright'),
+                ('SDSS1', 'JH', 'Science', 'None', '600-603', 90, 6, 'faint'),
+                ('SDSS2', 'HK', 'Flat', 'Science', '700', 4, 1, 'bright'),
+                (None, 'HK', 'Dark', None, '800', 30, 1, 'bright')]
+        records = []
+        for (target, config, datatype, applyto, filerange, exptime, lnrs,
+             rdmode) in rows:
+            records.append(obstable.ObsRecord(target, 'S20130719', config,
+                                              config, datatype, applyto,
+                                              filerange, exptime, lnrs,
+                                              rdmode))
+        TestAssociate.table = obstable.ObsTable(records=records)
+        TestAssociate.associations = association.associate(TestAssociate.table)
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def get_rows(self, row, caltype):
+        return list(TestAssociate.associations[row][caltype])
+
+    def test_receivers(self):
+        # science, flat, arc and telluric rows, not the darks
+        expected_result = [0, 2, 4, 5, 6, 7]
+        result = sorted(TestAssociate.associations.keys())
+        assert_list_equal(result, expected_result)
+
+    def test_science(self):
+        assert_list_equal(self.get_rows(0, 'Dark'), [1])
+        assert_list_equal(self.get_rows(0, 'Flat'), [2])
+        assert_list_equal(self.get_rows(0, 'Arc'), [4])
+        assert_list_equal(self.get_rows(0, 'Telluric'), [5])
+
+    def test_applyto(self):
+        # the 4s dark applies to flats only, the flat to science and arcs
+        assert_list_equal(self.get_rows(2, 'Dark'), [3])
+        assert_list_equal(self.get_rows(4, 'Flat'), [2])
+        assert_equal('Flat' in TestAssociate.associations[5], False)
+
+    def test_default_applyto(self):
+        # dark without applyto, no targetname needed for darks
+        assert_list_equal(self.get_rows(5, 'Dark'), [8])
+
+    def test_no_match(self):
+        # other configuration, other target
+        assert_list_equal(self.get_rows(6, 'Flat'), [])
+        assert_list_equal(self.get_rows(6, 'Arc'), [])
+
+    def test_custom_keys(self):
+        keys = {'Flat': ('band', 'grism')}
+        associations = association.associate(TestAssociate.table, keys)
+        assert_list_equal(list(associations[0]['Flat']), [2, 7])
+        assert_list_equal(sorted(associations.keys()), [0, 4, 6])
+
+    def test_readonly(self):
+        rows = TestAssociate.associations[0]['Dark']
+        assert_raises(ValueError, rows.__setitem__, 0, 5)
+
+    def test_shared(self):
+        # the science rows with the same key share the lookup
+        assert_equal(TestAssociate.associations[0]['Dark'] is
+                     TestAssociate.associations[6]['Dark'], True)
+
+    def test_without_indexes(self):
+        # the same associations, scanning the table
+        table = obstable.ObsTable(records=TestAssociate.table.records,
+                                  indexes=[])
+        associations = association.associate(table)
+        assert_list_equal(sorted(associations.keys()),
+                          sorted(TestAssociate.associations.keys()))
+        for (row, calibrations) in associations.items():
+            expected_result = TestAssociate.associations[row]
+            assert_list_equal(sorted(calibrations.keys()),
+                              sorted(expected_result.keys()))
+            for (caltype, rows) in calibrations.items():
+                assert_list_equal(list(rows), list(expected_result[caltype]))
+
+
+class TestParseApplyto:
+
+    def test_parse_applyto(self):
+        assert_equal(association.parse_applyto('Science,Arc'),
+                     ('Science', 'Arc'))
+        assert_equal(association.parse_applyto('Science'), ('Science',))
+        assert_equal(association.parse_applyto(['Flat']), ('Flat',))
+
+    def test_default(self):
+        assert_equal(association.parse_applyto('None', 'Arc'),
+                     ('Science', 'Telluric'))
+        assert_equal(association.parse_applyto(None, 'Telluric'),
+                     ('Science',))
+        assert_equal(association.parse_applyto('', 'Science'), ())
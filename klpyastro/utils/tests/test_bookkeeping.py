@@ -3,7 +3,8 @@ import os.path
 from klpyastro.utils import bookkeeping
 from nose.tools import assert_list_equal
 from nose.tools import assert_dict_equal
-from astrodata import AstroData
+from nose.tools import assert_equal
+from klpyastro.utils import descriptors
 
 class TestBookkeeping:
 
@@ -32,7 +33,7 @@ class TestBookkeeping:
                             'lnrs': 6,
                             'rdmode': '6'
                            }
-        ad = AstroData(TestBookkeeping.f2sciencefile)
+        ad = descriptors.Descriptors(TestBookkeeping.f2sciencefile)
         result = {}
         #result['targetname'] = bookkeeping.query_header(ad, 'targetname')
         result['band'] = bookkeeping.query_header(ad, 'band')
@@ -49,7 +50,7 @@ class TestBookkeeping:
                             'lnrs': 1,
                             'rdmode': '1'
                            }
-        ad = AstroData(TestBookkeeping.f2darkfile)
+        ad = descriptors.Descriptors(TestBookkeeping.f2darkfile)
         result = {}
         result['band'] = bookkeeping.query_header(ad, 'band')
         result['grism'] = bookkeeping.query_header(ad, 'grism')
@@ -65,7 +66,7 @@ class TestBookkeeping:
                             'lnrs': 1,
                             'rdmode': '1'
                            }
-        ad = AstroData(TestBookkeeping.f2flatfile)
+        ad = descriptors.Descriptors(TestBookkeeping.f2flatfile)
         result = {}
         result['band'] = bookkeeping.query_header(ad, 'band')
         result['grism'] = bookkeeping.query_header(ad, 'grism')
@@ -81,7 +82,7 @@ class TestBookkeeping:
                             'lnrs': 6,
                             'rdmode': '6'
                            }
-        ad = AstroData(TestBookkeeping.f2arcfile)
+        ad = descriptors.Descriptors(TestBookkeeping.f2arcfile)
         result = {}
         result['band'] = bookkeeping.query_header(ad, 'band')
         result['grism'] = bookkeeping.query_header(ad, 'grism')
@@ -101,7 +102,7 @@ class TestBookkeeping:
         filerange5 = '226,227-228,230,232-234'
         expected_result = [210,211,212,213,214,215,216,217,218,219,220,221,
                            223,224,225,226,227,228,230,232,233,234]
-        result = bookkeeping.parse_filerange(filerange1)
+        result = list(bookkeeping.parse_filerange(filerange1))
         result.extend(bookkeeping.parse_filerange(filerange2))
         result.extend(bookkeeping.parse_filerange(filerange3))
         result.extend(bookkeeping.parse_filerange(filerange4))
@@ -129,3 +130,58 @@ class TestBookkeeping:
             result.append(dirstruct)
         shutil.rmtree(program)
         assert_list_equal(result, expected_result)
+
+    def test_mkdirectories_batch(self):
+        import shutil
+        import tempfile
+
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        manifest_name = os.path.join(tmpdir, 'manifest.txt')
+        with open(manifest_name, 'w') as manifest_file:
+            manifest_file.write('# program target obsdate reduxdate bands\n')
+            manifest_file.write('GS-2013-Q-73 SDSSJ0227 20131002 15Oct2013 '
+                                'JH HK\n')
+            manifest_file.write('\n')
+            manifest_file.write('GS-2013-Q-73 SDSSJ0227 20131003 15Oct2013 '
+                                'JH\n')
+            manifest_file.write('GS-2013-Q-73 SDSSJ0001 20131002 15Oct2013 '
+                                'HK\n')
+        manifest = bookkeeping.read_manifest(manifest_name)
+        assert_equal(manifest[0], ('GS-2013-Q-73', 'SDSSJ0227',
+                                   '20131002', '15Oct2013', ['JH', 'HK']))
+        # the same structure twice is harmless
+        manifest.append(manifest[0])
+        try:
+            result = bookkeeping.mkdirectories_batch(manifest, rootdir=tmpdir,
+                                                     nthreads=4)
+            expected_result = [
+                'GS-2013-Q-73',
+                'GS-2013-Q-73/SDSSJ0001',
+                'GS-2013-Q-73/SDSSJ0001/20131002-15Oct2013',
+                'GS-2013-Q-73/SDSSJ0001/20131002-15Oct2013/README',
+                'GS-2013-Q-73/SDSSJ0001/20131002-15Oct2013/reduxHK',
+                'GS-2013-Q-73/SDSSJ0001/sciproducts',
+                'GS-2013-Q-73/SDSSJ0227',
+                'GS-2013-Q-73/SDSSJ0227/20131002-15Oct2013',
+                'GS-2013-Q-73/SDSSJ0227/20131002-15Oct2013/README',
+                'GS-2013-Q-73/SDSSJ0227/20131002-15Oct2013/reduxHK',
+                'GS-2013-Q-73/SDSSJ0227/20131002-15Oct2013/reduxJH',
+                'GS-2013-Q-73/SDSSJ0227/20131003-15Oct2013',
+                'GS-2013-Q-73/SDSSJ0227/20131003-15Oct2013/README',
+                'GS-2013-Q-73/SDSSJ0227/20131003-15Oct2013/reduxJH',
+                'GS-2013-Q-73/SDSSJ0227/sciproducts',
+                'GS-2013-Q-73/raw']
+            assert_list_equal(result, [os.path.join(tmpdir, path)
+                                       for path in expected_result])
+            assert_equal(os.getcwd(), cwd)
+            # nothing left to create, the READMEs are not overwritten
+            readme = os.path.join(tmpdir, expected_result[3])
+            with open(readme, 'w') as readme_file:
+                readme_file.write('Reduced with v1.0\n')
+            assert_list_equal(bookkeeping.mkdirectories_batch(
+                manifest, rootdir=tmpdir), [])
+            with open(readme) as readme_file:
+                assert_equal(readme_file.read(), 'Reduced with v1.0\n')
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,101 @@
+from klpyastro.utils import descriptors
+from klpyastro.utils import hdrindex
+from astropy.io import fits
+from nose.tools import assert_dict_equal
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from nose.tools import assert_false
+from nose.tools import assert_is_none
+from nose.tools import assert_raises
+import os.path
+import shutil
+import tempfile
+
+
+class TestDescriptors():
+
+    @classmethod
+    def setup_class(cls):
+        TestDescriptors.tmpdir = tempfile.mkdtemp()
+        TestDescriptors.sciencefile = TestDescriptors.write_file(
+            'S20131002S0046.fits', 'SDSSJ0227', 'OBJECT', 'science',
+            'JH_G0809', 'Open', 'JH_G5801', 90., 6)
+        TestDescriptors.darkfile = TestDescriptors.write_file(
+            'S20131002S0217.fits', 'Dark', 'DARK', 'dayCal',
+            'DK_G0807', 'Open', 'Open', 8., 1)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestDescriptors.tmpdir)
+
+    @staticmethod
+    def write_file(name, target, obstype, obsclass, filter1, filter2, grism,
+                   exptime, lnrs):
+        header = fits.Header()
+        header['OBJECT'] = target
+        header['OBSTYPE'] = obstype
+        header['OBSCLASS'] = obsclass
+        header['FILTER1'] = filter1
+        header['FILTER2'] = filter2
+        header['GRISM'] = grism
+        header['EXPTIME'] = exptime
+        header['LNRS'] = lnrs
+        filename = os.path.join(TestDescriptors.tmpdir, name)
+        fits.PrimaryHDU(header=header).writeto(filename)
+        return filename
+
+    def test_science(self):
+        expected_result = {'targetname': 'SDSSJ0227', 'band': 'JH',
+                           'grism': 'JH', 'datatype': 'Science',
+                           'exptime': 90., 'lnrs': 6, 'rdmode': '6'}
+        result = descriptors.Descriptors(TestDescriptors.sciencefile)
+        assert_dict_equal(result.as_dict(), expected_result)
+
+    def test_dark(self):
+        expected_result = {'band': 'dark', 'grism': 'Open',
+                           'datatype': 'Dark', 'exptime': 8., 'lnrs': 1,
+                           'rdmode': '1'}
+        result = descriptors.Descriptors(TestDescriptors.darkfile)
+        assert_dict_equal(result.as_dict(['band', 'grism', 'datatype',
+                                          'exptime', 'lnrs', 'rdmode']),
+                          expected_result)
+
+    def test_lazy(self):
+        result = descriptors.Descriptors(TestDescriptors.sciencefile)
+        assert_is_none(result._header)
+        assert_equal(result.get('band'), 'JH')
+        assert_false(result._header is None)
+        assert_equal(list(result._values.keys()), ['band'])
+        assert_raises(ValueError, result.get, 'filename')
+
+    def test_header_dict(self):
+        header = {'OBJECT': 'HIP 1234', 'OBSTYPE': 'OBJECT',
+                  'OBSCLASS': 'partnerCal', 'LNRS': None}
+        result = descriptors.Descriptors(header=header)
+        assert_equal(result.get('datatype'), 'Telluric')
+        assert_equal(result.get('band'), 'Open')
+        assert_is_none(result.get('rdmode'))
+
+    def test_get_descriptors(self):
+        filename = TestDescriptors.write_file(
+            'S20131002S0055.fits', 'GCALflat', 'FLAT', 'partnerCal',
+            'JH_G0809', 'Open', 'JH_G5801', 8., 1)
+        descriptors.clear_cache()
+        result1 = descriptors.get_descriptors(filename)
+        assert_true(descriptors.get_descriptors(filename) is result1)
+        # a modified file gets new descriptors
+        os.utime(filename, (1e9, 1e9))
+        assert_false(descriptors.get_descriptors(filename) is result1)
+
+    def test_get_batch(self):
+        filenames = [TestDescriptors.sciencefile, TestDescriptors.darkfile,
+                     os.path.join(TestDescriptors.tmpdir, 'missing.fits')]
+        result = descriptors.get_batch(filenames, ['band', 'lnrs'], 2)
+        assert_dict_equal(result, {
+            TestDescriptors.sciencefile: {'band': 'JH', 'lnrs': 6},
+            TestDescriptors.darkfile: {'band': 'dark', 'lnrs': 1}})
+        index = hdrindex.HeaderIndex(
+            os.path.join(TestDescriptors.tmpdir, 'index.db'),
+            descriptors.KEYWORDS)
+        assert_dict_equal(descriptors.get_batch(filenames, index=index),
+                          descriptors.get_batch(filenames))
@@ -0,0 +1,99 @@
+from klpyastro.utils import framerange
+from klpyastro.utils.framerange import FrameRange
+from nose.tools import assert_list_equal
+from nose.tools import assert_equal
+from nose.tools import assert_not_equal
+from nose.tools import assert_true
+from nose.tools import assert_false
+from nose.tools import assert_raises
+import numpy as np
+
+
+class TestFrameRange:
+
+    def test_from_string(self):
+        result = FrameRange.from_string('226,227-228,230,232-234')
+        assert_list_equal(result.intervals, [(226, 228), (230, 230),
+                                             (232, 234)])
+        assert_list_equal(list(result), [226, 227, 228, 230, 232, 233, 234])
+        assert_raises(ValueError, FrameRange.from_string, '1-2-3')
+        assert_raises(ValueError, FrameRange.from_string, 'None')
+
+    def test_normalize(self):
+        result = FrameRange([(10, 12), (1, 3), (2, 5), (6, 6), (9, 8)])
+        assert_list_equal(result.intervals, [(1, 6), (10, 12)])
+        assert_false(FrameRange())
+
+    def test_compress_frames(self):
+        frames = [225, 218, 219, 220, 221, 223, 224, 223, 230]
+        assert_equal(framerange.compress_frames(frames),
+                     '218-221,223-225,230')
+        assert_equal(framerange.compress_frames(np.arange(496, 500)),
+                     '496-499')
+        assert_equal(framerange.compress_frames([]), '')
+
+    def test_round_trip(self):
+        filerange = '218-221,223-225'
+        assert_equal(str(FrameRange.from_string(filerange)), filerange)
+        assert_equal(framerange.compress_frames(
+            FrameRange.from_string(filerange)), filerange)
+
+    def test_sequence(self):
+        frames = FrameRange.from_string('226,227-228,230,232-234')
+        expected_result = [226, 227, 228, 230, 232, 233, 234]
+        assert_equal(len(frames), len(expected_result))
+        assert_list_equal([frames[i] for i in range(-7, 7)],
+                          expected_result * 2)
+        assert_raises(IndexError, frames.__getitem__, 7)
+        assert_raises(IndexError, frames.__getitem__, -8)
+        assert_raises(TypeError, frames.__getitem__, '1')
+        assert_equal(str(frames[2:-1]), '228,230,232-233')
+        assert_list_equal(list(frames[::2]), expected_result[::2])
+        assert_list_equal([frame for frame in range(220, 240)
+                           if frame in frames], expected_result)
+        assert_false('226' in frames)
+        assert_list_equal(np.asarray(frames).tolist(), expected_result)
+        assert_list_equal([list(segment) for segment in frames.iter_ranges()],
+                          [[226, 227, 228], [230], [232, 233, 234]])
+
+    def test_sequence_large(self):
+        frames = FrameRange.from_string('1-200000,300001-400000')
+        assert_equal(len(frames), 300000)
+        assert_equal(frames[0], 1)
+        assert_equal(frames[200000], 300001)
+        assert_equal(frames[-1], 400000)
+        assert_true(250000 not in frames)
+        assert_true(350000 in frames)
+        assert_equal(np.asarray(frames).sum(),
+                     sum(range(1, 200001)) + sum(range(300001, 400001)))
+        assert_equal(len(FrameRange()), 0)
+        assert_equal(np.asarray(FrameRange()).size, 0)
+
+    def test_set_operations(self):
+        frames1 = FrameRange.from_string('1-10,20-30,40')
+        frames2 = FrameRange.from_string('5-22,29-45')
+        assert_equal(str(frames1 | frames2), '1-45')
+        assert_equal(str(frames1 & frames2), '5-10,20-22,29-30,40')
+        assert_equal(str(frames1 - frames2), '1-4,23-28')
+        assert_equal(str(frames2 - frames1), '11-19,31-39,41-45')
+        assert_equal(str(frames1 - FrameRange()), str(frames1))
+        assert_true(frames1.overlaps(frames2))
+        assert_false(frames1.overlaps(FrameRange.from_string('11-19,41')))
+
+    def test_set_operations_random(self):
+        random = np.random.RandomState(42)
+        for _ in range(200):
+            set1 = set(random.randint(0, 50, 20).tolist())
+            set2 = set(random.randint(0, 50, 20).tolist())
+            frames1 = FrameRange.from_frames(list(set1))
+            frames2 = FrameRange.from_frames(list(set2))
+            assert_list_equal(list(frames1 | frames2), sorted(set1 | set2))
+            assert_list_equal(list(frames1 & frames2), sorted(set1 & set2))
+            assert_list_equal(list(frames1 - frames2), sorted(set1 - set2))
+
+    def test_equal(self):
+        assert_equal(FrameRange.from_string('1-3,4'),
+                     FrameRange.from_string('1,2,3-4'))
+        assert_equal(hash(FrameRange.from_string('1-3,4')),
+                     hash(FrameRange.from_string('1,2,3-4')))
+        assert_not_equal(FrameRange.from_string('1-3'), '1-3')
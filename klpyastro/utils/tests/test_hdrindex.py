@@ -0,0 +1,114 @@
+from klpyastro.utils import hdrindex
+from astropy.io import fits
+from nose.tools import assert_equal
+from nose.tools import assert_list_equal
+import os.path
+import shutil
+import tempfile
+
+
+class CountingIndex(hdrindex.HeaderIndex):
+    # Keep track of the files that are opened.
+    def read_header(self, filename):
+        self.read.append(os.path.basename(filename))
+        return hdrindex.HeaderIndex.read_header(self, filename)
+
+
+class TestHeaderIndex():
+
+    @classmethod
+    def setup_class(cls):
+        TestHeaderIndex.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestHeaderIndex.tmpdir)
+
+    def make_files(self, name, nfiles):
+        directory = os.path.join(TestHeaderIndex.tmpdir, name)
+        os.mkdir(directory)
+        filenames = []
+        for i in range(nfiles):
+            filenames.append(os.path.join(directory, 'S%04d.fits' % i))
+            self.write_file(filenames[-1], i)
+        return filenames
+
+    def write_file(self, filename, lnrs):
+        header = fits.Header()
+        header['OBJECT'] = 'SDSSJ0001'
+        header['LNRS'] = lnrs
+        fits.PrimaryHDU(header=header).writeto(filename, overwrite=True)
+
+    def get_index(self, name, keywords=('OBJECT', 'LNRS')):
+        index = CountingIndex(os.path.join(TestHeaderIndex.tmpdir, name),
+                              keywords)
+        index.read = []
+        return index
+
+    def test_get_headers(self):
+        filenames = self.make_files('get', 3)
+        index = self.get_index('get.db')
+        headers = index.get_headers(filenames, nthreads=2)
+        assert_equal(headers[filenames[2]],
+                     {'OBJECT': 'SDSSJ0001', 'LNRS': 2})
+        assert_list_equal(sorted(index.read),
+                          ['S0000.fits', 'S0001.fits', 'S0002.fits'])
+
+    def test_incremental(self):
+        filenames = self.make_files('incremental', 4)
+        self.get_index('incremental.db').get_headers(filenames[:3])
+        # modified file: different size and modification time
+        header = fits.Header()
+        header['OBJECT'] = 'SDSSJ0002'
+        header['LNRS'] = 1
+        header['COMMENT'] = 'x' * 3000
+        fits.PrimaryHDU(header=header).writeto(filenames[1], overwrite=True)
+        os.utime(filenames[1], (1e9, 1e9))
+        index = self.get_index('incremental.db')
+        headers = index.get_headers(filenames)
+        assert_list_equal(sorted(index.read), ['S0001.fits', 'S0003.fits'])
+        assert_equal(headers[filenames[1]]['OBJECT'], 'SDSSJ0002')
+        # nothing changed
+        index = self.get_index('incremental.db')
+        headers = index.get_headers(filenames)
+        assert_list_equal(index.read, [])
+        assert_equal(len(headers), 4)
+
+    def test_new_keyword(self):
+        filenames = self.make_files('keyword', 2)
+        self.get_index('keyword.db').get_headers(filenames)
+        index = self.get_index('keyword.db', ('OBJECT', 'EXPTIME'))
+        headers = index.get_headers(filenames)
+        assert_equal(len(index.read), 2)
+        assert_equal(headers[filenames[0]]['EXPTIME'], None)
+
+    def test_missing_file(self):
+        filenames = self.make_files('missing', 2)
+        index = self.get_index('missing.db')
+        index.get_headers(filenames)
+        os.remove(filenames[0])
+        headers = index.get_headers(filenames)
+        assert_list_equal(list(headers.keys()), filenames[1:])
+        assert_equal(index.prune(), 1)
+        assert_equal(index.prune(), 0)
+
+    def test_shared_database(self):
+        # indexes with other keywords keep each other's entries
+        filenames = self.make_files('shared', 2)
+        self.get_index('shared.db').get_headers(filenames)
+        index = self.get_index('shared.db', ('OBJECT', 'EXPTIME'))
+        index.get_headers(filenames)
+        assert_equal(len(index.read), 2)
+        for keywords in [('OBJECT', 'LNRS'), ('OBJECT', 'EXPTIME')]:
+            index = self.get_index('shared.db', keywords)
+            headers = index.get_headers(filenames)
+            assert_list_equal(index.read, [])
+            assert_equal(sorted(headers[filenames[1]].keys()),
+                         sorted(keywords))
+        # a modified file drops the keywords of the other index
+        self.write_file(filenames[0], 5)
+        os.utime(filenames[0], (1e9, 1e9))
+        self.get_index('shared.db').get_headers(filenames)
+        index = self.get_index('shared.db', ('OBJECT', 'EXPTIME'))
+        index.get_headers(filenames)
+        assert_list_equal(index.read, ['S0000.fits'])
@@ -0,0 +1,183 @@
+from klpyastro.utils import ingest
+from klpyastro.utils import obsdb
+from klpyastro.utils import obstable
+from astropy.io import fits
+from nose.tools import assert_list_equal
+from nose.tools import assert_equal
+from nose.tools import assert_is_none
+import os.path
+import shutil
+import tempfile
+
+
+# (number, OBJECT, OBSTYPE, OBSCLASS, FILTER2, EXPTIME, LNRS)
+FRAMES = [
+    (1, 'HIP 1234', 'OBJECT', 'partnerCal', 'HK_G0806', 10., 1),
+    (2, 'HIP 1234', 'OBJECT', 'partnerCal', 'HK_G0806', 10., 1),
+    (3, 'GCALflat', 'FLAT', 'partnerCal', 'HK_G0806', 4., 1),
+    (4, 'SDSSJ0001', 'OBJECT', 'acq', 'HK_G0806', 15., 1),
+    (10, 'SDSSJ0001', 'OBJECT', 'science', 'HK_G0806', 90., 6),
+    (11, 'SDSSJ0001', 'OBJECT', 'science', 'HK_G0806', 90., 6),
+    (12, 'SDSSJ0001', 'OBJECT', 'science', 'HK_G0806', 90., 6),
+    (14, 'SDSSJ0001', 'OBJECT', 'science', 'HK_G0806', 90., 6),
+    (15, 'Ar', 'ARC', 'progCal', 'HK_G0806', 15., 1),
+    (30, 'SDSSJ0002', 'OBJECT', 'science', 'HK_G0806', 90., 6),
+    (31, 'Dark', 'DARK', 'dayCal', 'DK_G0807', 90., 6),
+    (32, 'Dark', 'DARK', 'dayCal', 'DK_G0807', 90., 6)
+]
+
+
+def write_frame(rawdir, frame):
+    (number, target, obstype, obsclass, filter2, exptime, lnrs) = frame
+    header = fits.Header()
+    header['OBJECT'] = target
+    header['OBSTYPE'] = obstype
+    header['OBSCLASS'] = obsclass
+    header['FILTER1'] = 'Open'
+    header['FILTER2'] = filter2
+    header['GRISM'] = 'HK_G5802'
+    header['EXPTIME'] = exptime
+    header['LNRS'] = lnrs
+    fits.PrimaryHDU(header=header).writeto(
+        os.path.join(rawdir, 'S20130719S%04d.fits' % number))
+
+
+class TestIngest():
+
+    @classmethod
+    def setup_class(cls):
+        TestIngest.tmpdir = tempfile.mkdtemp()
+        TestIngest.rawdir = os.path.join(TestIngest.tmpdir, 'raw')
+        os.mkdir(TestIngest.rawdir)
+        for frame in FRAMES:
+            write_frame(TestIngest.rawdir, frame)
+        # not a raw frame
+        fits.PrimaryHDU().writeto(os.path.join(TestIngest.rawdir,
+                                               'bpm.fits'))
+        TestIngest.expected_records = [
+            ('SDSSJ0001', 'Telluric', 'Science', '1-2', 10., 1, '1'),
+            ('SDSSJ0001', 'Flat', 'Science,Arc,Telluric', '3', 4., 1, '1'),
+            ('SDSSJ0001', 'Science', 'None', '10-12', 90., 6, '6'),
+            ('SDSSJ0001', 'Science', 'None', '14', 90., 6, '6'),
+            ('SDSSJ0001', 'Arc', 'Science,Telluric', '15', 15., 1, '1'),
+            ('SDSSJ0002', 'Science', 'None', '30', 90., 6, '6'),
+            ('SDSSJ0002', 'Dark', 'Science,Arc,Flat,Telluric', '31-32', 90.,
+             6, '6')
+        ]
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestIngest.tmpdir)
+
+    def get_summary(self, records):
+        return [(record.targetname, record.datatype, record.applyto,
+                 record.filerange, record.exptime, record.lnrs,
+                 record.rdmode) for record in records]
+
+    def test_get_frame_info(self):
+        expected_result = {'rootname': 'S20130719', 'number': 1,
+                           'targetname': 'HIP 1234', 'band': 'HK',
+                           'grism': 'HK', 'datatype': 'Telluric',
+                           'exptime': 10., 'lnrs': 1, 'rdmode': '1'}
+        result = ingest.get_frame_info(
+            os.path.join(TestIngest.rawdir, 'S20130719S0001.fits'))
+        assert_equal(result, expected_result)
+
+    def test_get_frame_info_skipped(self):
+        for name in ['S20130719S0004.fits', 'bpm.fits']:
+            assert_is_none(ingest.get_frame_info(
+                os.path.join(TestIngest.rawdir, name)))
+
+    def test_group_frames(self):
+        filenames = [os.path.join(TestIngest.rawdir,
+                                  'S20130719S%04d.fits' % frame[0])
+                     for frame in FRAMES]
+        frames = ingest.scan_headers(filenames, nthreads=3)
+        assert_equal(len(frames), len(FRAMES) - 1)
+        # the order of the frames does not matter
+        records = ingest.group_frames(frames[::-1])
+        assert_list_equal(self.get_summary(records),
+                          TestIngest.expected_records)
+
+    def test_ingest(self):
+        tablename = os.path.join(TestIngest.tmpdir, 'table.dat')
+        nadded = ingest.ingest(TestIngest.rawdir, tablename)
+        assert_equal(nadded, len(TestIngest.expected_records))
+        table = obstable.ObsTable(tablename)
+        assert_list_equal(self.get_summary(table.records),
+                          TestIngest.expected_records)
+        # the records already in the table are not added again
+        assert_equal(ingest.ingest(TestIngest.rawdir, tablename), 0)
+        assert_equal(len(obstable.ObsTable(tablename)),
+                     len(TestIngest.expected_records))
+
+    def test_ingest_index(self):
+        tablename = os.path.join(TestIngest.tmpdir, 'table_index.dat')
+        index = os.path.join(TestIngest.tmpdir, 'hdrindex.db')
+        ingest.ingest(TestIngest.rawdir, tablename, index=index)
+        os.remove(tablename)
+        # second run from the index
+        ingest.ingest(TestIngest.rawdir, tablename, index=index)
+        table = obstable.ObsTable(tablename)
+        assert_list_equal(self.get_summary(table.records),
+                          TestIngest.expected_records)
+
+    def test_ingest_new_frame(self):
+        # a frame arriving between two runs extends the rows it joins
+        expected_result = (TestIngest.expected_records[:2] +
+                           [TestIngest.expected_records[4]] +
+                           TestIngest.expected_records[5:] +
+                           [('SDSSJ0001', 'Science', 'None', '10-14', 90., 6,
+                             '6')])
+        for name in ['table_new.dat', 'table_new.db']:
+            rawdir = os.path.join(TestIngest.tmpdir, 'raw_' + name)
+            shutil.copytree(TestIngest.rawdir, rawdir)
+            tablename = os.path.join(TestIngest.tmpdir, name)
+            ingest.ingest(rawdir, tablename)
+            write_frame(rawdir, (13, 'SDSSJ0001', 'OBJECT', 'science',
+                                 'HK_G0806', 90., 6))
+            assert_equal(ingest.ingest(rawdir, tablename), 1)
+            table = obsdb.open_table(tablename)
+            assert_list_equal(self.get_summary(table.records),
+                              expected_result)
+            assert_equal(ingest.ingest(rawdir, tablename), 0)
+            assert_equal(len(obsdb.open_table(tablename)),
+                         len(expected_result))
+
+    def test_ingest_concurrent(self):
+        # another job writes to the table while the frames are ingested:
+        # its record is kept and the replaced rows do not come back
+        other = obstable.ObsRecord(
+            targetname='SDSSJ0003', rootname='S20130720', band='HK',
+            grism='HK', datatype='Science', applyto='None', filerange='1-2',
+            exptime=90., lnrs=6, rdmode='6')
+        expected_result = (TestIngest.expected_records[:2] +
+                           [TestIngest.expected_records[4]] +
+                           TestIngest.expected_records[5:] +
+                           [self.get_summary([other])[0],
+                            ('SDSSJ0001', 'Science', 'None', '10-14', 90., 6,
+                             '6')])
+        open_table = obsdb.open_table
+
+        def open_and_write(tablename):
+            table = open_table(tablename)
+            concurrent = open_table(tablename)
+            concurrent.add_records_to_table(other)
+            concurrent.append_table()
+            return table
+
+        for name in ['table_concurrent.dat', 'table_concurrent.db']:
+            rawdir = os.path.join(TestIngest.tmpdir, 'raw_' + name)
+            shutil.copytree(TestIngest.rawdir, rawdir)
+            tablename = os.path.join(TestIngest.tmpdir, name)
+            ingest.ingest(rawdir, tablename)
+            write_frame(rawdir, (13, 'SDSSJ0001', 'OBJECT', 'science',
+                                 'HK_G0806', 90., 6))
+            ingest.obsdb.open_table = open_and_write
+            try:
+                ingest.ingest(rawdir, tablename)
+            finally:
+                ingest.obsdb.open_table = open_table
+            table = obsdb.open_table(tablename)
+            assert_list_equal(sorted(self.get_summary(table.records)),
+                              sorted(expected_result))
@@ -0,0 +1,135 @@
+from klpyastro.utils import obsdb
+from klpyastro.utils import obstable
+from nose.tools import assert_list_equal
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from contextlib import closing
+import os.path
+import shutil
+import sqlite3
+import tempfile
+
+
+class TestSQLiteObsTable():
+
+    @classmethod
+    def setup_class(cls):
+        TestSQLiteObsTable.tmpdir = tempfile.mkdtemp()
+        TestSQLiteObsTable.obsrecords = []
+        for i in range(12):
+            TestSQLiteObsTable.obsrecords.append(obstable.ObsRecord(
+                targetname='SDSSJ%04d' % (i % 3), rootname='S20130719',
+                band=['HK', 'JH'][i % 2], grism=['HK', 'JH'][i % 2],
+                datatype=['Science', 'Dark', 'Flat', 'Arc'][i % 4],
+                applyto=[None, 'Science,Arc', 'Science', 'None'][i % 4],
+                filerange='%d-%d' % (10 * i, 10 * i + 3),
+                exptime=[90, 4, 15][i % 3], lnrs=[6, 1, 1][i % 3],
+                rdmode=['faint', 'bright', 'bright'][i % 3]))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestSQLiteObsTable.tmpdir)
+
+    def get_filename(self, name):
+        return os.path.join(TestSQLiteObsTable.tmpdir, name)
+
+    def test_write_read(self):
+        filename = self.get_filename('write_read.db')
+        table = obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords)
+        table.write_table(filename)
+        result = obsdb.SQLiteObsTable(filename)
+        assert_list_equal(result.records, TestSQLiteObsTable.obsrecords)
+
+    def test_write_replaces(self):
+        filename = self.get_filename('write_replaces.db')
+        table = obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords)
+        table.write_table(filename)
+        table.write_table(filename)
+        result = obsdb.SQLiteObsTable(filename)
+        assert_equal(len(result), len(TestSQLiteObsTable.obsrecords))
+
+    def test_append(self):
+        filename = self.get_filename('append.db')
+        table = obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords[:5])
+        table.filename = filename
+        table.append_table()
+        table.add_records_to_table(TestSQLiteObsTable.obsrecords[5:])
+        table.append_table()
+        table.append_table()
+        result = obsdb.SQLiteObsTable(filename)
+        assert_list_equal(result.records, TestSQLiteObsTable.obsrecords)
+
+    def test_database_settings(self):
+        filename = self.get_filename('settings.db')
+        obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords).\
+            write_table(filename)
+        with closing(sqlite3.connect(filename)) as connection:
+            journal_mode = connection.execute(
+                'PRAGMA journal_mode').fetchone()[0]
+            indexes = [row[1] for row in connection.execute(
+                "SELECT * FROM sqlite_master WHERE type='index'")]
+        assert_equal(journal_mode, 'wal')
+        assert_true('observations_exptime_lnrs_rdmode' in indexes)
+        assert_true('observations_targetname_band_grism' in indexes)
+
+    def test_select_records(self):
+        filename = self.get_filename('select.db')
+        obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords).\
+            write_table(filename)
+        criteria = {'datatype': 'Dark', 'exptime': [(None, 10.), 'range'],
+                    'applyto': ['Arc', 'contain']}
+        expected_result = [record for record in TestSQLiteObsTable.obsrecords
+                           if record.datatype == 'Dark' and
+                           record.exptime <= 10.]
+        result = obsdb.select_records(filename, criteria)
+        assert_list_equal(result.records, expected_result)
+        assert_equal(len(result.table), len(expected_result))
+
+    def test_select_records_overlap(self):
+        filename = self.get_filename('overlap.db')
+        obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords).\
+            write_table(filename)
+        criteria = {'band': 'HK', 'filerange': ['15-22', 'overlap']}
+        result = obsdb.select_records(filename, criteria)
+        assert_list_equal(result.records, [TestSQLiteObsTable.obsrecords[2]])
+
+    def test_import_export(self):
+        textfile = self.get_filename('import.dat')
+        dbfile = self.get_filename('import.db')
+        exportfile = self.get_filename('export.dat')
+        table = obstable.ObsTable(records=TestSQLiteObsTable.obsrecords)
+        table.pretty_table(textfile)
+        nrecords = obsdb.import_text(textfile, dbfile, chunksize=5)
+        assert_equal(nrecords, len(TestSQLiteObsTable.obsrecords))
+        obsdb.export_text(dbfile, exportfile)
+        with open(textfile) as expected, open(exportfile) as result:
+            assert_equal(result.read(), expected.read())
+
+    def test_export_existing(self):
+        # an export replaces an existing text table, in both formats
+        dbfile = self.get_filename('existing.db')
+        obsdb.SQLiteObsTable(records=TestSQLiteObsTable.obsrecords[1:]).\
+            write_table(dbfile)
+        for pretty in [True, False]:
+            newfile = self.get_filename('new%d.dat' % pretty)
+            obsdb.export_text(dbfile, newfile, pretty=pretty)
+            textfile = self.get_filename('existing%d.dat' % pretty)
+            obstable.ObsTable(records=TestSQLiteObsTable.obsrecords[:1]).\
+                pretty_table(textfile)
+            obsdb.export_text(dbfile, textfile, pretty=pretty)
+            with open(newfile) as expected, open(textfile) as result:
+                assert_equal(result.read(), expected.read())
+
+    def test_open_table(self):
+        textfile = self.get_filename('open.dat')
+        dbfile = self.get_filename('open.db')
+        obstable.ObsTable(records=TestSQLiteObsTable.obsrecords).\
+            write_table(textfile)
+        obsdb.import_text(textfile, dbfile)
+        text_table = obsdb.open_table(textfile)
+        db_table = obsdb.open_table(dbfile)
+        assert_equal(type(text_table), obstable.ObsTable)
+        assert_equal(type(db_table), obsdb.SQLiteObsTable)
+        assert_list_equal(db_table.records, text_table.records)
+        new_table = obsdb.open_table(self.get_filename('new.sqlite'))
+        assert_equal(len(new_table), 0)
@@ -1,9 +1,13 @@
 from klpyastro.utils import obstable
 from nose.tools import assert_list_equal
 from nose.tools import assert_equal
+from nose.tools import assert_false
+from nose.tools import assert_not_equal
 from nose.tools import assert_raises
 from nose.tools import assert_multi_line_equal
 import os.path
+import shutil
+import tempfile
 
 class TestObsRecord:
 
@@ -42,6 +46,26 @@ class TestObsRecord:
                   record.lnrs, record.rdmode]
         assert_list_equal(result, expected_result)
 
+    def test_slots(self):
+        record = obstable.ObsRecord()
+        assert_false(hasattr(record, '__dict__'))
+        assert_raises(AttributeError, setattr, record, 'name', 'value')
+
+    def test_equal_hash(self):
+        record = obstable.ObsRecord()
+        record.read_record(TestObsRecord.asciiline)
+        assert_equal(record, TestObsRecord.obsrecord)
+        assert_equal(hash(record), hash(TestObsRecord.obsrecord))
+        assert_equal(len(set([record, TestObsRecord.obsrecord])), 1)
+        record.lnrs = 1
+        assert_not_equal(record, TestObsRecord.obsrecord)
+        assert_not_equal(TestObsRecord.obsrecord, 'not a record')
+
+    def test_hash_list(self):
+        record = obstable.ObsRecord(applyto=['Science', 'Arc'])
+        assert_equal(hash(record),
+                     hash(obstable.ObsRecord(applyto=['Science', 'Arc'])))
+
 
 class TestObsTable():
     @classmethod
@@ -158,3 +182,511 @@ class TestObsTable():
 
     def test_append_table(self):
         pass
+
+
+class TestObsTableColumns():
+    @classmethod
+    def setup_class(cls):
+        TestObsTableColumns.obsrecords = [
+            obstable.ObsRecord(targetname='SDSSJ000429.46-002142.8',
+                               rootname='S20130719', band='HK', grism='HK',
+                               datatype='Science', applyto='None',
+                               filerange='496-499', exptime=90, lnrs=6,
+                               rdmode='faint'),
+            obstable.ObsRecord(targetname='SDSSJ000429.46-002142.8',
+                               rootname='S20130719', band='HK', grism='HK',
+                               datatype='Dark', applyto='Science,Arc',
+                               filerange='592-595', exptime=90, lnrs=1,
+                               rdmode='faint'),
+            obstable.ObsRecord(targetname='SDSSJ000429.46-002142.8',
+                               rootname='S20130719', band='HK', grism='HK',
+                               datatype='Flat', applyto='Science,Arc',
+                               filerange='501', exptime=4, lnrs=1,
+                               rdmode='bright')]
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_categorical_codes(self):
+        table = obstable.ObsTable(records=TestObsTableColumns.obsrecords)
+        assert_list_equal(list(table.data['datatype']), [0, 1, 2])
+        assert_list_equal(list(table.data['band']), [0, 0, 0])
+        assert_list_equal(table.get_categories('rdmode'), ['faint', 'bright'])
+
+    def test_get_column(self):
+        expected_result = ['Science', 'Dark', 'Flat']
+        table = obstable.ObsTable(records=TestObsTableColumns.obsrecords)
+        result = list(table.get_column('datatype'))
+        assert_list_equal(result, expected_result)
+
+    def test_missing_values(self):
+        table = obstable.ObsTable(records=[obstable.ObsRecord()])
+        assert_equal(table.data['band'][0], -1)
+        assert_equal(table.data['lnrs'][0], -1)
+        result = table.records[0]
+        assert_equal(result, obstable.ObsRecord())
+
+    def test_records_view(self):
+        table = obstable.ObsTable(records=TestObsTableColumns.obsrecords[:1])
+        records = table.records
+        assert_equal(table.records is records, True)
+        table.add_records_to_table(TestObsTableColumns.obsrecords[1:])
+        assert_equal(len(table), 3)
+        assert_list_equal(table.records, TestObsTableColumns.obsrecords)
+
+    def test_records_setter(self):
+        table = obstable.ObsTable(records=TestObsTableColumns.obsrecords)
+        table.records = TestObsTableColumns.obsrecords[2:]
+        assert_equal(table.length, 1)
+        assert_list_equal(table.records, TestObsTableColumns.obsrecords[2:])
+
+    def test_growth(self):
+        table = obstable.ObsTable()
+        for i in range(100):
+            table.add_records_to_table(TestObsTableColumns.obsrecords[i % 3])
+        assert_equal(len(table), 100)
+        assert_equal(table.records[99], TestObsTableColumns.obsrecords[0])
+
+
+class TestSelectRecords():
+    @classmethod
+    def setup_class(cls):
+        TestSelectRecords.table = obstable.ObsTable()
+        TestSelectRecords.table.add_columns_to_table({
+            'targetname': ['SDSSJ0004', 'SDSSJ0004', 'SDSSJ0004',
+                           'SDSSJ0004', 'SDSSJ0117'],
+            'rootname': ['S20130719'] * 5,
+            'band': ['HK', 'HK', 'HK', 'HK', 'JH'],
+            'grism': ['HK', 'HK', 'HK', 'HK', 'JH'],
+            'datatype': ['Science', 'Dark', 'Flat', 'Dark', 'Science'],
+            'applyto': ['None', 'Science,Arc', 'Science,Arc', 'Flat', 'None'],
+            'filerange': ['496-499', '592-595', '501', '588-591',
+                          '58,60-62'],
+            'exptime': [90., 90., 4., 4., 120.],
+            'lnrs': [6, 6, 1, 1, 8],
+            'rdmode': ['faint', 'faint', 'bright', 'bright', 'faint']})
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def select_rows(self, criteria):
+        return list(TestSelectRecords.table.select_records_from_table(
+            criteria).rows)
+
+    def test_equals(self):
+        assert_list_equal(self.select_rows({'datatype': ['Dark', 'equals']}),
+                          [1, 3])
+        assert_list_equal(self.select_rows({'datatype': 'Dark',
+                                            'exptime': 90., 'LNRS': 6,
+                                            'rdmode': 'faint'}), [1])
+        assert_list_equal(self.select_rows({'rootname': 'S20130719',
+                                            'band': 'JH'}), [4])
+
+    def test_equals_unknown(self):
+        assert_list_equal(self.select_rows({'datatype': 'Arc'}), [])
+
+    def test_contain(self):
+        assert_list_equal(self.select_rows({'applyto': ['Arc', 'contain']}),
+                          [1, 2])
+        assert_list_equal(self.select_rows({'targetname': ['0117',
+                                                           'contain']}), [4])
+
+    def test_range(self):
+        assert_list_equal(self.select_rows({'exptime': [(50, None),
+                                                        'range']}),
+                          [0, 1, 4])
+        assert_list_equal(self.select_rows({'lnrs': [(1, 6), 'range'],
+                                            'datatype': 'Dark'}), [1, 3])
+
+    def test_overlap(self):
+        assert_list_equal(self.select_rows({'filerange': ['499-501',
+                                                          'overlap']}),
+                          [0, 2])
+        assert_list_equal(self.select_rows({'filerange': ['59', 'overlap']}),
+                          [])
+        assert_list_equal(self.select_rows({'filerange': ['60', 'overlap']}),
+                          [4])
+
+    def test_invalid(self):
+        assert_raises(ValueError,
+                      TestSelectRecords.table.select_records_from_table,
+                      {'band': [(1, 2), 'range']})
+        assert_raises(ValueError,
+                      TestSelectRecords.table.select_records_from_table,
+                      {'seeing': 0.5})
+
+    def test_view(self):
+        view = TestSelectRecords.table.select_records_from_table(
+            {'band': 'HK'})
+        assert_equal(len(view), 4)
+        assert_equal(view.table is TestSelectRecords.table, True)
+        darks = view.select_records_from_table({'datatype': 'Dark'})
+        assert_list_equal(list(darks.get_column('filerange')),
+                          ['592-595', '588-591'])
+        assert_list_equal(darks.records,
+                          [TestSelectRecords.table.records[1],
+                           TestSelectRecords.table.records[3]])
+
+
+class TestObsTableIndexes():
+    @classmethod
+    def setup_class(cls):
+        TestObsTableIndexes.obsrecords = []
+        for (datatype, exptime, lnrs, rdmode) in [('Science', 90, 6, 'faint'),
+                                                  ('Dark', 90, 6, 'faint'),
+                                                  ('Flat', 4, 1, 'bright'),
+                                                  ('Dark', 4, 1, 'bright'),
+                                                  ('Dark', 90, 6, 'faint')]:
+            TestObsTableIndexes.obsrecords.append(obstable.ObsRecord(
+                targetname='SDSSJ0004', rootname='S20130719', band='HK',
+                grism='HK', datatype=datatype, applyto='Science',
+                filerange='1', exptime=exptime, lnrs=lnrs, rdmode=rdmode))
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_default_indexes(self):
+        table = obstable.ObsTable()
+        assert_list_equal(sorted(table.indexes),
+                          sorted(obstable.ObsTable.DEFAULT_INDEXES))
+
+    def test_incremental(self):
+        table = obstable.ObsTable()
+        criteria = {'exptime': 90, 'lnrs': 6, 'rdmode': 'faint',
+                    'datatype': 'Dark'}
+        table.add_records_to_table(TestObsTableIndexes.obsrecords[:2])
+        assert_list_equal(list(table.get_selected_rows(criteria)), [1])
+        table.add_records_to_table(TestObsTableIndexes.obsrecords[2:])
+        assert_list_equal(list(table.get_selected_rows(criteria)), [1, 4])
+
+    def test_same_as_scan(self):
+        indexed = obstable.ObsTable(records=TestObsTableIndexes.obsrecords)
+        scanned = obstable.ObsTable(records=TestObsTableIndexes.obsrecords,
+                                    indexes=[])
+        for criteria in [{'exptime': 4., 'lnrs': 1, 'rdmode': 'bright'},
+                         {'band': 'HK', 'grism': 'HK', 'datatype': 'Flat'},
+                         {'band': 'HK', 'grism': 'JH'},
+                         {'exptime': 90., 'lnrs': 6, 'rdmode': 'slow'}]:
+            assert_list_equal(list(indexed.get_selected_rows(criteria)),
+                              list(scanned.get_selected_rows(criteria)))
+
+    def test_index_used(self):
+        table = obstable.ObsTable(records=TestObsTableIndexes.obsrecords)
+        criteria = {'exptime': 90, 'lnrs': 6, 'rdmode': 'faint'}
+        # tamper with the index: the query must answer from it
+        table._indexes[('exptime', 'lnrs', 'rdmode')][(90., 6, 0)] = [3]
+        assert_list_equal(list(table.get_selected_rows(criteria)), [3])
+
+    def test_create_drop_index(self):
+        table = obstable.ObsTable(records=TestObsTableIndexes.obsrecords,
+                                  indexes=[])
+        table.create_index(('datatype', 'RDMODE'))
+        assert_list_equal(table.indexes, [('datatype', 'rdmode')])
+        view = table.select_records_from_table({'datatype': 'Dark',
+                                                'rdmode': 'faint'})
+        assert_list_equal(list(view.rows), [1, 4])
+        table.drop_index(('datatype', 'rdmode'))
+        assert_list_equal(table.indexes, [])
+        assert_raises(ValueError, table.create_index, ('seeing',))
+
+    def test_read_table_keeps_indexes(self):
+        table = obstable.ObsTable(records=TestObsTableIndexes.obsrecords)
+        table.records = TestObsTableIndexes.obsrecords[:2]
+        criteria = {'band': 'HK', 'grism': 'HK'}
+        assert_list_equal(list(table.get_selected_rows(criteria)), [0, 1])
+
+
+class TestAppendTable():
+    @classmethod
+    def setup_class(cls):
+        TestAppendTable.tmpdir = tempfile.mkdtemp()
+        TestAppendTable.obsrecords = [
+            obstable.ObsRecord(targetname='SDSSJ000429.46-002142.8',
+                               rootname='S20130719', band='HK', grism='HK',
+                               datatype='Science', applyto='None',
+                               filerange='496-499', exptime=90, lnrs=6,
+                               rdmode='faint'),
+            obstable.ObsRecord(targetname='SDSSJ000429.46-002142.8',
+                               rootname='S20130719', band='HK', grism='HK',
+                               datatype='Dark', applyto='Science',
+                               filerange='592-595', exptime=90, lnrs=6,
+                               rdmode='faint'),
+            obstable.ObsRecord(targetname='SDSSJ000429.46-002142.8',
+                               rootname='S20130719', band='HK', grism='HK',
+                               datatype='Telluric', applyto='Science,Arc',
+                               filerange='601-604', exptime=4, lnrs=1,
+                               rdmode='bright')]
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestAppendTable.tmpdir)
+
+    def get_filename(self, name):
+        filename = os.path.join(TestAppendTable.tmpdir, name)
+        if os.path.exists(filename):
+            os.remove(filename)
+        return filename
+
+    def test_append_new_file(self):
+        filename = self.get_filename('new.dat')
+        table = obstable.ObsTable(records=TestAppendTable.obsrecords)
+        table.append_table(filename)
+        result = obstable.ObsTable(filename).records
+        assert_list_equal(result, TestAppendTable.obsrecords)
+
+    def test_append_tab(self):
+        filename = self.get_filename('tab.dat')
+        table = obstable.ObsTable(records=TestAppendTable.obsrecords[:1])
+        table.write_table(filename)
+        table.add_records_to_table(TestAppendTable.obsrecords[1:])
+        table.append_table(filename)
+        # nothing new: nothing written
+        table.append_table(filename)
+        expected_result = open(filename).read()
+        table.write_table(filename)
+        assert_multi_line_equal(open(filename).read(), expected_result)
+
+    def test_append_pretty(self):
+        filename = self.get_filename('pretty.dat')
+        table = obstable.ObsTable(records=TestAppendTable.obsrecords[:2])
+        table.pretty_table(filename)
+        table = obstable.ObsTable(filename)
+        table.add_records_to_table(TestAppendTable.obsrecords[2])
+        table.append_table(filename)
+        # 'Science,Arc' is wider than the applyto column: rewritten
+        expected_result = open(filename).read()
+        table.pretty_table(filename)
+        assert_multi_line_equal(open(filename).read(), expected_result)
+        table.add_records_to_table(TestAppendTable.obsrecords[0])
+        table.append_table(filename)
+        lines = open(filename).read().splitlines()
+        assert_equal(len(lines), 5)
+        assert_equal(len(set(len(line) for line in lines)), 1)
+        result = obstable.ObsTable(filename).records
+        assert_list_equal(result, TestAppendTable.obsrecords +
+                          TestAppendTable.obsrecords[:1])
+
+    def test_append_pretty_unread(self):
+        # a record too wide for a file the table did not read: the
+        # records on disk are kept in the rewritten table
+        filename = self.get_filename('pretty_unread.dat')
+        table = obstable.ObsTable(records=TestAppendTable.obsrecords[:2])
+        table.pretty_table(filename)
+        table = obstable.ObsTable(records=TestAppendTable.obsrecords[2:])
+        table.append_table(filename)
+        lines = open(filename).read().splitlines()
+        assert_equal(len(set(len(line) for line in lines)), 1)
+        result = obstable.ObsTable(filename).records
+        assert_list_equal(result, TestAppendTable.obsrecords)
+
+    def test_pretty_astropy(self):
+        from astropy.io import ascii
+        filename = self.get_filename('astropy.dat')
+        table = obstable.ObsTable(records=TestAppendTable.obsrecords)
+        table.write_table(filename)
+        ascii.write(ascii.read(filename), output=filename,
+                    format='fixed_width', bookend=False, delimiter=None,
+                    overwrite=True)
+        expected_result = open(filename).read()
+        table.pretty_table(filename)
+        assert_multi_line_equal(open(filename).read(), expected_result)
+
+
+class TestIterRecords():
+    @classmethod
+    def setup_class(cls):
+        TestIterRecords.tmpdir = tempfile.mkdtemp()
+        TestIterRecords.obsrecords = []
+        for i in range(25):
+            TestIterRecords.obsrecords.append(obstable.ObsRecord(
+                targetname='SDSSJ%04d' % (i % 3), rootname='S20130719',
+                band='HK', grism='HK',
+                datatype=['Science', 'Dark', 'Flat', 'Arc', 'Telluric'][i % 5],
+                applyto='None', filerange='%d-%d' % (10 * i, 10 * i + 3),
+                exptime=[90, 4][i % 2], lnrs=[6, 1][i % 2],
+                rdmode=['faint', 'bright'][i % 2]))
+        table = obstable.ObsTable(records=TestIterRecords.obsrecords)
+        TestIterRecords.tabfile = os.path.join(TestIterRecords.tmpdir,
+                                               'tab.dat')
+        TestIterRecords.prettyfile = os.path.join(TestIterRecords.tmpdir,
+                                                  'pretty.dat')
+        table.write_table(TestIterRecords.tabfile)
+        table.pretty_table(TestIterRecords.prettyfile)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestIterRecords.tmpdir)
+
+    def test_iter_records(self):
+        for filename in [TestIterRecords.tabfile, TestIterRecords.prettyfile]:
+            result = list(obstable.iter_records(filename, chunksize=4))
+            assert_list_equal(result, TestIterRecords.obsrecords)
+
+    def test_iter_records_criteria(self):
+        expected_result = [record for record in TestIterRecords.obsrecords
+                           if record.datatype == 'Dark' and
+                           record.exptime == 4.]
+        criteria = {'datatype': 'Dark', 'exptime': [(None, 10), 'range']}
+        for filename in [TestIterRecords.tabfile, TestIterRecords.prettyfile]:
+            result = list(obstable.iter_records(filename, criteria,
+                                                chunksize=7))
+            assert_list_equal(result, expected_result)
+
+    def test_iter_table_chunks(self):
+        chunks = list(obstable.iter_table_chunks(TestIterRecords.prettyfile,
+                                                 chunksize=10))
+        # the title line counts in the first chunk
+        assert_list_equal([len(chunk) for chunk in chunks], [9, 10, 6])
+        filerange = [value for chunk in chunks
+                     for value in chunk.get_column('filerange')]
+        assert_list_equal(filerange, [record.filerange for record
+                                      in TestIterRecords.obsrecords])
+
+    def test_iter_table_chunks_skipped(self):
+        # chunks without selected rows are not returned
+        criteria = {'filerange': ['0-3', 'overlap']}
+        chunks = list(obstable.iter_table_chunks(TestIterRecords.tabfile,
+                                                 criteria, chunksize=5))
+        assert_equal(len(chunks), 1)
+        assert_list_equal(chunks[0].records, TestIterRecords.obsrecords[:1])
+
+
+class TestMerge():
+    @classmethod
+    def setup_class(cls):
+        TestMerge.obsrecords = []
+        for i in range(10):
+            TestMerge.obsrecords.append(obstable.ObsRecord(
+                targetname='SDSSJ%04d' % (i % 3), rootname='S20130719',
+                band='HK', grism='HK', datatype=['Science', 'Dark'][i % 2],
+                applyto=[None, ['Science', 'Arc']][i % 2],
+                filerange='%d-%d' % (10 * i, 10 * i + 3),
+                exptime=[90, None][i % 2], lnrs=6, rdmode='faint'))
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_merge(self):
+        table = obstable.ObsTable(records=TestMerge.obsrecords[:6])
+        other = obstable.ObsTable(records=TestMerge.obsrecords[4:] +
+                                  TestMerge.obsrecords[8:])
+        assert_equal(table.merge(other), 4)
+        assert_list_equal(table.records, TestMerge.obsrecords)
+
+    def test_merge_records(self):
+        table = obstable.ObsTable(records=TestMerge.obsrecords[:3])
+        assert_equal(table.merge(TestMerge.obsrecords), 7)
+        assert_equal(table.merge(TestMerge.obsrecords), 0)
+        assert_list_equal(table.records, TestMerge.obsrecords)
+
+    def test_merge_after_add(self):
+        # the hashes kept from the first merge must include the new rows
+        table = obstable.ObsTable(records=TestMerge.obsrecords[:2])
+        table.merge(TestMerge.obsrecords[2:4])
+        table.add_records_to_table(TestMerge.obsrecords[4])
+        assert_equal(table.merge(TestMerge.obsrecords[:5]), 0)
+        assert_equal(len(table), 5)
+
+    def test_merge_view(self):
+        table = obstable.ObsTable()
+        other = obstable.ObsTable(records=TestMerge.obsrecords)
+        view = other.select_records_from_table({'datatype': 'Dark'})
+        assert_equal(table.merge(view), 5)
+        assert_list_equal(table.records, TestMerge.obsrecords[1::2])
+
+
+class TestConcurrentWrites():
+    @classmethod
+    def setup_class(cls):
+        TestConcurrentWrites.tmpdir = tempfile.mkdtemp()
+        TestConcurrentWrites.obsrecords = []
+        for i in range(6):
+            TestConcurrentWrites.obsrecords.append(obstable.ObsRecord(
+                targetname='SDSSJ0001', rootname='S20130719', band='HK',
+                grism='HK', datatype='Science', applyto='None',
+                filerange='%d-%d' % (10 * i, 10 * i + 3), exptime=90,
+                lnrs=6, rdmode='faint'))
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestConcurrentWrites.tmpdir)
+
+    def get_filename(self, name, pretty):
+        filename = os.path.join(TestConcurrentWrites.tmpdir, name)
+        table = obstable.ObsTable(records=TestConcurrentWrites.obsrecords[:1])
+        if pretty:
+            table.pretty_table(filename)
+        else:
+            table.write_table(filename)
+        return filename
+
+    def test_concurrent_appends(self):
+        records = TestConcurrentWrites.obsrecords
+        for pretty in [False, True]:
+            filename = self.get_filename('appends%d.dat' % pretty, pretty)
+            table1 = obstable.ObsTable(filename)
+            table2 = obstable.ObsTable(filename)
+            table1.add_records_to_table(records[1:3])
+            table1.append_table()
+            # records[2] was already appended by table1
+            table2.add_records_to_table(records[2:4])
+            table2.append_table()
+            assert_list_equal(table2.records, records[:4])
+            assert_list_equal(obstable.ObsTable(filename).records,
+                              records[:4])
+
+    def test_write_keeps_concurrent_append(self):
+        records = TestConcurrentWrites.obsrecords
+        filename = self.get_filename('write.dat', False)
+        table1 = obstable.ObsTable(filename)
+        table2 = obstable.ObsTable(filename)
+        table1.add_records_to_table(records[1:3])
+        table1.append_table()
+        table2.add_records_to_table(records[3])
+        table2.write_table()
+        assert_list_equal(obstable.ObsTable(filename).records, records[:4])
+        table2.add_records_to_table(records[4])
+        table2.pretty_table()
+        assert_list_equal(obstable.ObsTable(filename).records, records[:5])
+
+    def test_remove_keeps_concurrent_append(self):
+        records = TestConcurrentWrites.obsrecords
+        for pretty in [False, True]:
+            filename = self.get_filename('remove%d.dat' % pretty, pretty)
+            table1 = obstable.ObsTable(filename)
+            table1.add_records_to_table(records[1:3])
+            table1.append_table()
+            table2 = obstable.ObsTable(filename)
+            table3 = obstable.ObsTable(filename)
+            table3.add_records_to_table(records[3])
+            table3.append_table()
+            table2.remove_rows([1])
+            table2.add_records_to_table(records[4])
+            table2.append_table()
+            assert_list_equal(obstable.ObsTable(filename).records,
+                              [records[0], records[2], records[3],
+                               records[4]])
+
+    def test_no_merge_other_file(self):
+        # writing over a file that the table was not read from replaces it
+        records = TestConcurrentWrites.obsrecords
+        filename = self.get_filename('other.dat', False)
+        table = obstable.ObsTable(records=records[3:5])
+        table.write_table(filename)
+        assert_list_equal(obstable.ObsTable(filename).records, records[3:5])
+
+    def test_lock_file(self):
+        filename = self.get_filename('lock.dat', False)
+        table = obstable.ObsTable(filename)
+        table.add_records_to_table(TestConcurrentWrites.obsrecords[1])
+        table.append_table()
+        table.pretty_table()
+        expected_result = ['lock.dat']
+        # no temporary or lock file left behind
+        result = sorted(name for name in os.listdir(TestConcurrentWrites.tmpdir)
+                        if name.startswith('lock'))
+        assert_list_equal(result, expected_result)
@@ -1,14 +1,33 @@
 from klpyastro.utils import throughput
+from astropy.io import ascii
+from astropy import units as u
+from nose.tools import assert_equal
+from nose.tools import assert_almost_equal
+from nose.tools import assert_true
+from nose.tools import assert_raises
+from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_almost_equal
+import numpy as np
+import os
+import shutil
+import tempfile
 
 class TestAtmosphericTransparency:
 
     @classmethod
     def setup_class(cls):
-        pass
+        wlen = np.arange(100.) + 1000.
+        transmission = np.ones(100)
+        transmission[[5, 6, 7, 12, 30, 31, 99]] = 0.1
+        (fd, TestAtmosphericTransparency.filename) = \
+            tempfile.mkstemp(suffix='.dat')
+        os.close(fd)
+        ascii.write([wlen, transmission], TestAtmosphericTransparency.filename,
+                    names=['wlen', 'T'], overwrite=True)
 
     @classmethod
     def teardown_class(cls):
-        pass
+        os.remove(TestAtmosphericTransparency.filename)
 
     def setup(self):
         pass
@@ -17,14 +36,183 @@ class TestAtmosphericTransparency:
         pass
 
     def test_init(self):
-        pass
+        atmos = throughput.AtmosphericTransparency(
+            TestAtmosphericTransparency.filename)
+        assert_equal(atmos.wlen.size, 100)
+        assert_equal(atmos.wunit, u.Angstrom)
+
+    def test_get_blocked_regions1(self):
+        expected_result = [[1005., 1012.], [1030., 1031.], [1099., 1099.]]
+        atmos = throughput.AtmosphericTransparency(
+            TestAtmosphericTransparency.filename)
+        result = atmos.get_blocked_regions(cutoff=0.5, tolerance=5)
+        assert_array_equal(result, expected_result)
+
+    def test_get_blocked_regions2(self):
+        # smaller tolerance splits the first region
+        expected_result = [[1005., 1007.], [1012., 1012.], [1030., 1031.]]
+        atmos = throughput.AtmosphericTransparency(
+            TestAtmosphericTransparency.filename)
+        result = atmos.get_blocked_regions(cutoff=0.5, tolerance=2,
+                                           upper=1050.)
+        assert_array_equal(result, expected_result)
+
+    def test_get_blocked_regions3(self):
+        # limits as Quantity
+        expected_result = [[1012., 1012.], [1030., 1031.]]
+        atmos = throughput.AtmosphericTransparency(
+            TestAtmosphericTransparency.filename)
+        result = atmos.get_blocked_regions(cutoff=0.5, tolerance=5,
+                                           lower=0.101 * u.micron,
+                                           upper=0.105 * u.micron)
+        assert_array_equal(result, expected_result)
+
+    def test_get_blocked_regions4(self):
+        # nothing blocked
+        atmos = throughput.AtmosphericTransparency(
+            TestAtmosphericTransparency.filename)
+        result = atmos.get_blocked_regions(cutoff=0.05)
+        assert_equal(result.shape, (0, 2))
+
+
+class TestAtmosphericModelGrid:
+
+    @classmethod
+    def setup_class(cls):
+        TestAtmosphericModelGrid.tmpdir = tempfile.mkdtemp()
+        wlen = np.linspace(19000., 25000., 601)
+        TestAtmosphericModelGrid.wlen = wlen
+        TestAtmosphericModelGrid.tau_dry = \
+            0.05 + np.exp(-0.5 * ((wlen - 22000.) / 50.)**2)
+        TestAtmosphericModelGrid.tau_h2o = \
+            0.02 + 0.1 * np.exp(-0.5 * ((wlen - 20000.) / 80.)**2)
+        airmass = np.array([1., 1.5, 2.])
+        pwv = np.array([1., 3., 5.])
+        transmission = np.exp(-TestAtmosphericModelGrid.optical_depth(
+            airmass[:, np.newaxis, np.newaxis],
+            pwv[np.newaxis, :, np.newaxis]))
+        TestAtmosphericModelGrid.filename = os.path.join(
+            TestAtmosphericModelGrid.tmpdir, 'models.atmgrid')
+        throughput.AtmosphericModelGrid.build(
+            TestAtmosphericModelGrid.filename, airmass, pwv, wlen,
+            transmission)
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(TestAtmosphericModelGrid.tmpdir)
+
+    @staticmethod
+    def optical_depth(airmass, pwv):
+        return airmass * (TestAtmosphericModelGrid.tau_dry +
+                          pwv * TestAtmosphericModelGrid.tau_h2o)
+
+    def test_init(self):
+        grid = throughput.AtmosphericModelGrid(
+            TestAtmosphericModelGrid.filename)
+        assert_array_equal(grid.airmass, [1., 1.5, 2.])
+        assert_array_equal(grid.pwv, [1., 3., 5.])
+        assert_array_equal(grid.wlen, TestAtmosphericModelGrid.wlen)
+        assert_equal(grid.wunit, u.Angstrom)
+
+    def test_get_transmission1(self):
+        # on a grid node
+        grid = throughput.AtmosphericModelGrid(
+            TestAtmosphericModelGrid.filename)
+        expected = np.exp(-TestAtmosphericModelGrid.optical_depth(1.5, 3.))
+        assert_array_almost_equal(grid.get_transmission(1.5, 3.), expected)
+
+    def test_get_transmission2(self):
+        # log-space interpolation is exact for an absorbing atmosphere
+        grid = throughput.AtmosphericModelGrid(
+            TestAtmosphericModelGrid.filename)
+        expected = np.exp(-TestAtmosphericModelGrid.optical_depth(1.23, 2.1))
+        assert_array_almost_equal(grid.get_transmission(1.23, 2.1), expected)
+
+    def test_get_transmission3(self):
+        grid = throughput.AtmosphericModelGrid(
+            TestAtmosphericModelGrid.filename)
+        assert_raises(ValueError, grid.get_transmission, 2.5, 3.)
+        assert_raises(ValueError, grid.get_transmission, 1.5, 0.5)
+
+    def test_cache(self):
+        grid = throughput.AtmosphericModelGrid(
+            TestAtmosphericModelGrid.filename, cachesize=2)
+        transmission = grid.get_transmission(1.2, 2.)
+        assert_true(grid.get_transmission(1.2, 2.) is transmission)
+        grid.get_transmission(1.3, 2.)
+        grid.get_transmission(1.4, 2.)
+        assert_equal(len(grid._cache), 2)
+        assert_true(grid.get_transmission(1.2, 2.) is not transmission)
+
+    def test_get_transparency(self):
+        grid = throughput.AtmosphericModelGrid(
+            TestAtmosphericModelGrid.filename)
+        atmos = grid.get_transparency(2., 1.)
+        result = atmos.get_blocked_regions(cutoff=0.5)
+        assert_equal(result.shape, (1, 2))
+        assert_true(result[0, 0] < 22000. < result[0, 1])
+
+    def test_build_from_files(self):
+        filenames = []
+        for airmass in [1., 2.]:
+            filenames.append([])
+            for pwv in [1., 5.]:
+                filename = os.path.join(TestAtmosphericModelGrid.tmpdir,
+                                        'model_%g_%g.dat' % (airmass, pwv))
+                transmission = np.exp(-TestAtmosphericModelGrid.optical_depth(
+                    airmass, pwv))
+                ascii.write([TestAtmosphericModelGrid.wlen, transmission],
+                            filename, names=['wlen', 'T'], overwrite=True)
+                filenames[-1].append(filename)
+        grid = throughput.AtmosphericModelGrid.build_from_files(
+            os.path.join(TestAtmosphericModelGrid.tmpdir, 'files.atmgrid'),
+            [1., 2.], [1., 5.], filenames)
+        expected = np.exp(-TestAtmosphericModelGrid.optical_depth(1.5, 2.))
+        assert_array_almost_equal(grid.get_transmission(1.5, 2.), expected,
+                                  decimal=4)
+
+    def test_build_permissions(self):
+        # a new grid gets the umask permissions, a rebuilt grid keeps its
+        filename = os.path.join(TestAtmosphericModelGrid.tmpdir,
+                                'mode.atmgrid')
+        args = ([1.], [1.], TestAtmosphericModelGrid.wlen,
+                np.ones((1, 1, TestAtmosphericModelGrid.wlen.size)))
+        umask = os.umask(0o022)
+        try:
+            throughput.AtmosphericModelGrid.build(filename, *args)
+            assert_equal(os.stat(filename).st_mode & 0o777, 0o644)
+            os.chmod(filename, 0o664)
+            throughput.AtmosphericModelGrid.build(filename, *args)
+            assert_equal(os.stat(filename).st_mode & 0o777, 0o664)
+        finally:
+            os.umask(umask)
+
+
+class TestInRegions:
+
+    def test_in_regions1(self):
+        wlen = np.arange(10.)
+        regions = np.array([[1., 2.], [5., 5.], [7.5, 20.]])
+        expected_result = [False, True, True, False, False, True, False,
+                           False, True, True]
+        result = throughput.in_regions(wlen, regions)
+        assert_array_equal(result, expected_result)
+
+    def test_in_regions2(self):
+        # no regions
+        result = throughput.in_regions(np.arange(3.), np.empty((0, 2)))
+        assert_array_equal(result, [False, False, False])
 
 
 class TestTransmissionBand:
 
     @classmethod
     def setup_class(cls):
-        pass
+        # boxcar band from 1.0 to 1.2 microns
+        wlen = np.linspace(0.9, 1.3, 401)
+        transmission = np.where((wlen >= 1.0) & (wlen <= 1.2), 1., 0.)
+        TestTransmissionBand.band = throughput.TransmissionBand(
+            'box', wlen=wlen, transmission=transmission, wunit='micron')
 
     @classmethod
     def teardown_class(cls):
@@ -37,17 +225,109 @@ class TestTransmissionBand:
         pass
 
     def test_init(self):
+        assert_equal(TestTransmissionBand.band.wunit, u.micron)
+
+    def test_get_central_wlen(self):
+        result = TestTransmissionBand.band.get_central_wlen()
+        assert_almost_equal(result, 1.1, places=3)
+
+    def test_get_bandwidth(self):
+        result = TestTransmissionBand.band.get_bandwidth()
+        assert_almost_equal(result, 0.2)
+
+    def test_get_weights(self):
+        # weights on a grid in Angstrom sum to 1 and are zero out of band
+        wlen = np.linspace(8000., 14000., 601)
+        weights = TestTransmissionBand.band.get_weights(wlen, 'Angstrom')
+        assert_almost_equal(weights.sum(), 1.)
+        assert_equal(weights[(wlen < 9990.) | (wlen > 12010.)].sum(), 0.)
+
+
+class TestSyntheticPhotometry:
+
+    @classmethod
+    def setup_class(cls):
+        wlen = np.linspace(0.9, 2.5, 1601)
+        TestSyntheticPhotometry.bands = []
+        for (name, low, high) in [('b1', 1.0, 1.2), ('b2', 1.5, 1.7)]:
+            transmission = np.where((wlen >= low) & (wlen <= high), 1., 0.)
+            TestSyntheticPhotometry.bands.append(
+                throughput.TransmissionBand(name, wlen=wlen,
+                                            transmission=transmission,
+                                            wunit='micron'))
+
+    @classmethod
+    def teardown_class(cls):
         pass
 
+    def test_band_fluxes1(self):
+        # flat spectra return their level in every band
+        photometry = throughput.SyntheticPhotometry(
+            TestSyntheticPhotometry.bands)
+        wlen = np.linspace(0.8, 2.4, 3000)
+        spectra = np.array([np.ones(wlen.size), 3. * np.ones(wlen.size)])
+        result = photometry.band_fluxes(wlen, spectra)
+        assert_array_almost_equal(result, [[1., 1.], [3., 3.]])
+
+    def test_band_fluxes2(self):
+        # single spectrum
+        photometry = throughput.SyntheticPhotometry(
+            TestSyntheticPhotometry.bands)
+        wlen = np.linspace(0.8, 2.4, 3000)
+        spectrum = np.where(wlen < 1.4, 2., 5.)
+        result = photometry.band_fluxes(wlen, spectrum)
+        assert_array_almost_equal(result, [2., 5.])
+
+    def test_get_weights_cached(self):
+        photometry = throughput.SyntheticPhotometry(
+            TestSyntheticPhotometry.bands)
+        wlen = np.linspace(0.8, 2.4, 3000)
+        photometry.get_weights(wlen)
+        cached = list(photometry._weights.values())
+        photometry.get_weights(wlen.copy())
+        assert_equal(len(photometry._weights), 2)
+        assert_true(all(a is b for (a, b) in
+                        zip(cached, photometry._weights.values())))
+
+    def test_get_weights_same_name(self):
+        # two bands with the same name but different curves
+        (band1, band2) = TestSyntheticPhotometry.bands
+        band3 = throughput.TransmissionBand(band1.name, wlen=band2.wlen,
+                                            transmission=band2.transmission,
+                                            wunit=band2.wunit)
+        photometry = throughput.SyntheticPhotometry([band1, band3])
+        wlen = np.linspace(0.8, 2.4, 3000)
+        spectrum = np.where(wlen < 1.4, 2., 5.)
+        assert_array_almost_equal(photometry.band_fluxes(wlen, spectrum),
+                                  [2., 5.])
+
+    def test_get_weights_cachesize(self):
+        photometry = throughput.SyntheticPhotometry(
+            TestSyntheticPhotometry.bands, cachesize=3)
+        for npix in (1000, 2000, 3000):
+            photometry.get_weights(np.linspace(0.8, 2.4, npix))
+        assert_equal(len(photometry._weights), 3)
+
+
 class TestBandList:
 
     @classmethod
     def setup_class(cls):
-        pass
+        TestBandList.datadir = tempfile.mkdtemp()
+        TestBandList.cachedir = tempfile.mkdtemp()
+        wlen = np.linspace(10000., 25000., 151)
+        for (name, low, high) in [('J-band', 11000., 13000.),
+                                  ('H-band', 15000., 17000.)]:
+            transmission = np.where((wlen >= low) & (wlen <= high), 0.9, 0.)
+            ascii.write([wlen, transmission],
+                        os.path.join(TestBandList.datadir, name + '.dat'),
+                        names=['wlen', 'T'], overwrite=True)
+        TestBandList.bands_table = throughput.BANDS_TABLE[:2]
 
     @classmethod
     def teardown_class(cls):
-        pass
+        shutil.rmtree(TestBandList.datadir)
+        shutil.rmtree(TestBandList.cachedir)
 
     def setup(self):
         pass
@@ -55,6 +335,87 @@ class TestBandList:
     def teardown(self):
         pass
 
+    def new_registry(self):
+        return throughput.BandRegistry(TestBandList.bands_table,
+                                       search_path=[TestBandList.datadir],
+                                       cachedir=TestBandList.cachedir)
+
     def test_init(self):
-        pass
+        registry = self.new_registry()
+        bandlist = throughput.BandList(1. * u.micron, 2. * u.micron,
+                                       registry=registry)
+        result = [band.name for band in bandlist.bands]
+        assert_equal(result, ['J-band', 'H-band'])
+
+    def test_get_bands_for_range(self):
+        registry = self.new_registry()
+        bandlist = throughput.BandList(1.5 * u.micron, 2. * u.micron,
+                                       registry=registry)
+        result = [band.name for band in bandlist.bands]
+        assert_equal(result, ['H-band'])
+
+    def test_shared_bands(self):
+        # bands are built once and shared by all BandList instances
+        registry = self.new_registry()
+        bandlist1 = throughput.BandList(1. * u.micron, 2. * u.micron,
+                                        registry=registry)
+        bandlist2 = throughput.BandList(1. * u.micron, 2. * u.micron,
+                                        registry=registry)
+        assert_true(bandlist1.bands[0] is bandlist2.bands[0])
+
+    def test_binary_cache(self):
+        (wlen, transmission) = self.new_registry().get_curve('J-band')
+        assert_true(os.path.exists(os.path.join(TestBandList.cachedir,
+                                                'J-band.npz')))
+        (cwlen, ctransmission) = self.new_registry().get_curve('J-band')
+        assert_array_equal(cwlen, wlen)
+        assert_array_equal(ctransmission, transmission)
+        assert_equal(ctransmission.dtype, np.float32)
+
+    def test_missing_curve(self):
+        registry = self.new_registry()
+        assert_raises(IOError, registry.get_curve, 'Z-band')
+        registry.bands_table = throughput.BANDS_TABLE
+        assert_raises(IOError, throughput.BandList, 1. * u.micron,
+                      3. * u.micron, registry)
+        bandlist = throughput.BandList(1. * u.micron, 3. * u.micron,
+                                       registry, skip_missing=True)
+        assert_equal([band.name for band in bandlist.bands],
+                     ['J-band', 'H-band'])
+
+    def test_truncated_cache(self):
+        # a cache file left partial by an interrupted writer is ignored
+        # and replaced
+        (wlen, transmission) = self.new_registry().get_curve('H-band')
+        cachefile = os.path.join(TestBandList.cachedir, 'H-band.npz')
+        with open(cachefile, 'rb') as npzfile:
+            content = npzfile.read()
+        with open(cachefile, 'wb') as npzfile:
+            npzfile.write(content[:len(content) // 2])
+        (cwlen, ctransmission) = self.new_registry().get_curve('H-band')
+        assert_array_equal(cwlen, wlen)
+        assert_array_equal(ctransmission, transmission)
+        with np.load(cachefile) as cached:
+            assert_array_equal(cached['wlen'], wlen)
+        # no temporary file is left
+        assert_equal([name for name in os.listdir(TestBandList.cachedir)
+                      if not name.endswith('-band.npz')], [])
 
+    def test_default_registry(self):
+        # the shared registry lists BANDS_TABLE, with the curves in the
+        # current directory
+        registry = throughput.BAND_REGISTRY
+        assert_equal(registry.bands_table, throughput.BANDS_TABLE)
+        assert_equal(registry.search_path, [os.curdir])
+        cwd = os.getcwd()
+        emptydir = tempfile.mkdtemp()
+        try:
+            os.chdir(emptydir)
+            bandlist = throughput.BandList(1. * u.micron, 3. * u.micron,
+                                           skip_missing=True)
+            assert_equal(bandlist.bands, [])
+            assert_raises(IOError, throughput.BandList, 1. * u.micron,
+                          3. * u.micron)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(emptydir)
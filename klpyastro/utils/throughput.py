@@ -1,77 +1,766 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import zipfile
+
 from astropy.io import ascii
 from astropy import units as u
 import numpy as np
 
 class AtmosphericTransparency:
-    def __init__(self, filename, wunit='Angstrom'):
-        data = ascii.read(filename)
-        self.wlen = data.field('wlen').data
-        self.transmission = data.field('T').data
+    def __init__(self, filename=None, wunit='Angstrom', wlen=None,
+                 transmission=None):
+        # Either read the ASCII model 'filename', or use the wlen and
+        # transmission arrays, eg. interpolated by AtmosphericModelGrid.
+        if filename is not None:
+            data = ascii.read(filename)
+            self.wlen = data.field('wlen').data
+            self.transmission = data.field('T').data
+        else:
+            self.wlen = np.asarray(wlen)
+            self.transmission = np.asarray(transmission)
         self.wunit = u.Unit(wunit)
         #data.field('wlen').units
 
-    def get_blocked_regions(self, cutoff=0.8, lower=None, upper=None):
-        blocked_regions = []
-        # wlength range with T < 0.5 = blocked region
-        cutoff_positions = np.where(self.transmission < cutoff)
-        wblocks = []
-        tolerance = 10
-        current_block_starts = 0
-        current_block_ends = 0
-        for pos in cutoff_positions:
-            if (pos - current_block_ends) <= tolerance:
-                current_block_ends = pos
-                prev_pos = pos
-            else:
-                # end of a block
-                wlow = self.wlen[current_block_starts]
-                whigh = self.wlen[current_block_ends]
-                wblocks.append((wlow, whigh))
+    def get_blocked_regions(self, cutoff=0.8, lower=None, upper=None,
+                            tolerance=10):
+        """
+        Find the wavelength regions where the transmission is below cutoff.
+
+        The blocked pixels are grouped in runs.  Runs separated by
+        'tolerance' pixels or fewer are merged into one region.  The
+        whole computation is vectorized.
+
+        Parameters
+        ----------
+        cutoff : float, optional
+            Transmission below which the atmosphere is considered opaque.
+            Default = 0.8
+        lower, upper : float or Quantity, optional
+            Limits of the wavelength range to search.  Floats are in wunit.
+        tolerance : int, optional
+            Largest gap, in pixels, between two blocked pixels of the same
+            region.  Default = 10
+
+        Returns
+        -------
+        ndarray
+            Array of shape (n, 2) with the lower and upper wavelengths,
+            in wunit, of the n blocked regions, in increasing order.
+
+        See Also
+        --------
+        in_regions : Mask wavelengths against the regions.
+        """
+        (first, last) = (0, self.wlen.size)
+        if lower is not None:
+            first = np.searchsorted(self.wlen, _to_value(lower, self.wunit),
+                                    side='left')
+        if upper is not None:
+            last = np.searchsorted(self.wlen, _to_value(upper, self.wunit),
+                                   side='right')
+
+        blocked = np.flatnonzero(self.transmission[first:last] < cutoff)
+        if blocked.size == 0:
+            return np.empty((0, 2), dtype=self.wlen.dtype)
+        blocked += first
+
+        # run-length encoding: a gap larger than tolerance ends a region
+        breaks = np.flatnonzero(np.diff(blocked) > tolerance)
+        starts = np.concatenate(([blocked[0]], blocked[breaks + 1]))
+        ends = np.concatenate((blocked[breaks], [blocked[-1]]))
+
+        return np.column_stack((self.wlen[starts], self.wlen[ends]))
+
+class AtmosphericModelGrid(object):
+    """
+    Grid of atmospheric transmission models indexed by airmass and
+    precipitable water vapour, stored in a single binary file.
+
+    The file holds the common wavelength grid and the natural logarithm
+    of the transmission of all the models.  It is memory-mapped, so only
+    the four models that bracket a requested (airmass, pwv) are read from
+    disk.  The transmission is interpolated bilinearly in log-space,
+    which is exact for the airmass dependence of an absorbing atmosphere
+    (Beer-Lambert).  The interpolated curves are kept in a small
+    least-recently-used cache, since the exposures of a sequence share
+    nearly identical conditions.
+
+    Parameters
+    ----------
+    filename : str
+        Grid file written by AtmosphericModelGrid.build().
+    cachesize : int, optional
+        Number of interpolated curves to keep in memory.  Default = 32
+
+    Attributes
+    ----------
+    airmass : ndarray
+        Airmass values of the grid, in increasing order.
+    pwv : ndarray
+        Precipitable water vapour values, in mm, in increasing order.
+    wlen : ndarray
+        Wavelengths common to all the models, in wunit.
+    wunit : Unit
+        Units of the wavelengths.
+
+    Examples
+    --------
+    >>> AtmosphericModelGrid.build_from_files('mk_models.atmgrid',
+    ...     [1.0, 1.5, 2.0], [1.0, 1.6, 3.0, 5.0],
+    ...     [['mktrans_zm_10_10.dat', 'mktrans_zm_16_10.dat', ...], ...])
+    >>> grid = AtmosphericModelGrid('mk_models.atmgrid')
+    >>> atmos = grid.get_transparency(1.23, 2.1)
+    >>> regions = atmos.get_blocked_regions()
+    """
+    MAGIC = b'KLPYATMG'
+
+    def __init__(self, filename, cachesize=32):
+        self.filename = filename
+        with open(filename, 'rb') as gridfile:
+            magic = gridfile.read(len(self.MAGIC))
+            if magic != self.MAGIC:
+                raise IOError('%s is not an atmospheric model grid' %
+                              filename)
+            (hdrsize,) = struct.unpack('<I', gridfile.read(4))
+            header = json.loads(gridfile.read(hdrsize).decode('utf-8'))
+
+        self.airmass = np.array(header['airmass'], dtype=np.float64)
+        self.pwv = np.array(header['pwv'], dtype=np.float64)
+        self.wunit = u.Unit(header['wunit'])
+        nwlen = header['nwlen']
+        offset = header['offset']
+        self.wlen = np.memmap(filename, dtype='<f8', mode='r',
+                              offset=offset, shape=(nwlen,))
+        self._logtrans = np.memmap(filename, dtype='<f4', mode='r',
+                                   offset=offset + 8 * nwlen,
+                                   shape=(self.airmass.size, self.pwv.size,
+                                          nwlen))
+
+        self.cachesize = cachesize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, filename, airmass, pwv, wlen, transmission,
+              wunit='Angstrom'):
+        """
+        Write a grid file.
+
+        The file is written under a temporary name then renamed, so that
+        a concurrent reader never sees a partial grid.  The permissions
+        of an existing grid are kept, a new one gets the default
+        permissions set by the umask.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the grid file to create.
+        airmass : array_like
+            Airmass values of the grid, in increasing order.
+        pwv : array_like
+            Water vapour values of the grid, in increasing order.
+        wlen : array_like
+            Wavelengths common to all the models, in increasing order.
+        transmission : array_like
+            Transmission, 0 to 1, of shape (airmass.size, pwv.size,
+            wlen.size).
+        wunit : str or Unit, optional
+            Units of the wavelengths.  Default = 'Angstrom'
+
+        Returns
+        -------
+        AtmosphericModelGrid
+            The grid, opened from the new file.
+        """
+        airmass = np.asarray(airmass, dtype=np.float64)
+        pwv = np.asarray(pwv, dtype=np.float64)
+        wlen = np.asarray(wlen, dtype='<f8')
+        transmission = np.asarray(transmission, dtype=np.float64)
+        if transmission.shape != (airmass.size, pwv.size, wlen.size):
+            raise ValueError('Transmission shape %s does not match the grid '
+                             '(%d, %d, %d)' % (transmission.shape,
+                                               airmass.size, pwv.size,
+                                               wlen.size))
+        if np.any(np.diff(airmass) <= 0) or np.any(np.diff(pwv) <= 0):
+            raise ValueError('Airmass and pwv must be in increasing order')
+
+        # Zero transmission is floored so that its logarithm is finite.
+        tiny = np.finfo(np.float32).tiny
+        logtrans = np.log(np.clip(transmission, tiny, None)).astype('<f4')
 
-        # to save an if in the loop I just let the first
-        # block at position 0 be appended to the wblocks
-        # Here I just remove it.  (I make sure it's a 0-0)
-        if wblocks[0][0] == wblocks[0][1]:
-            wblocks = wblocks[1:]
+        header = {'airmass': airmass.tolist(),
+                  'pwv': pwv.tolist(),
+                  'wunit': u.Unit(wunit).to_string(),
+                  'nwlen': int(wlen.size),
+                  'offset': 0}
+        # The header size depends on the offset it records.  Reserve
+        # enough digits, then align the data on 8 bytes.
+        hdrsize = len(json.dumps(header)) + 16
+        offset = len(cls.MAGIC) + 4 + hdrsize
+        header['offset'] = offset + (-offset) % 8
+        hdrbytes = json.dumps(header).encode('utf-8')
+        hdrbytes += b' ' * (header['offset'] - len(cls.MAGIC) - 4 -
+                            len(hdrbytes))
 
-        return block_regions
+        # mkstemp creates the file readable by its owner only.
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode & 0o777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        directory = os.path.dirname(os.path.abspath(filename))
+        (fd, tmpname) = tempfile.mkstemp(suffix='.atmgrid', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as gridfile:
+                gridfile.write(cls.MAGIC)
+                gridfile.write(struct.pack('<I', len(hdrbytes)))
+                gridfile.write(hdrbytes)
+                gridfile.write(wlen.tobytes())
+                gridfile.write(logtrans.tobytes())
+            os.chmod(tmpname, mode)
+            os.rename(tmpname, filename)
+        except Exception:
+            os.remove(tmpname)
+            raise
+        return cls(filename)
+
+    @classmethod
+    def build_from_files(cls, filename, airmass, pwv, modelfiles,
+                         wunit='Angstrom'):
+        """
+        Write a grid file from ASCII models in the AtmosphericTransparency
+        format.  Every model is interpolated on the wavelengths of the
+        first one.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the grid file to create.
+        airmass, pwv : array_like
+            Airmass and water vapour values of the grid.
+        modelfiles : list of list of str
+            modelfiles[i][j] is the model for airmass[i] and pwv[j].
+        wunit : str or Unit, optional
+            Units of the wavelengths.  Default = 'Angstrom'
+
+        Returns
+        -------
+        AtmosphericModelGrid
+            The grid, opened from the new file.
+        """
+        wlen = None
+        transmission = None
+        for (i, row) in enumerate(modelfiles):
+            for (j, modelfile) in enumerate(row):
+                model = AtmosphericTransparency(modelfile, wunit=wunit)
+                if wlen is None:
+                    wlen = np.asarray(model.wlen, dtype=np.float64)
+                    transmission = np.empty((len(modelfiles), len(row),
+                                             wlen.size))
+                transmission[i, j] = np.interp(wlen, model.wlen,
+                                               model.transmission)
+        return cls.build(filename, airmass, pwv, wlen, transmission,
+                         wunit=wunit)
+
+    def get_transmission(self, airmass, pwv):
+        """
+        Interpolated transmission for the given airmass and water vapour.
+
+        Parameters
+        ----------
+        airmass : float
+            Airmass, within the range of the grid.
+        pwv : float
+            Precipitable water vapour, in mm, within the range of the grid.
+
+        Returns
+        -------
+        ndarray
+            Transmission on the wavelengths of the grid.  The array is
+            shared with the cache and read-only.
+
+        Raises
+        ------
+        ValueError
+            The airmass or the water vapour is outside the grid.
+        """
+        # Conditions closer than the rounding share a cached curve.
+        key = (round(float(airmass), 4), round(float(pwv), 3))
+        with self._lock:
+            if key in self._cache:
+                transmission = self._cache.pop(key)
+                self._cache[key] = transmission
+                return transmission
+
+        (ia1, ia2, wa) = _bracket(self.airmass, key[0], 'airmass')
+        (ip1, ip2, wp) = _bracket(self.pwv, key[1], 'pwv')
+        logtrans = (1. - wa) * ((1. - wp) * self._logtrans[ia1, ip1] +
+                                wp * self._logtrans[ia1, ip2]) + \
+            wa * ((1. - wp) * self._logtrans[ia2, ip1] +
+                  wp * self._logtrans[ia2, ip2])
+        transmission = np.exp(logtrans.astype(np.float64))
+        transmission.flags.writeable = False
+
+        with self._lock:
+            self._cache[key] = transmission
+            while len(self._cache) > self.cachesize:
+                self._cache.popitem(last=False)
+        return transmission
+
+    def get_transparency(self, airmass, pwv):
+        """
+        Interpolated model for the given airmass and water vapour, as an
+        AtmosphericTransparency.  See get_transmission().
+        """
+        return AtmosphericTransparency(wunit=self.wunit, wlen=self.wlen,
+                                       transmission=self.get_transmission(
+                                           airmass, pwv))
+
+    def clear_cache(self):
+        """
+        Forget the interpolated curves.
+        """
+        with self._lock:
+            self._cache.clear()
+        return
 
 class TransmissionBand:
+    """
+    Transmission curve of a photometric band.
+
+    Parameters
+    ----------
+    name : str
+        Name of the band.  The curve is obtained from the band registry,
+        BAND_REGISTRY, unless it is given with wlen and transmission.
+    wlen : ndarray, optional
+        Wavelengths of a user-supplied curve, in increasing order.
+    transmission : ndarray, optional
+        Transmission of a user-supplied curve, 0 to 1.
+    wunit : str or Unit, optional
+        Units of the wavelengths.  Default = 'Angstrom'
+    """
     # transmission: ndarray of values 0 to 1
     # central wavelength: Angstrom
-    def __init__(self, name):
+    def __init__(self, name, wlen=None, transmission=None, wunit='Angstrom'):
         self.name = name
-        (self.wlen, self.transmission) = self.get_transmission_curve(name)
+        if wlen is None or transmission is None:
+            (self.wlen, self.transmission) = self.get_transmission_curve(name)
+        else:
+            self.wlen = np.asarray(wlen, dtype=np.float64)
+            self.transmission = np.asarray(transmission, dtype=np.float64)
+        self.wunit = u.Unit(wunit)
 
     def get_transmission_curve(self, name):
-        data = ascii.read(''.join([name,'.dat']))
-        wlen = data.field('wlen').data
-        transmission = data.field('T').data
-        return (wlen, transmission)
+        return BAND_REGISTRY.get_curve(name)
 
     def get_central_wlen(self):
-        cwlen = 0.
+        """
+        Transmission-weighted mean wavelength of the band, in wunit.
+        """
+        weights = _trapezoid_weights(self.wlen) * self.transmission
+        cwlen = np.sum(weights * self.wlen) / np.sum(weights)
         return cwlen
 
     def get_bandwidth(self, cutoff=0.2):
-        bandwidth = 0.
+        """
+        Width of the wavelength range, in wunit, over which the
+        transmission is at least 'cutoff' times its peak value.
+        """
+        (lower, upper) = self.get_limits(cutoff)
+        bandwidth = upper - lower
         return bandwidth
 
+    def get_limits(self, cutoff=0.2):
+        """
+        Lower and upper wavelengths, in wunit, of the range over which the
+        transmission is at least 'cutoff' times its peak value.
+        """
+        above = np.flatnonzero(self.transmission >=
+                               cutoff * self.transmission.max())
+        return (self.wlen[above[0]], self.wlen[above[-1]])
+
+    def get_weights(self, wlen, wunit=None):
+        """
+        Integration weights of the band on a wavelength grid.
+
+        The band flux of a spectrum f on the grid is np.dot(f, weights),
+        the photon-weighted mean flux density through the band,
+        integral(f T wlen dwlen) / integral(T wlen dwlen).
+
+        Parameters
+        ----------
+        wlen : ndarray
+            Wavelength grid of the spectra, in increasing order.
+        wunit : str or Unit, optional
+            Units of the grid.  Default is the band's wunit.
+
+        Returns
+        -------
+        ndarray
+            Weights, same size as wlen.  All zero if the band does not
+            overlap the grid.
+        """
+        bandwlen = self.wlen
+        if wunit is not None and u.Unit(wunit) != self.wunit:
+            bandwlen = (self.wlen * self.wunit).to(wunit).value
+        wlen = np.asarray(wlen, dtype=np.float64)
+        transmission = np.interp(wlen, bandwlen, self.transmission,
+                                 left=0., right=0.)
+        weights = transmission * wlen * _trapezoid_weights(wlen)
+        norm = weights.sum()
+        if norm > 0:
+            weights /= norm
+        return weights
+
+
+class SyntheticPhotometry(object):
+    """
+    Synthetic photometry of batches of spectra through a set of bands.
+
+    The integration weights of each band on a wavelength grid are computed
+    once and cached per (grid, band curve) pair.  Integrating a stack of
+    spectra through all the bands is then a single matrix product.
+
+    Parameters
+    ----------
+    bands : list of TransmissionBand or str
+        The bands.  Names are loaded with TransmissionBand(name).
+    cachesize : int, optional
+        Number of (grid, band curve) weights to keep in memory.
+        Default = 64
+
+    Attributes
+    ----------
+    bands : list of TransmissionBand
+        The bands, in the order of the output columns.
+
+    Examples
+    --------
+    >>> photometry = SyntheticPhotometry(['J-band', 'H-band', 'K-band'])
+    >>> fluxes = photometry.band_fluxes(wlen, spectra)
+    >>> fluxes.shape
+    (nspectra, 3)
+    """
+    def __init__(self, bands, cachesize=64):
+        self.bands = []
+        for band in bands:
+            if not isinstance(band, TransmissionBand):
+                band = TransmissionBand(band)
+            self.bands.append(band)
+        self.cachesize = cachesize
+        self._weights = OrderedDict()
+
+    def get_weights(self, wlen, wunit=None):
+        """
+        Return the (npix, nbands) matrix of integration weights of all the
+        bands on the wavelength grid, computing only those not in the cache.
+        """
+        wlen = np.ascontiguousarray(wlen, dtype=np.float64)
+        gridkey = (hashlib.sha1(wlen.tobytes()).hexdigest(), str(wunit))
+        columns = []
+        for band in self.bands:
+            # Keyed on the curve, not the name: two user bands can share
+            # a name.
+            key = (gridkey, _get_band_key(band))
+            if key in self._weights:
+                weights = self._weights.pop(key)
+            else:
+                weights = band.get_weights(wlen, wunit)
+            self._weights[key] = weights
+            columns.append(weights)
+        while len(self._weights) > self.cachesize:
+            self._weights.popitem(last=False)
+        return np.column_stack(columns)
+
+    def band_fluxes(self, wlen, spectra, wunit=None):
+        """
+        Integrate spectra through all the bands.
+
+        Parameters
+        ----------
+        wlen : ndarray
+            Wavelength grid shared by the spectra.
+        spectra : ndarray
+            A spectrum, or a 2-D stack of spectra, one per row, in flux
+            density per unit wavelength.
+        wunit : str or Unit, optional
+            Units of the grid.  Default is the bands' wunit.
+
+        Returns
+        -------
+        ndarray
+            Band fluxes, shape (nspectra, nbands), or (nbands,) for a
+            single spectrum.
+        """
+        return np.dot(spectra, self.get_weights(wlen, wunit))
+
+    def clear_cache(self):
+        """
+        Forget the cached integration weights.
+        """
+        self._weights = OrderedDict()
+
 
 class BandList:
-    def __init__(self, lower, upper):
+    def __init__(self, lower, upper, registry=None, skip_missing=False):
         # lower and upper are Quantity objects.  (astropy.units)
-        self.bands = self.get_bands_for_range(lower, upper)
+        # With skip_missing, the bands without a curve are left out.
+        self.registry = BAND_REGISTRY if registry is None else registry
+        self.bands = self.get_bands_for_range(lower, upper, skip_missing)
+
+    def get_bands_for_range(self, lower, upper, skip_missing=False):
+        return self.registry.get_bands_for_range(lower, upper, skip_missing)
+
+
+class BandRegistry(object):
+    """
+    Registry of the band transmission curves listed in a bands table.
+
+    The curves are loaded lazily, the first time a band is requested.
+    The ASCII curve, name.dat, is searched for in the directories of
+    the search path, by default the current directory.  Once parsed, the
+    curve is saved as compact NumPy arrays in a binary cache, and later
+    loads, in this or another process, read the cache instead as long as
+    the ASCII file has not changed.  The TransmissionBand instances are
+    created once and shared by all the users of the registry.
+
+    Parameters
+    ----------
+    bands_table : list of tuple, optional
+        List of (central wavelength Quantity, band name).
+        Default = BANDS_TABLE
+    search_path : list of str, optional
+        Directories where to look for the name.dat files.
+        Default = [current directory]
+    cachedir : str, optional
+        Directory for the binary cache.  Default is the 'bands'
+        subdirectory of the klpyastro cache directory.
+
+    See Also
+    --------
+    BAND_REGISTRY : The registry shared by the whole process.
+    """
+    def __init__(self, bands_table=None, search_path=None, cachedir=None):
+        self.bands_table = BANDS_TABLE if bands_table is None else bands_table
+        if search_path is None:
+            search_path = [os.curdir]
+        self.search_path = search_path
+        self.cachedir = cachedir
+        self._curves = {}
+        self._bands = {}
+        self._lock = threading.Lock()
+
+    def find_curve_file(self, name):
+        """
+        Return the path to the ASCII curve of band 'name'.
+
+        Raises
+        ------
+        IOError
+            The curve was not found in the search path.
+        """
+        for directory in self.search_path:
+            filename = os.path.join(directory, ''.join([name, '.dat']))
+            if os.path.isfile(filename):
+                return os.path.abspath(filename)
+        raise IOError('Transmission curve for %s not found in %s' %
+                      (name, self.search_path))
+
+    def get_curve(self, name):
+        """
+        Return the (wlen, transmission) arrays of band 'name'.  The arrays
+        are shared and read-only.
+        """
+        with self._lock:
+            if name not in self._curves:
+                self._curves[name] = self._load_curve(name)
+        return self._curves[name]
+
+    def get_band(self, name):
+        """
+        Return the shared TransmissionBand instance for band 'name'.
+        """
+        if name not in self._bands:
+            (wlen, transmission) = self.get_curve(name)
+            band = TransmissionBand(name, wlen=wlen, transmission=transmission)
+            with self._lock:
+                self._bands.setdefault(name, band)
+        return self._bands[name]
+
+    def get_bands_for_range(self, lower, upper, skip_missing=False):
+        """
+        Return the bands whose central wavelength is within [lower, upper].
 
-    def get_bands_for_range(self, lower, upper):
+        Parameters
+        ----------
+        lower, upper : Quantity
+            Limits of the wavelength range.
+        skip_missing : bool, optional
+            If True, the bands whose curve cannot be found are left out,
+            with a warning, instead of raising IOError.  Default = False
+        """
         bands = []
-        for (wlen, name) in bands_table:
+        for (wlen, name) in self.bands_table:
             if wlen >= lower and wlen <= upper:
-                band = TransmissionBand(name)
-                bands.append(band)
+                try:
+                    bands.append(self.get_band(name))
+                except IOError as err:
+                    if not skip_missing:
+                        raise
+                    print('Warning: %s skipped (%s)' % (name, err))
         return bands
 
+    def _load_curve(self, name):
+        source = self.find_curve_file(name)
+        mtime = os.path.getmtime(source)
+        cachedir = self.cachedir
+        if cachedir is None:
+            from klpyastro.utils.fileutils import get_cache_dir
+            cachedir = get_cache_dir('bands')
+        cachefile = os.path.join(cachedir, ''.join([name, '.npz']))
+
+        try:
+            with np.load(cachefile) as cached:
+                if str(cached['source']) == source and \
+                        float(cached['mtime']) == mtime:
+                    wlen = cached['wlen']
+                    transmission = cached['transmission']
+                else:
+                    wlen = None
+        except (IOError, OSError, KeyError, ValueError, EOFError,
+                zipfile.BadZipfile):
+            # missing, stale or truncated cache
+            wlen = None
+
+        if wlen is None:
+            data = ascii.read(source)
+            wlen = np.asarray(data.field('wlen').data, dtype=np.float64)
+            transmission = np.asarray(data.field('T').data,
+                                      dtype=np.float32)
+            try:
+                _write_cache(cachefile, wlen=wlen, transmission=transmission,
+                             source=source, mtime=mtime)
+            except (IOError, OSError):
+                pass    # the cache is only an optimization
+
+        wlen.flags.writeable = False
+        transmission.flags.writeable = False
+        return (wlen, transmission)
+
+
 BANDS_TABLE = [(1.2 * u.micron, 'J-band'),
                (1.6 * u.micron, 'H-band'),
                (2.2 * u.micron, 'K-band')
                ]
+
+# Registry shared by all the BandList and TransmissionBand in the process.
+# It lists the bands of BANDS_TABLE.  No band curves are distributed with
+# klpyastro: the name.dat curves are looked up in the current directory,
+# or elsewhere with eg.
+#   BAND_REGISTRY.search_path = ['/path/to/curves']
+BAND_REGISTRY = BandRegistry()
+
+
+def in_regions(wlen, regions):
+    """
+    Flag the wavelengths that fall inside any of the regions.
+
+    Parameters
+    ----------
+    wlen : ndarray
+        Wavelengths to test, in the same units as the regions.
+    regions : ndarray
+        Array of shape (n, 2) of sorted, non-overlapping [lower, upper]
+        intervals, eg. from AtmosphericTransparency.get_blocked_regions().
+        The limits are inclusive.
+
+    Returns
+    -------
+    ndarray of bool
+        True where the wavelength is inside a region.
+    """
+    regions = np.asarray(regions)
+    if regions.size == 0:
+        return np.zeros(np.shape(wlen), dtype=bool)
+    # An odd number of region limits at or below a wavelength means that
+    # the wavelength is inside a region.  Upper limits count only once
+    # passed, so that they are inclusive.
+    nlower = np.searchsorted(regions[:, 0], wlen, side='right')
+    nupper = np.searchsorted(regions[:, 1], wlen, side='left')
+    return nlower > nupper
+
+
+def _trapezoid_weights(wlen):
+    """
+    Weights of the trapezoidal rule on the grid wlen, such that
+    the integral of f is np.sum(f * weights).
+    """
+    weights = np.zeros(wlen.size)
+    steps = np.diff(wlen) / 2.
+    weights[:-1] += steps
+    weights[1:] += steps
+    return weights
+
+
+def _write_cache(cachefile, **arrays):
+    """
+    Write a .npz cache file under a temporary name then rename it, so
+    that a concurrent reader never sees a partial file.
+    """
+    (fd, tmpname) = tempfile.mkstemp(suffix='.npz',
+                                     dir=os.path.dirname(cachefile))
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            np.savez(tmpfile, **arrays)
+        os.rename(tmpname, cachefile)
+    except Exception:
+        os.remove(tmpname)
+        raise
+    return
+
+
+def _get_band_key(band):
+    """
+    Digest of the transmission curve of a band and its units.
+    """
+    digest = hashlib.sha1()
+    for array in (band.wlen, band.transmission):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        digest.update(array.tobytes())
+        digest.update(b'|')
+    digest.update(band.wunit.to_string().encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _bracket(grid, value, name):
+    """
+    Indices of the ends of the grid interval containing value, and the
+    weight of the upper end for linear interpolation.  A grid with a
+    single value accepts only that value.
+    """
+    if value < grid[0] or value > grid[-1]:
+        raise ValueError('%s %g is outside the grid range [%g, %g]' %
+                         (name, value, grid[0], grid[-1]))
+    if grid.size == 1:
+        return (0, 0, 0.)
+    index = min(np.searchsorted(grid, value, side='right') - 1,
+                grid.size - 2)
+    weight = (value - grid[index]) / (grid[index + 1] - grid[index])
+    return (index, index + 1, weight)
+
+
+def _to_value(wlen, wunit):
+    """
+    Return the value of a wavelength in wunit.  Floats are assumed to
+    already be in wunit.
+    """
+    if isinstance(wlen, u.Quantity):
+        return wlen.to(wunit).value
+    return wlen
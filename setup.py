@@ -63,7 +63,8 @@ setup(
                  'klpyastro/scripts/rmextrawcs',
                  'klpyastro/scripts/splot',
                  'klpyastro/scripts/mkdirectories',
-                 'klpyastro/scripts/mktable_helper'
+                 'klpyastro/scripts/mktable_helper',
+                 'klpyastro/scripts/mktable'
                  ],
 
       zip_safe=False,